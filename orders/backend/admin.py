@@ -1,6 +1,8 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from .models import User, Shop, Category, Product, ProductInfo, Parameter, ProductParameter, Order, OrderItem, Contact, ConfirmEmailToken
+from .models import User, Shop, Category, Product, ProductInfo, Parameter, ProductParameter, Order, OrderItem, Contact, ConfirmEmailToken, \
+    ImportJob
+from .tasks import enqueue_import
 
 @admin.register(User)
 class CustomUserAdmin(UserAdmin):
@@ -64,3 +66,22 @@ class ContactAdmin(admin.ModelAdmin):
 @admin.register(ConfirmEmailToken)
 class ConfirmEmailTokenAdmin(admin.ModelAdmin):
     list_display = ('user', 'key', 'created_at',)
+
+
+@admin.register(ImportJob)
+class ImportJobAdmin(admin.ModelAdmin):
+    "Запуск импорта прайса из админки и просмотр статуса задач"
+    list_display = ('id', 'user', 'state', 'goods_processed', 'goods_total', 'created_at', 'finished_at')
+    list_filter = ('state',)
+    readonly_fields = ('state', 'goods_processed', 'goods_total', 'bytes_processed', 'bytes_total', 'stats', 'error',
+                       'created_at', 'started_at', 'finished_at')
+
+    def get_readonly_fields(self, request, obj=None):
+        if obj:
+            return ('user', 'source', 'url', 'format', 'incremental') + self.readonly_fields
+        return self.readonly_fields
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if not change:
+            enqueue_import(obj)
@@ -0,0 +1,157 @@
+from functools import wraps
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Count, F, Max, Sum
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework.response import Response
+
+from backend.models import Shop
+
+
+def get_cache():
+    """
+    Кэш ответов каталога из settings.CACHES.
+    Для тестов подходит локальная память, в продакшене нужен общий для всех процессов кэш: Redis или Memcached.
+    """
+    return caches[settings.CATALOG_CACHE]
+
+
+def bump_catalog_version(shop_ids=None):
+    """
+    Увеличивает версию каталога магазинов, после этого закэшированные ответы по ним больше не выдаются.
+    Без shop_ids - всех магазинов, например после переименования общих категорий.
+    """
+    shops = Shop.objects.all() if shop_ids is None else Shop.objects.filter(id__in=shop_ids)
+    shops.update(catalog_version=F('catalog_version') + 1, catalog_modified=timezone.now())
+
+
+def cached_fragments(keys, build):
+    """
+    Готовые фрагменты ответа из кэша каталога в порядке keys - словаря {идентификатор: ключ кэша}.
+
+    Фрагменты читаются и записываются одним запросом к кэшу (get_many / set_many). Отсутствующие в кэше
+    строит build(идентификаторы) - словарь {идентификатор: фрагмент}. Версия строки входит в ключ,
+    поэтому после изменения строки старый фрагмент просто больше не запрашивается.
+    """
+    cache = get_cache()
+    fragments = cache.get_many(keys.values())
+    missing = [pk for pk, key in keys.items() if key not in fragments]
+    if missing:
+        built = {keys[pk]: fragment for pk, fragment in build(missing).items()}
+        cache.set_many(built, settings.CATALOG_CACHE_TIMEOUT)
+        fragments.update(built)
+    return [fragments[key] for key in keys.values() if key in fragments]
+
+
+def catalog_version(shop_id=None):
+    """
+    Версия каталога одного магазина или, без shop_id, всех магазинов вместе, и время ее последнего изменения.
+    Версия всех магазинов меняется при изменении версии любого из них, а также при добавлении и удалении магазина.
+    """
+    if shop_id is not None:
+        version, modified = Shop.objects.filter(id=shop_id).values_list(
+            'catalog_version', 'catalog_modified').first() or (None, None)
+        return f'shop{shop_id}.{version}', modified
+    versions = Shop.objects.aggregate(count=Count('id'), last=Max('id'), total=Sum('catalog_version'),
+                                      modified=Max('catalog_modified'))
+    return '{count}.{last}.{total}'.format(**versions), versions['modified']
+
+
+def make_etag(request, version):
+    "ETag ответа: версия данных, адрес запроса и формат ответа - JSON или браузерный API"
+    value = f'{version}:{request.get_full_path()}:{request.accepted_media_type}'
+    return quote_etag(md5(value.encode()).hexdigest())
+
+
+def set_validators(response, etag, modified):
+    "Заголовки ETag и Last-Modified ответа, без времени изменения - только ETag"
+    response['ETag'] = etag
+    if modified is not None:
+        response['Last-Modified'] = http_date(modified.timestamp())
+    return response
+
+
+def not_modified(request, etag, modified):
+    """
+    Ответ 304 Not Modified, если у клиента актуальная версия: If-None-Match совпадает с etag или,
+    когда If-None-Match нет, данные не менялись после If-Modified-Since. Иначе None.
+    """
+    response = get_conditional_response(request, etag=etag,
+                                        last_modified=int(modified.timestamp()) if modified is not None else None)
+    return response if response is None else set_validators(response, etag, modified)
+
+
+def conditional_get(version):
+    """
+    Условный GET для ответов, которые не кэшируются, например списка заказов покупателя.
+
+    version(request) возвращает версию данных и время их последнего изменения, по ним ответ получает
+    ETag и Last-Modified. Если у клиента актуальная версия, метод не вызывается и отдается 304 Not Modified.
+    Если version вернула None, например для анонимного пользователя, метод вызывается без проверки.
+    """
+
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            current = version(request)
+            if current is None:
+                return method(self, request, *args, **kwargs)
+
+            etag = make_etag(request, current[0])
+            response = not_modified(request, etag, current[1])
+            if response is not None:
+                return response
+
+            response = method(self, request, *args, **kwargs)
+            if response.status_code == 200:
+                set_validators(response, etag, current[1])
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def cached_response(shop_param=None):
+    """
+    Кэширует данные успешного ответа GET-метода представления по адресу запроса и версии каталога.
+
+    Если в запросе есть параметр shop_param, ключ зависит только от версии этого магазина,
+    иначе - от версии всех магазинов. Версия меняется при импорте и смене статуса магазина,
+    поэтому устаревшие ответы не выдаются, а таймаут кэша нужен только для освобождения памяти.
+    По той же версии ответ получает ETag и Last-Modified, и на условный запрос с актуальной версией
+    отдается 304 Not Modified без обращения к кэшу.
+    """
+
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            shop_id = request.query_params.get(shop_param) if shop_param else None
+            version, modified = catalog_version(int(shop_id) if shop_id and shop_id.isdigit() else None)
+            etag = make_etag(request, version)
+            response = not_modified(request, etag, modified)
+            if response is not None:
+                return response
+
+            path = md5(request.get_full_path().encode()).hexdigest()
+            key = f'catalog:{version}:{path}'
+
+            cache = get_cache()
+            data = cache.get(key)
+            if data is not None:
+                return set_validators(Response(data, headers={'X-Cache': 'HIT'}), etag, modified)
+
+            response = method(self, request, *args, **kwargs)
+            if response.status_code == 200:
+                cache.set(key, response.data, settings.CATALOG_CACHE_TIMEOUT)
+                response['X-Cache'] = 'MISS'
+                set_validators(response, etag, modified)
+            return response
+
+        return wrapper
+
+    return decorator
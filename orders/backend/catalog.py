@@ -0,0 +1,349 @@
+import math
+import re
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, SearchVectorCombinable, \
+    SearchVectorField, TrigramSimilarity
+from django.db import connections
+from django.db.models import Case, Count, F, Func, Min, PositiveIntegerField, Q, Sum, Value, When
+from django.utils import timezone
+
+from backend.models import CatalogEntry, CatalogFacet, CatalogParameter, ProductInfo, ProductParameter, SearchWord
+
+# сколько предложений перестраивается за один запрос
+CATALOG_BATCH_SIZE = 1000
+
+# конфигурация полнотекстового поиска Postgres: русская морфология, английские слова тоже приводятся к основе
+SEARCH_CONFIG = 'russian'
+
+# сколько найденных строк каталога ранжируется по релевантности
+SEARCH_CANDIDATES = 1000
+
+# слова для словаря опечаток: буквенные, не короче трех символов
+SEARCH_WORD_RE = re.compile(r'[^\W\d_]{3,}')
+
+# фильтры по характеристикам в параметрах запроса: param[Цвет]=красный, param_min[Вес (г)]=100, param_max[...]
+PARAMETER_FILTER_RE = re.compile(r'^param(?:_(min|max))?\[(.+)\]$')
+
+# сколько самых частых значений каждой характеристики отдается в фасетах
+FACET_VALUES = 20
+
+# сортировки каталога в параметре ordering; pk делает порядок однозначным для постраничного вывода по курсору
+PRICE_ORDERINGS = {
+    'price': ('price', 'pk'),
+    '-price': ('-price', '-pk'),
+    'price_rrc': ('price_rrc', 'pk'),
+    '-price_rrc': ('-price_rrc', '-pk'),
+}
+
+# поля ProductInfo и связанных таблиц в порядке полей CatalogEntry
+CATALOG_SOURCE_FIELDS = (
+    ('product_info_id', 'id'),
+    ('shop_id', 'shop_id'),
+    ('shop_name', 'shop__name'),
+    ('shop_state', 'shop__state'),
+    ('product_id', 'product_id'),
+    ('product_name', 'product__name'),
+    ('category_id', 'product__category_id'),
+    ('category_name', 'product__category__name'),
+    ('model', 'model'),
+    ('external_id', 'external_id'),
+    ('quantity', 'quantity'),
+    ('price', 'price'),
+    ('price_rrc', 'price_rrc'),
+)
+
+
+def refresh_catalog(product_info_ids, batch_size=CATALOG_BATCH_SIZE, categories=()):
+    """
+    Перестраивает строки каталога и их характеристики для предложений product_info_ids,
+    затем пересчитывает фасеты затронутых категорий.
+    Строки удаленных предложений удаляются каскадно вместе с ProductInfo, здесь они просто не создаются;
+    категории таких строк вызывающий код собирает до удаления и передает в categories.
+    """
+    product_info_ids = sorted(product_info_ids)
+    categories = set(categories)
+    for start in range(0, len(product_info_ids), batch_size):
+        chunk = product_info_ids[start:start + batch_size]
+        # пары [название, значение] в порядке ProductParameter: в jsonb ключи объекта упорядочиваются заново
+        parameters = {}
+        for product_info_id, name, value in ProductParameter.objects.filter(
+                product_info_id__in=chunk).order_by('id').values_list('product_info_id', 'parameter__name', 'value'):
+            parameters.setdefault(product_info_id, []).append([name, value])
+
+        entries = [
+            CatalogEntry(parameters=parameters.get(row[0], []),
+                         **{field: value for (field, _), value in zip(CATALOG_SOURCE_FIELDS, row)})
+            for row in ProductInfo.objects.filter(id__in=chunk).order_by('id').values_list(
+                *(source for _, source in CATALOG_SOURCE_FIELDS))
+        ]
+        # фасеты пересчитываются и для прежних категорий: предложение могло сменить категорию или исчезнуть
+        categories.update(CatalogEntry.objects.filter(product_info_id__in=chunk).values_list('category_id', flat=True))
+        categories.update(entry.category_id for entry in entries)
+
+        CatalogEntry.objects.filter(product_info_id__in=chunk).delete()
+        CatalogEntry.objects.bulk_create(entries, batch_size=batch_size)
+        CatalogParameter.objects.bulk_create([
+            CatalogParameter(entry_id=entry.product_info_id, shop_id=entry.shop_id, shop_state=entry.shop_state,
+                             category_id=entry.category_id, name=name, value=value, number=parse_number(value))
+            for entry in entries for name, value in entry.parameters
+        ], batch_size=batch_size)
+        update_search_index(CatalogEntry.objects.filter(product_info_id__in=chunk), entries)
+
+    refresh_facets(categories)
+
+
+def parse_number(value):
+    "Числовое значение характеристики: 256, 5.5 или 5,5; для остальных значений None"
+    try:
+        number = float(str(value).strip().replace(',', '.'))
+    except ValueError:
+        return None
+    return number if math.isfinite(number) else None
+
+
+def refresh_shop_catalog(shop):
+    "Переносит в строки каталога название и статус магазина, фасеты его категорий пересчитываются"
+    CatalogEntry.objects.filter(shop_id=shop.id).update(shop_name=shop.name, shop_state=shop.state)
+    CatalogParameter.objects.filter(shop_id=shop.id).update(shop_state=shop.state)
+    refresh_facets(CatalogEntry.objects.filter(shop_id=shop.id).values_list('category_id', flat=True).distinct())
+
+
+def update_catalog_quantities(quantities):
+    "Переносит в строки каталога остатки предложений {product_info_id: quantity} одним UPDATE"
+    if quantities:
+        CatalogEntry.objects.filter(product_info_id__in=quantities).update(quantity=Case(
+            *[When(product_info_id=product_info_id, then=Value(quantity))
+              for product_info_id, quantity in quantities.items()],
+            output_field=PositiveIntegerField(),
+        ), updated_at=timezone.now())
+
+
+def refresh_facets(category_ids):
+    """
+    Пересчитывает CatalogFacet для категорий category_ids по характеристикам работающих магазинов.
+    Категория считается по частичному индексу (категория, название, значение, число) без чтения таблицы.
+    """
+    category_ids = sorted(set(category_ids))
+    if not category_ids:
+        return
+    counts = CatalogParameter.objects.filter(category_id__in=category_ids, shop_state=True).values(
+        'category_id', 'name', 'value').annotate(count=Count('*'), low=Min('number')).values_list(
+        'category_id', 'name', 'value', 'low', 'count')
+    facets = [CatalogFacet(category_id=category_id, name=name, value=value, number=number, count=count)
+              for category_id, name, value, number, count in counts]
+    CatalogFacet.objects.filter(category_id__in=category_ids).delete()
+    CatalogFacet.objects.bulk_create(facets, batch_size=CATALOG_BATCH_SIZE)
+
+
+def rename_catalog_categories(categories):
+    "Переносит в строки каталога новые названия категорий, у строк меняется время изменения"
+    for category in categories:
+        CatalogEntry.objects.filter(category_id=category.id).update(category_name=category.name,
+                                                                   updated_at=timezone.now())
+
+
+def rebuild_catalog(product_infos=None, batch_size=CATALOG_BATCH_SIZE):
+    "Полностью перестраивает каталог для queryset предложений, по умолчанию для всех"
+    product_infos = ProductInfo.objects.all() if product_infos is None else product_infos
+    refresh_catalog(product_infos.values_list('id', flat=True), batch_size=batch_size)
+
+
+class ParameterValues(SearchVectorCombinable, Func):
+    "Поисковый вектор из значений характеристик - вторых элементов пар [название, значение] JSON-поля"
+    function = 'jsonb_to_tsvector'
+    template = "setweight(%(function)s('%(config)s'::regconfig, jsonb_path_query_array(%(expressions)s, '$[*][1]'), " \
+               "'[\"string\", \"numeric\"]'), '%(weight)s')"
+    output_field = SearchVectorField()
+
+    def __init__(self, expression, config=SEARCH_CONFIG, weight='C'):
+        super().__init__(expression, config=config, weight=weight)
+
+
+def search_vector():
+    "Поисковый вектор строки каталога: название важнее модели, модель важнее характеристик"
+    return (SearchVector('product_name', config=SEARCH_CONFIG, weight='A')
+            + SearchVector('model', config=SEARCH_CONFIG, weight='B')
+            + ParameterValues('parameters'))
+
+
+def search_words(text):
+    "Слова текста для словаря опечаток в нижнем регистре"
+    return SEARCH_WORD_RE.findall(text.lower())
+
+
+def update_search_index(queryset, entries):
+    """
+    Пересчитывает поисковый вектор строк каталога queryset и добавляет в словарь слова
+    из названий и характеристик entries. Поиск по индексам есть только в Postgres.
+    """
+    if connections[queryset.db].vendor != 'postgresql':
+        return
+    queryset.update(search_vector=search_vector())
+
+    words = set()
+    for entry in entries:
+        words.update(search_words(entry.product_name))
+        for _, value in entry.parameters:
+            words.update(search_words(str(value)))
+    SearchWord.objects.bulk_create([SearchWord(word=word[:80]) for word in sorted(words)], ignore_conflicts=True)
+
+
+def correct_word(word):
+    "Самое похожее на word слово каталога по триграммам или None"
+    return SearchWord.objects.filter(word__trigram_similar=word).annotate(
+        similarity=TrigramSimilarity('word', word)).order_by('-similarity').values_list('word', flat=True).first()
+
+
+def first_matches(matches, limit):
+    """
+    Первичные ключи первых limit строк queryset matches.
+
+    OFFSET 0 во вложенном запросе скрывает LIMIT от планировщика. Иначе при связанных условиях, например
+    поисковом запросе и категории, он рассчитывает на ранние совпадения, выбирает последовательный просмотр
+    и читает всю таблицу, если совпадений нет. Так строки отбираются по индексам, а чтение останавливается на limit.
+    """
+    sql, params = matches.values('pk').query.get_compiler(matches.db).as_sql()
+    with connections[matches.db].cursor() as cursor:
+        cursor.execute(f'SELECT * FROM ({sql} OFFSET 0) matches LIMIT %s', (*params, limit))
+        return [row[0] for row in cursor.fetchall()]
+
+
+def search_catalog(entries, text, candidates=SEARCH_CANDIDATES, ordering=None):
+    """
+    Отбирает строки каталога по поисковому запросу и упорядочивает их по релевантности или по ordering.
+
+    В Postgres строки ищутся по полнотекстовому индексу: название, модель и характеристики с учетом словоформ.
+    Если так ничего не нашлось, запрос считается опечаткой: каждое слово заменяется самым похожим словом
+    каталога по триграммам, и поиск повторяется. По релевантности ранжируются только первые candidates
+    совпадений: у широких запросов совпадают сотни тысяч строк, и ранг каждой из них не помещается во время
+    ответа. Сортировка ordering, например по цене, ранга не требует и выполняется базой по всем совпадениям,
+    иначе самые дешевые предложения выбирались бы из случайной части выдачи.
+    В других СУБД - вхождение подстроки в название или модель без ранжирования.
+    """
+    if connections[entries.db].vendor != 'postgresql':
+        return entries.filter(Q(product_name__icontains=text) | Q(model__icontains=text)).order_by(
+            *(ordering or ('pk',)))
+
+    # для сортировки по ordering достаточно знать, что совпадения есть
+    limit = 1 if ordering else candidates
+    query = SearchQuery(text, config=SEARCH_CONFIG, search_type='websearch')
+    found = first_matches(entries.filter(search_vector=query), limit)
+    if not found:
+        text = text.lower()
+        corrected = SEARCH_WORD_RE.sub(lambda match: correct_word(match.group()) or match.group(), text)
+        if corrected != text:
+            query = SearchQuery(corrected, config=SEARCH_CONFIG, search_type='websearch')
+            found = first_matches(entries.filter(search_vector=query), limit)
+
+    if ordering:
+        return entries.filter(search_vector=query).order_by(*ordering)
+    return entries.filter(pk__in=found).annotate(rank=SearchRank(F('search_vector'), query)).order_by('-rank', 'pk')
+
+
+def price_filters(params):
+    """
+    Условие по цене и наличию из параметров запроса: price_min и price_max - границы цены включительно,
+    in_stock=true - только предложения с ненулевым остатком. Неверное значение - ValueError.
+    """
+    query = Q()
+    for key, lookup in (('price_min', 'price__gte'), ('price_max', 'price__lte')):
+        value = params.get(key, '').strip()
+        if not value:
+            continue
+        if not value.isdigit():
+            raise ValueError(f'{key}: ожидается целое неотрицательное число')
+        query &= Q(**{lookup: int(value)})
+
+    in_stock = params.get('in_stock', '').strip().lower()
+    if in_stock in ('1', 'true', 'yes'):
+        query &= Q(quantity__gt=0)
+    elif in_stock not in ('', '0', 'false', 'no'):
+        raise ValueError('in_stock: ожидается true или false')
+    return query
+
+
+def price_ordering(params):
+    "Порядок строк каталога из параметра ordering, без него None. Неизвестная сортировка - ValueError"
+    ordering = params.get('ordering', '').strip()
+    if not ordering:
+        return None
+    if ordering not in PRICE_ORDERINGS:
+        raise ValueError(f'ordering: ожидается одно из {", ".join(PRICE_ORDERINGS)}')
+    return PRICE_ORDERINGS[ordering]
+
+def parameter_filters(params):
+    """
+    Разбирает фильтры по характеристикам из параметров запроса в {название: условие}.
+
+    param[название]=значение - равенство, несколько одноименных параметров - любое из значений;
+    param_min[название] и param_max[название] - границы числового значения включительно.
+    Неверное число - ValueError.
+    """
+    filters = {}
+    for key in params:
+        match = PARAMETER_FILTER_RE.match(key)
+        if not match:
+            continue
+        bound, name = match.groups()
+        condition = filters.setdefault(name, {})
+        if bound is None:
+            condition['values'] = params.getlist(key)
+            continue
+        number = parse_number(params.get(key))
+        if number is None:
+            raise ValueError(f'{key}: ожидается число')
+        condition[bound] = number
+    return filters
+
+
+def filter_parameters(queryset, filters, field='pk'):
+    """
+    Отбирает строки queryset, у которых строка каталога в поле field подходит под все фильтры parameter_filters.
+    Каждая характеристика - подзапрос к CatalogParameter, который выполняется по индексу (название, значение)
+    или (название, число) без чтения самих строк каталога.
+    """
+    for name, condition in filters.items():
+        parameters = CatalogParameter.objects.filter(name=name)
+        if 'values' in condition:
+            parameters = parameters.filter(value__in=condition['values'])
+        if 'min' in condition:
+            parameters = parameters.filter(number__gte=condition['min'])
+        if 'max' in condition:
+            parameters = parameters.filter(number__lte=condition['max'])
+        queryset = queryset.filter(**{f'{field}__in': parameters.values('entry_id')})
+    return queryset
+
+
+def catalog_facets(shop_id=None, category_id=None, filters=None, entries=None, limit=FACET_VALUES):
+    """
+    Фасеты каталога: по каждой характеристике самые частые значения с количеством предложений,
+    а для числовых характеристик еще наименьшее и наибольшее значение.
+
+    Без фильтров и с фильтром по категории количества суммируются из CatalogFacet. С фильтрами по магазину
+    и характеристикам считаются по индексам CatalogParameter, не читая строки каталога; время растет
+    с количеством подходящих предложений. entries - найденные поиском строки каталога, если был поиск.
+    """
+    if shop_id or filters or entries is not None:
+        counts = filter_parameters(CatalogParameter.objects.filter(shop_state=True), filters or {}, field='entry_id')
+        if shop_id:
+            counts = counts.filter(shop_id=shop_id)
+        if entries is not None:
+            counts = counts.filter(entry_id__in=entries.order_by().values('pk'))
+    else:
+        counts = CatalogFacet.objects.all()
+    if category_id:
+        counts = counts.filter(category_id=category_id)
+    total = Sum('count') if counts.model is CatalogFacet else Count('*')
+
+    facets = {}
+    for name, value, number, count in counts.values('name', 'value').annotate(
+            total=total, low=Min('number')).order_by('name', '-total', 'value').values_list(
+            'name', 'value', 'low', 'total'):
+        facet = facets.setdefault(name, {'parameter': name, 'values': []})
+        if len(facet['values']) < limit:
+            facet['values'].append({'value': value, 'count': count})
+        if number is not None:
+            facet['min'] = min(facet.get('min', number), number)
+            facet['max'] = max(facet.get('max', number), number)
+
+    return list(facets.values())
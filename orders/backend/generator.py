@@ -0,0 +1,141 @@
+import csv
+import io
+import json
+import random
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from backend.parsers import CSV_COLUMNS
+
+# справочники для правдоподобных прайсов в формате data/shop1.yaml. Id категорий совпадают с обычными,
+# импорт синтетических прайсов в рабочую базу переименует их, поэтому bench_import работает с тестовой базой
+CATEGORIES = (
+    (224, 'Смартфоны'), (15, 'Аксессуары'), (1, 'Flash-накопители'), (2, 'Телевизоры'), (3, 'Ноутбуки'),
+    (4, 'Планшеты'), (5, 'Наушники'), (6, 'Мониторы'), (7, 'Фотоаппараты'), (8, 'Умные часы'),
+)
+BRANDS = ('Apple', 'Samsung', 'Xiaomi', 'Huawei', 'Sony', 'LG', 'Lenovo', 'Asus', 'Acer', 'Philips')
+COLORS = ('черный', 'белый', 'красный', 'синий', 'золотистый', 'серебристый', 'зеленый')
+PARAMETERS = (
+    ('Цвет', lambda rng: rng.choice(COLORS)),
+    ('Диагональ (дюйм)', lambda rng: rng.choice((5.5, 6.1, 6.5, 10.1, 13.3, 15.6, 27, 55))),
+    ('Разрешение (пикс)', lambda rng: rng.choice(('1792x828', '2688x1242', '1920x1080', '3840x2160'))),
+    ('Встроенная память (Гб)', lambda rng: rng.choice((16, 32, 64, 128, 256, 512, 1024))),
+    ('Вес (г)', lambda rng: rng.randint(50, 3000)),
+)
+
+
+def scalar(value):
+    "Значение в виде YAML-скаляра: строки в JSON-кавычках корректны и для YAML"
+    if isinstance(value, str):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+
+def parameter_generators(count):
+    "Первые параметры берутся из справочника, остальные генерируются"
+    generators = list(PARAMETERS[:count])
+    for index in range(len(generators), count):
+        generators.append((f'Характеристика {index + 1}', lambda rng: rng.randint(1, 100)))
+    return generators
+
+
+def generate_goods(goods, parameters=4, products=None, seed=0, change_ratio=0.0):
+    """
+    Генерирует goods товаров с parameters характеристиками у каждого.
+
+    Товары выбираются из общего пространства products названий, поэтому у разных магазинов
+    часть продуктов совпадает, как в реальных прайсах. Содержимое определяется seed;
+    change_ratio > 0 меняет цену и остаток у такой доли товаров для проверки инкрементального импорта.
+    """
+    rng = random.Random(seed)
+    changes = random.Random(seed + 1)
+    products = products or goods
+    generators = parameter_generators(parameters)
+
+    for external_id in range(1, goods + 1):
+        product = rng.randrange(products)
+        category_id, category = CATEGORIES[product % len(CATEGORIES)]
+        brand = BRANDS[product // len(CATEGORIES) % len(BRANDS)]
+        price = rng.randint(100, 2000) * 100
+        quantity = rng.randint(0, 50)
+        if change_ratio and changes.random() < change_ratio:
+            price += 100
+            quantity += 1
+        yield {
+            'id': external_id,
+            'category': category_id,
+            'model': f'{brand.lower()}/{product}',
+            'name': f'{category} {brand} {product}',
+            'price': price,
+            'price_rrc': price + price // 10,
+            'quantity': quantity,
+            'parameters': {name: generate(rng) for name, generate in generators},
+        }
+
+
+def categories():
+    return [{'id': category_id, 'name': name} for category_id, name in CATEGORIES]
+
+
+def write_yaml(stream, shop, goods):
+    stream.write(f'shop: {scalar(shop)}\ncategories:\n'.encode())
+    for category_id, name in CATEGORIES:
+        stream.write(f'  - id: {category_id}\n    name: {scalar(name)}\n'.encode())
+
+    stream.write(b'goods:\n')
+    for item in goods:
+        lines = [f'  - id: {item["id"]}\n    category: {item["category"]}\n']
+        for key in ('model', 'name', 'price', 'price_rrc', 'quantity'):
+            lines.append(f'    {key}: {scalar(item[key])}\n')
+        lines.append('    parameters:\n')
+        for name, value in item['parameters'].items():
+            lines.append(f'      {scalar(name)}: {scalar(value)}\n')
+        stream.write(''.join(lines).encode())
+
+
+def write_jsonl(stream, shop, goods):
+    stream.write(json.dumps({'shop': shop, 'categories': categories()}, ensure_ascii=False).encode() + b'\n')
+    for item in goods:
+        stream.write(json.dumps(item, ensure_ascii=False).encode() + b'\n')
+
+
+def write_msgpack(stream, shop, goods):
+    packer = msgpack.Packer()
+    stream.write(packer.pack({'shop': shop, 'categories': categories()}))
+    for item in goods:
+        stream.write(packer.pack(item))
+
+
+def write_csv(stream, shop, goods):
+    # характеристики - дополнительные колонки, их набор известен только после первого товара
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='', write_through=True)
+    writer = None
+    names = dict(CATEGORIES)
+    for item in goods:
+        if writer is None:
+            writer = csv.writer(text)
+            writer.writerow(CSV_COLUMNS + tuple(item['parameters']))
+        writer.writerow([shop, item['category'], names[item['category']], item['id'], item['model'],
+                         item['name'], item['price'], item['price_rrc'], item['quantity'],
+                         *item['parameters'].values()])
+    text.detach()
+
+
+WRITERS = {
+    'yaml': write_yaml,
+    'csv': write_csv,
+    'jsonl': write_jsonl,
+    'msgpack': write_msgpack,
+}
+
+
+def write_pricelist(stream, shop, goods, parameters=4, products=None, seed=0, change_ratio=0.0, format='yaml'):
+    """
+    Пишет в бинарный stream прайс магазина shop в указанном формате, параметры генерации - как в generate_goods.
+    Прайс пишется потоварно, поэтому память не зависит от его размера.
+    """
+    items = generate_goods(goods, parameters=parameters, products=products, seed=seed, change_ratio=change_ratio)
+    WRITERS[format](stream, shop, items)
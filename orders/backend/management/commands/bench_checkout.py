@@ -0,0 +1,138 @@
+import json
+import random
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from statistics import median, quantiles
+from time import perf_counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection, connections, transaction
+from django.db.models import Sum
+from django.test.utils import setup_databases, teardown_databases
+
+from backend.importer import PriceListImporter
+from backend.models import CatalogEntry, Order, OrderItem, ProductInfo, User
+from backend.stock import StockError, checkout
+from backend.totals import refresh_order_totals
+
+
+class Command(BaseCommand):
+    help = 'Нагрузочная проверка резервирования остатков: много одновременных оформлений заказов ' \
+           'с общими предложениями, проверка отсутствия перепродажи и пропускная способность; вывод в JSON. ' \
+           'Замер идет во временной тестовой базе, как у manage.py test, рабочая база не меняется'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buyers', type=int, default=200, help='Покупателей, каждый оформляет одну корзину')
+        parser.add_argument('--workers', type=int, default=16, help='Одновременных оформлений')
+        parser.add_argument('--products', type=int, default=5, help='Предложений, за остатки которых идет борьба')
+        parser.add_argument('--stock', type=int, default=50, help='Остаток каждого предложения перед замером')
+        parser.add_argument('--items', type=int, default=3, help='Наибольшее число позиций в корзине')
+        parser.add_argument('--partial', action='store_true', help='Оформлять то, что есть на складе')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Файл для результатов, по умолчанию stdout')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        # данные фиксируются: параллельные оформления идут в отдельных соединениях к той же временной базе
+        databases = setup_databases(verbosity=0, interactive=False, aliases={connection.alias})
+        try:
+            if connection.vendor == 'sqlite' and connection.creation.is_in_memory_db(connection.settings_dict['NAME']):
+                raise CommandError('Соединения потоков не видят базу в памяти: задайте файл в DATABASES TEST NAME')
+            product_info_ids = self.create_offers(options)
+            baskets = self.prepare(rng, product_info_ids, options)
+            started = perf_counter()
+            with ThreadPoolExecutor(options['workers']) as pool:
+                outcomes = list(pool.map(lambda basket_id: self.place(basket_id, options['partial']), baskets))
+            elapsed = perf_counter() - started
+            report = self.report(outcomes, elapsed, product_info_ids, options)
+        finally:
+            connections.close_all()
+            teardown_databases(databases, verbosity=0)
+
+        report = json.dumps(report, ensure_ascii=False, indent=2)
+        if options['output']:
+            Path(options['output']).write_text(report, encoding='utf-8')
+        else:
+            self.stdout.write(report)
+
+    @staticmethod
+    def create_offers(options):
+        "Магазин с предложениями, за остатки которых идет борьба; возвращает их id"
+        shop = User.objects.create_user('shop@checkout.local', type='shop', is_active=True)
+        PriceListImporter(shop.id).run({
+            'shop': 'Бенчмарк оформления',
+            'categories': [{'id': 1, 'name': 'Бенчмарк'}],
+            'goods': [{'id': number, 'category': 1, 'name': f'Товар {number}', 'model': f'bench/{number}',
+                       'price': 1000 + number, 'price_rrc': 1100 + number, 'quantity': options['stock'],
+                       'parameters': {}}
+                      for number in range(options['products'])],
+        })
+        return list(ProductInfo.objects.order_by('id').values_list('id', flat=True))
+
+    def prepare(self, rng, product_info_ids, options):
+        "Корзины покупателей из случайных позиций по спорным предложениям; возвращает id корзин"
+        shops = dict(ProductInfo.objects.filter(id__in=product_info_ids).values_list('id', 'shop_id'))
+        items = min(options['items'], len(product_info_ids))
+        baskets = []
+        with transaction.atomic():
+            for number in range(options['buyers']):
+                user = User.objects.create_user(f'buyer{number}@checkout.local', is_active=True)
+                basket = Order.objects.create(user=user, status='basket')
+                OrderItem.objects.bulk_create([
+                    OrderItem(order=basket, product_info_id=product_info_id, shop_id=shops[product_info_id],
+                              quantity=rng.randint(1, 3))
+                    for product_info_id in rng.sample(product_info_ids, rng.randint(1, items))
+                ])
+                baskets.append(basket.id)
+            refresh_order_totals(baskets)
+        return baskets
+
+    @staticmethod
+    def place(basket_id, partial):
+        "Оформление одной корзины в своем соединении: исход и время в миллисекундах"
+        started = perf_counter()
+        try:
+            results = checkout(Order.objects.filter(id=basket_id), partial=partial)
+            outcome = 'placed' if all(result['status'] == 'reserved' for result in results) else 'partial'
+        except StockError:
+            outcome = 'rejected'
+        except DatabaseError as error:
+            outcome = type(error).__name__
+        finally:
+            connections.close_all()
+        return outcome, (perf_counter() - started) * 1000
+
+    def report(self, outcomes, elapsed, product_info_ids, options):
+        "Итоги замера и проверка: списано ровно столько, сколько заказано, и остатки не ушли в минус"
+        stock = dict(ProductInfo.objects.filter(id__in=product_info_ids).values_list('id', 'quantity'))
+        ordered = dict(OrderItem.objects.filter(product_info_id__in=product_info_ids).exclude(
+            order__status='basket').values('product_info_id').annotate(total=Sum('quantity')).values_list(
+            'product_info_id', 'total'))
+        catalog = dict(CatalogEntry.objects.filter(product_info_id__in=product_info_ids).values_list(
+            'product_info_id', 'quantity'))
+        counts = {}
+        for outcome, _ in outcomes:
+            counts[outcome] = counts.get(outcome, 0) + 1
+        timings = [timing for _, timing in outcomes]
+        oversold = any(stock[product_info_id] + ordered.get(product_info_id, 0) != options['stock']
+                       for product_info_id in product_info_ids)
+        result = {
+            'parameters': {key: options[key] for key in ('buyers', 'workers', 'products', 'stock', 'items',
+                                                         'partial', 'seed')},
+            'database': connection.vendor,
+            'outcomes': counts,
+            'stock_left': stock,
+            'units_ordered': ordered,
+            'oversold': oversold,
+            'catalog_matches': catalog == stock,
+            'elapsed_s': round(elapsed, 3),
+            'checkouts_per_s': round(len(outcomes) / elapsed, 1) if elapsed else None,
+            'latency_ms': {
+                'median': round(median(timings), 2),
+                'p95': round(quantiles(timings, n=20)[-1], 2) if len(timings) > 1 else round(timings[0], 2),
+            },
+        }
+        self.stderr.write(f'{len(outcomes)} оформлений за {result["elapsed_s"]} с, '
+                          f'{result["checkouts_per_s"]} в секунду, {counts}, '
+                          f'{"ПЕРЕПРОДАЖА" if oversold else "без перепродажи"}')
+        return result
@@ -0,0 +1,128 @@
+import json
+import resource
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_databases, teardown_databases
+
+from backend.generator import WRITERS, write_pricelist
+from backend.importer import BATCH_SIZE, PriceListImporter
+from backend.parsers import detect_format, read_pricelist
+from backend.tasks import create_executor
+
+# префикс названий синтетических магазинов
+SHOP_PREFIX = 'Benchmark'
+
+# сценарии: (название, версия прайса, инкрементальный импорт); None - только разбор без записи в базу.
+# Для форматов из --formats кроме YAML дополнительно замеряется разбор сценарием parse_<формат>
+CASES = (
+    ('parse', 'base', None),
+    ('full', 'base', False),
+    ('incremental_noop', 'base', True),
+    ('incremental_changed', 'changed', True),
+    ('full_repeat', 'changed', False),
+)
+
+
+def run_case(name, paths, incremental, batch_size, database):
+    """
+    Выполняет сценарий в отдельном процессе пула, чтобы пиковая память процесса относилась только к нему.
+    database - имя тестовой базы: процесс пула читает настройки заново и иначе подключился бы к рабочей.
+    """
+    connection.settings_dict['NAME'] = database
+    queries = 0
+
+    def count_queries(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    goods = 0
+    started = perf_counter()
+    with connection.execute_wrapper(count_queries):
+        for path in paths:
+            with open(path, 'rb') as stream:
+                data = read_pricelist(stream, detect_format(path))
+                if incremental is None:
+                    goods += sum(1 for _ in data['goods'])
+                else:
+                    stats = PriceListImporter(None, batch_size=batch_size, incremental=incremental).run(data)
+                    goods += stats['counts']['goods']
+    seconds = perf_counter() - started
+
+    return {
+        'case': name,
+        'files': len(paths),
+        'goods': goods,
+        'seconds': round(seconds, 4),
+        'goods_per_second': round(goods / seconds, 1) if seconds else None,
+        'queries': queries,
+        # ru_maxrss в Linux измеряется в килобайтах
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+class Command(BaseCommand):
+    help = 'Бенчмарк импорта прайсов на синтетических данных с выводом результатов в JSON. ' \
+           'Импорт идет во временную тестовую базу, как у manage.py test, рабочая база не меняется'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shops', type=int, default=1, help='Количество магазинов')
+        parser.add_argument('--goods', type=int, default=1000, help='Количество товаров в каждом прайсе')
+        parser.add_argument('--parameters', type=int, default=4, help='Количество характеристик у товара')
+        parser.add_argument('--change-ratio', type=float, default=0.01,
+                            help='Доля измененных товаров для сценария incremental_changed')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument('--formats', nargs='+', choices=WRITERS, default=['yaml'],
+                            help='Форматы для замера скорости разбора')
+        parser.add_argument('--output', help='Файл для результатов, по умолчанию stdout')
+
+    def handle(self, *args, **options):
+        with TemporaryDirectory() as directory:
+            paths = self.generate(Path(directory), options)
+            results = []
+            cases = list(CASES)
+            cases[1:1] = [(f'parse_{format}', format, None) for format in options['formats'] if format != 'yaml']
+            databases = setup_databases(verbosity=0, interactive=False, aliases={connection.alias})
+            try:
+                database = connection.settings_dict['NAME']
+                if connection.vendor == 'sqlite' and connection.creation.is_in_memory_db(database):
+                    raise CommandError('Процессы пула не видят базу в памяти: задайте файл в DATABASES TEST NAME')
+                for name, version, incremental in cases:
+                    # каждый сценарий запускается в новом процессе для честного замера памяти
+                    with create_executor(1) as executor:
+                        result = executor.submit(run_case, name, paths[version], incremental,
+                                                 options['batch_size'], database).result()
+                    results.append(result)
+                    self.stderr.write(f'{name}: {result["goods_per_second"]} товаров/с, '
+                                      f'{result["queries"]} запросов, {result["seconds"]} с')
+            finally:
+                teardown_databases(databases, verbosity=0)
+
+        report = json.dumps({
+            'parameters': {key: options[key] for key in ('shops', 'goods', 'parameters', 'change_ratio',
+                                                          'batch_size', 'formats')},
+            'database': connection.vendor,
+            'results': results,
+        }, ensure_ascii=False, indent=2)
+        if options['output']:
+            Path(options['output']).write_text(report, encoding='utf-8')
+        else:
+            self.stdout.write(report)
+
+    def generate(self, directory, options):
+        versions = [('base', 'yaml', 0.0), ('changed', 'yaml', options['change_ratio'])]
+        versions += [(format, format, 0.0) for format in options['formats'] if format != 'yaml']
+        paths = {version: [] for version, _, _ in versions}
+        for index in range(options['shops']):
+            for version, format, change_ratio in versions:
+                path = directory / f'{version}_{index + 1}.{format}'
+                with open(path, 'wb') as stream:
+                    write_pricelist(stream, f'{SHOP_PREFIX} {index + 1}', options['goods'],
+                                    parameters=options['parameters'], seed=index, change_ratio=change_ratio,
+                                    format=format)
+                paths[version].append(str(path))
+        return paths
@@ -0,0 +1,76 @@
+import json
+import random
+from pathlib import Path
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Q
+
+from backend.catalog import SEARCH_CANDIDATES, search_catalog
+from backend.models import CatalogEntry, Category, Shop
+from backend.pagination import CatalogSearchPagination
+
+# запросы по умолчанию: широкие, узкие, по характеристикам и с опечатками для данных generate_pricelists
+QUERIES = (
+    'смартфон', 'смартфоны apple', 'телевизор samsung', 'ноутбук', 'наушники sony', 'xiaomi', 'черный',
+    'планшет 128', 'смартфн', 'тилевизор', 'наушнеки',
+)
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+class Command(BaseCommand):
+    help = 'Бенчмарк поиска по текущему каталогу: задержка первой страницы выдачи, вывод в JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--query', action='append', dest='queries', help='Поисковый запрос, можно несколько')
+        parser.add_argument('--repeat', type=int, default=5, help='Сколько раз выполняется каждый запрос')
+        parser.add_argument('--candidates', type=int, default=SEARCH_CANDIDATES)
+        parser.add_argument('--seed', type=int, default=0, help='Выбор магазинов и категорий для фильтров')
+        parser.add_argument('--output', help='Файл для результатов, по умолчанию stdout')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        shop_ids = list(Shop.objects.values_list('id', flat=True))
+        category_ids = list(Category.objects.values_list('id', flat=True))
+        page_size = CatalogSearchPagination.page_size
+
+        results = []
+        for text in options['queries'] or QUERIES:
+            # как в ProductInfoAPIView: без фильтров, с shop_id и с category_id
+            filters = [('', Q())]
+            if shop_ids:
+                shop_id = rng.choice(shop_ids)
+                filters.append((f'shop_id={shop_id}', Q(shop_id=shop_id)))
+            if category_ids:
+                category_id = rng.choice(category_ids)
+                filters.append((f'category_id={category_id}', Q(category_id=category_id)))
+
+            for name, query in filters:
+                timings = []
+                for _ in range(options['repeat']):
+                    started = perf_counter()
+                    entries = CatalogEntry.objects.filter(Q(shop_state=True) & query).defer('search_vector')
+                    found = len(search_catalog(entries, text, candidates=options['candidates'])[:page_size + 1])
+                    timings.append((perf_counter() - started) * 1000)
+                results.append({'query': text, 'filter': name, 'found': found,
+                                'ms_median': round(percentile(timings, 0.5), 2)})
+                self.stderr.write(f'{text!r} {name}: {found} строк, {results[-1]["ms_median"]} мс')
+
+        latencies = [result['ms_median'] for result in results]
+        report = json.dumps({
+            'parameters': {key: options[key] for key in ('repeat', 'candidates', 'seed')},
+            'database': connection.vendor,
+            'catalog_entries': CatalogEntry.objects.count(),
+            'p50_ms': percentile(latencies, 0.5),
+            'p95_ms': percentile(latencies, 0.95),
+            'results': results,
+        }, ensure_ascii=False, indent=2)
+        if options['output']:
+            Path(options['output']).write_text(report, encoding='utf-8')
+        else:
+            self.stdout.write(report)
@@ -0,0 +1,134 @@
+import json
+import random
+from pathlib import Path
+from statistics import median
+from time import perf_counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from rest_framework.renderers import JSONRenderer
+
+from backend.models import CatalogEntry, Order, OrderItem, ProductInfo, User
+from backend.renderers import FastJSONRenderer
+from backend.serializers import CATALOG_ENTRY_VALUES, CatalogEntrySerializer, OrderSerializer, ProductInfoSerializer, \
+    catalog_entry_values, order_list_data
+
+# покупатель с такой почтой создается бенчмарком, его заказы откатываются вместе с транзакцией
+BENCHMARK_EMAIL = 'benchmark@serialization.local'
+
+
+def measure(render, repeat):
+    "Медиана времени render() в миллисекундах и результат последнего вызова"
+    timings = []
+    for _ in range(repeat):
+        started = perf_counter()
+        content = render()
+        timings.append((perf_counter() - started) * 1000)
+    return round(median(timings), 2), content
+
+
+def sorted_parameters(data):
+    "Данные каталога с характеристиками по алфавиту: порядок характеристик в ProductInfoSerializer не задан"
+    for item in data:
+        item['product_parameters'].sort(key=lambda parameter: parameter['parameter'])
+    return data
+
+
+class Command(BaseCommand):
+    help = 'Бенчмарк сериализации списков каталога и заказов: вложенные сериализаторы DRF и JSONRenderer ' \
+           'против values() и orjson, а также список каталога из кэша фрагментов JSON; вывод в JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, default=200, help='Строк каталога в списке')
+        parser.add_argument('--orders', type=int, default=100, help='Заказов в списке заказов')
+        parser.add_argument('--items', type=int, default=10, help='Позиций в каждом заказе')
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Файл для результатов, по умолчанию stdout')
+
+    def handle(self, *args, **options):
+        if not CatalogEntry.objects.exists():
+            raise CommandError('Каталог пуст, сначала импортируйте прайсы')
+        results = [self.bench_catalog(options), self.bench_fragments(options)]
+        # заказы создаются во временной транзакции и после замера откатываются
+        with transaction.atomic():
+            results.append(self.bench_orders(options))
+            transaction.set_rollback(True)
+
+        report = json.dumps({
+            'parameters': {key: options[key] for key in ('page_size', 'orders', 'items', 'repeat', 'seed')},
+            'database': connection.vendor,
+            'results': results,
+        }, ensure_ascii=False, indent=2)
+        if options['output']:
+            Path(options['output']).write_text(report, encoding='utf-8')
+        else:
+            self.stdout.write(report)
+
+    def bench_catalog(self, options):
+        page = CatalogEntry.objects.filter(shop_state=True).order_by('pk')[:options['page_size']]
+        ids = list(page.values_list('pk', flat=True))
+
+        def nested():
+            infos = ProductInfo.objects.filter(id__in=ids).order_by('id').select_related('product').prefetch_related(
+                'product_parameters__parameter')
+            return JSONRenderer().render(ProductInfoSerializer(infos, many=True).data)
+
+        def flat():
+            return FastJSONRenderer().render(CatalogEntrySerializer(page.values(*CATALOG_ENTRY_VALUES), many=True).data)
+
+        return self.compare('catalog', nested, flat, options['repeat'], normalize=sorted_parameters)
+
+    def bench_fragments(self, options):
+        "Список каталога из прогретого кэша фрагментов против сериализации строк values() при каждом запросе"
+        page = CatalogEntry.objects.filter(shop_state=True).order_by('pk')[:options['page_size']]
+
+        def flat():
+            return FastJSONRenderer().render(CatalogEntrySerializer(page.values(*CATALOG_ENTRY_VALUES), many=True).data)
+
+        def fragments():
+            rows = page.values(*catalog_entry_values(fragments=True))
+            return FastJSONRenderer().render(CatalogEntrySerializer(rows, many=True, context={'fragments': True}).data)
+
+        fragments()
+        return self.compare('catalog_fragments', flat, fragments, options['repeat'], labels=('flat', 'fragments'))
+
+    def bench_orders(self, options):
+        rng = random.Random(options['seed'])
+        user = User.objects.create_user(BENCHMARK_EMAIL, is_active=True)
+        infos = list(ProductInfo.objects.order_by('id').values_list('id', 'shop_id')[:options['items'] * 50])
+        for _ in range(options['orders']):
+            order = Order.objects.create(user=user, status=rng.choice(('new', 'confirmed', 'sent')))
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product_info_id=info_id, shop_id=shop_id, quantity=rng.randint(1, 5))
+                for info_id, shop_id in rng.sample(infos, min(options['items'], len(infos)))
+            ])
+        orders = Order.objects.filter(user_id=user.id).exclude(status='basket').distinct()
+
+        def nested():
+            return JSONRenderer().render(OrderSerializer(orders.prefetch_related('ordered_items'), many=True).data)
+
+        def flat():
+            return FastJSONRenderer().render(order_list_data(orders))
+
+        return self.compare('orders', nested, flat, options['repeat'])
+
+    def compare(self, name, before, after, repeat, normalize=None, labels=('nested', 'flat')):
+        before_ms, before_content = measure(before, repeat)
+        after_ms, after_content = measure(after, repeat)
+        if normalize is None:
+            identical = before_content == after_content
+        else:
+            identical = normalize(json.loads(before_content)) == normalize(json.loads(after_content))
+        result = {
+            'case': name,
+            'rows': len(json.loads(after_content)),
+            'bytes': len(after_content),
+            'identical': identical,
+            f'{labels[0]}_ms': before_ms,
+            f'{labels[1]}_ms': after_ms,
+            'speedup': round(before_ms / after_ms, 1) if after_ms else None,
+        }
+        self.stderr.write(f'{name}: {before_ms} мс -> {after_ms} мс, x{result["speedup"]}, '
+                          f'{"совпадает" if identical else "РАЗЛИЧАЕТСЯ"}')
+        return result
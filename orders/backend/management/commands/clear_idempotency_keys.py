@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from backend.idempotency import expired_keys
+
+
+class Command(BaseCommand):
+    help = 'Удаляет ключи идемпотентности старше settings.IDEMPOTENCY_KEY_TTL, например по расписанию cron'
+
+    def handle(self, *args, **options):
+        deleted, _ = expired_keys().delete()
+        self.stdout.write(f'Удалено ключей: {deleted}')
@@ -0,0 +1,34 @@
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from backend.generator import WRITERS, write_pricelist
+
+
+class Command(BaseCommand):
+    help = 'Генерирует синтетические прайсы со структурой data/shop1.yaml. ' \
+           'Категории прайсов имеют id 1-8, 15 и 224: импортируйте их только в тестовую базу'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='Каталог для файлов прайсов')
+        parser.add_argument('--shops', type=int, default=1, help='Количество магазинов (файлов)')
+        parser.add_argument('--goods', type=int, default=1000, help='Количество товаров в каждом прайсе')
+        parser.add_argument('--parameters', type=int, default=4, help='Количество характеристик у товара')
+        parser.add_argument('--products', type=int, help='Количество разных продуктов на все магазины')
+        parser.add_argument('--prefix', default='Магазин', help='Префикс названия магазина')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--change-ratio', type=float, default=0.0,
+                            help='Доля товаров с измененной ценой и остатком')
+        parser.add_argument('--format', choices=WRITERS, default='yaml', help='Формат файлов прайсов')
+
+    def handle(self, *args, **options):
+        output = Path(options['output'])
+        output.mkdir(parents=True, exist_ok=True)
+        for index in range(options['shops']):
+            path = output / f'shop_{index + 1}.{options["format"]}'
+            with open(path, 'wb') as stream:
+                write_pricelist(stream, f'{options["prefix"]} {index + 1}', options['goods'],
+                                parameters=options['parameters'], products=options['products'],
+                                seed=options['seed'] + index, change_ratio=options['change_ratio'],
+                                format=options['format'])
+            self.stdout.write(str(path))
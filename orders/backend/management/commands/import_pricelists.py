@@ -0,0 +1,85 @@
+from concurrent.futures import as_completed
+from pathlib import Path
+from time import perf_counter, sleep
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError
+
+from backend.importer import BATCH_SIZE, PriceListImporter
+from backend.parsers import EXTENSIONS, detect_format, read_pricelist
+from backend.tasks import create_executor
+
+# сколько раз повторять импорт файла, если транзакция магазина откатилась из-за взаимной блокировки
+RETRIES = 3
+
+
+def import_file(path, incremental, batch_size):
+    "Импорт одного файла в процессе пула, каждый магазин в своей транзакции"
+    started = perf_counter()
+    for attempt in range(1, RETRIES + 1):
+        try:
+            with open(path, 'rb') as stream:
+                data = read_pricelist(stream, detect_format(path))
+                stats = PriceListImporter(None, batch_size=batch_size, incremental=incremental).run(data)
+        except OperationalError:
+            if attempt == RETRIES:
+                raise
+            sleep(attempt)
+        else:
+            return {'path': path, 'stats': stats, 'seconds': perf_counter() - started, 'attempts': attempt}
+
+
+class Command(BaseCommand):
+    help = 'Параллельный импорт прайсов (YAML, CSV, JSON Lines, MessagePack) из файлов или каталогов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='Файлы прайсов или каталоги с ними')
+        parser.add_argument('--workers', type=int, default=settings.IMPORT_WORKERS, help='Количество процессов')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Размер пачки товаров')
+        parser.add_argument('--incremental', action='store_true', help='Обновлять только изменившиеся товары')
+
+    def collect_files(self, paths):
+        files = []
+        for path in map(Path, paths):
+            if path.is_dir():
+                files.extend(sorted(file for file in path.iterdir() if file.suffix.lower() in EXTENSIONS))
+            elif path.is_file():
+                files.append(path)
+            else:
+                raise CommandError(f'Файл или каталог {path} не найден')
+        return [str(file) for file in files]
+
+    def handle(self, *args, **options):
+        files = self.collect_files(options['paths'])
+        if not files:
+            raise CommandError('Не найдено ни одного прайса')
+
+        started = perf_counter()
+        total_goods = 0
+        failed = 0
+        with create_executor(options['workers']) as executor:
+            futures = {
+                executor.submit(import_file, path, options['incremental'], options['batch_size']): path
+                for path in files
+            }
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    result = future.result()
+                except Exception as error:
+                    failed += 1
+                    self.stderr.write(f'{path}: ошибка импорта: {error}')
+                    continue
+
+                goods = result['stats']['counts']['goods']
+                total_goods += goods
+                self.stdout.write(f'{path}: {goods} товаров за {result["seconds"]:.2f} с '
+                                  f'({goods / result["seconds"]:.0f} товаров/с, попыток: {result["attempts"]})')
+
+        seconds = perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Файлов: {len(files) - failed} из {len(files)}, товаров: {total_goods}, '
+            f'время: {seconds:.2f} с, {total_goods / seconds:.0f} товаров/с'))
+        if failed:
+            raise CommandError(f'Не удалось импортировать файлов: {failed}')
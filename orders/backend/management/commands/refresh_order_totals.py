@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from backend.models import Order
+from backend.totals import refresh_order_totals
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает итоги заказов по позициям, например после обновления или ручной правки базы'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--order', type=int, action='append', dest='orders', help='id заказа')
+
+    def handle(self, *args, **options):
+        orders = Order.objects.all()
+        if options['orders']:
+            orders = orders.filter(id__in=options['orders'])
+
+        order_ids = list(orders.values_list('id', flat=True))
+        with transaction.atomic():
+            refresh_order_totals(order_ids)
+        self.stdout.write(f'Пересчитано заказов: {len(order_ids)}')
@@ -0,0 +1,47 @@
+from concurrent.futures import as_completed
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from backend.models import ImportJob
+from backend.tasks import create_executor, do_import
+
+# задачи в этих статусах не завершены: пул, в котором они стояли или выполнялись, остановлен вместе с сервером
+UNFINISHED_STATES = ('queued', 'running')
+
+
+class Command(BaseCommand):
+    help = 'Перезапускает задачи импорта, прерванные остановкой сервера. Запускается при старте, ' \
+           'пока сервер еще не принимает запросы: иначе задачи, которые выполняются прямо сейчас, запустятся дважды'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.IMPORT_WORKERS, help='Количество процессов')
+        parser.add_argument('--fail', action='store_true',
+                            help='Отметить задачи ошибкой вместо повторного запуска')
+
+    def handle(self, *args, **options):
+        jobs = ImportJob.objects.filter(state__in=UNFINISHED_STATES)
+        if options['fail']:
+            count = jobs.update(state='failed', error='Задача прервана остановкой сервера',
+                                finished_at=timezone.now())
+            self.stdout.write(f'Отмечено ошибкой задач: {count}')
+            return
+
+        # импорт идет в транзакции, прерванный импорт откатился целиком, и задачу можно выполнить заново
+        job_ids = list(jobs.order_by('created_at').values_list('id', flat=True))
+        ImportJob.objects.filter(id__in=job_ids).update(state='queued', started_at=None, goods_processed=0,
+                                                        bytes_processed=0)
+        if not job_ids:
+            self.stdout.write('Прерванных задач нет')
+            return
+
+        with create_executor(options['workers']) as executor:
+            for future in as_completed([executor.submit(do_import, job_id) for job_id in job_ids]):
+                future.result()
+
+        for job in ImportJob.objects.filter(id__in=job_ids).order_by('created_at'):
+            if job.state == 'done':
+                self.stdout.write(f'Задача {job.id}: импортировано товаров {job.goods_processed}')
+            else:
+                self.stderr.write(f'Задача {job.id}: ошибка импорта: {job.error}')
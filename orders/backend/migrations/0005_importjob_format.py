@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0004_unique_product_parameter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='format',
+            field=models.CharField(choices=[('yaml', 'YAML'), ('csv', 'CSV'), ('jsonl', 'JSON Lines'), ('msgpack', 'MessagePack')], default='yaml', max_length=10, verbose_name='Формат прайса'),
+        ),
+    ]
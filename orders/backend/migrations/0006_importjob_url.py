@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0005_importjob_format'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='url',
+            field=models.URLField(blank=True, verbose_name='Ссылка на прайс'),
+        ),
+        migrations.AlterField(
+            model_name='importjob',
+            name='source',
+            field=models.FileField(blank=True, upload_to='imports/', verbose_name='Файл прайса'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:00
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations, models
+
+# поисковый вектор и словарь для уже перестроенного каталога, как в backend.catalog.update_search_index
+FILL_SEARCH_INDEX = """
+UPDATE backend_catalogentry SET search_vector =
+    setweight(to_tsvector('russian'::regconfig, COALESCE(product_name, '')), 'A') ||
+    setweight(to_tsvector('russian'::regconfig, COALESCE(model, '')), 'B') ||
+    setweight(jsonb_to_tsvector('russian'::regconfig, parameters, '["string", "numeric"]'), 'C');
+
+INSERT INTO backend_searchword (word)
+SELECT DISTINCT left(lower(match[1]), 80) FROM (
+    SELECT product_name AS text FROM backend_catalogentry
+    UNION SELECT value FROM backend_catalogentry, jsonb_each_text(parameters)
+) texts, regexp_matches(texts.text, '([[:alpha:]]{3,})', 'g') match
+ON CONFLICT DO NOTHING;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0009_catalogentry'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.CreateModel(
+            name='SearchWord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('word', models.CharField(max_length=80, unique=True, verbose_name='Слово')),
+            ],
+            options={
+                'verbose_name': 'Слово каталога',
+                'verbose_name_plural': 'Словарь поиска',
+            },
+        ),
+        migrations.AddField(
+            model_name='catalogentry',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True, verbose_name='Поисковый вектор'),
+        ),
+        migrations.RunSQL(FILL_SEARCH_INDEX, migrations.RunSQL.noop),
+        migrations.AddIndex(
+            model_name='catalogentry',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='catalog_search_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='searchword',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['word'], name='search_word_trgm_idx', opclasses=['gin_trgm_ops']),
+        ),
+    ]
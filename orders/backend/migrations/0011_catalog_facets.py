@@ -0,0 +1,62 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:14
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# характеристики и фасеты уже перестроенного каталога, числа разбираются как в backend.catalog.parse_number
+FILL_CATALOG_FACETS = r"""
+INSERT INTO backend_catalogparameter (entry_id, shop_id, shop_state, category_id, name, value, number)
+SELECT product_info_id, shop_id, shop_state, category_id, key, value,
+    CASE WHEN value ~ '^\s*[-+]?(\d+([.,]\d*)?|[.,]\d+)\s*$' THEN replace(trim(value), ',', '.')::float END
+FROM backend_catalogentry, jsonb_each_text(parameters);
+
+INSERT INTO backend_catalogfacet (category_id, name, value, number, count)
+SELECT category_id, name, value, min(number), count(*)
+FROM backend_catalogparameter WHERE shop_state
+GROUP BY category_id, name, value;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0010_catalog_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogFacet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=40, verbose_name='Название')),
+                ('value', models.CharField(max_length=100, verbose_name='Значение')),
+                ('number', models.FloatField(null=True, verbose_name='Числовое значение')),
+                ('count', models.PositiveIntegerField(verbose_name='Количество предложений')),
+                ('category', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='catalog_facets', to='backend.category', verbose_name='Категория')),
+            ],
+            options={
+                'verbose_name': 'Фасет каталога',
+                'verbose_name_plural': 'Фасеты каталога',
+                'indexes': [models.Index(fields=['category', 'name', 'value'], name='catalog_facet_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='CatalogParameter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shop_state', models.BooleanField(default=True, verbose_name='Магазин принимает заказы')),
+                ('name', models.CharField(max_length=40, verbose_name='Название')),
+                ('value', models.CharField(max_length=100, verbose_name='Значение')),
+                ('number', models.FloatField(null=True, verbose_name='Числовое значение')),
+                ('category', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='catalog_parameters', to='backend.category', verbose_name='Категория')),
+                ('entry', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='catalog_parameters', to='backend.catalogentry', verbose_name='Строка каталога')),
+                ('shop', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='catalog_parameters', to='backend.shop', verbose_name='Магазин')),
+            ],
+            options={
+                'verbose_name': 'Характеристика в каталоге',
+                'verbose_name_plural': 'Характеристики в каталоге',
+                'indexes': [models.Index(fields=['name', 'value', 'entry'], name='catalog_parameter_value_idx'), models.Index(fields=['name', 'number', 'entry'], name='catalog_parameter_number_idx'), models.Index(fields=['entry', 'name', 'value', 'number'], name='catalog_parameter_entry_idx'), models.Index(condition=models.Q(('shop_state', True)), fields=['shop', 'category', 'name', 'value', 'number'], name='catalog_parameter_shop_idx'), models.Index(condition=models.Q(('shop_state', True)), fields=['category', 'name', 'value', 'number'], name='catalog_parameter_category_idx')],
+            },
+        ),
+        migrations.RunSQL(FILL_CATALOG_FACETS, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0011_catalog_facets'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='catalogentry',
+            index=models.Index(condition=models.Q(('shop_state', True)), fields=['price', 'product_info'], name='catalog_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='catalogentry',
+            index=models.Index(condition=models.Q(('shop_state', True)), fields=['price_rrc', 'product_info'], name='catalog_price_rrc_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='catalogentry',
+            index=models.Index(condition=models.Q(('shop_state', True)), fields=['category', 'price', 'product_info'], name='catalog_category_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='catalogentry',
+            index=models.Index(condition=models.Q(('shop_state', True)), fields=['category', 'price_rrc', 'product_info'], name='catalog_category_price_rrc_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='catalogentry',
+            index=models.Index(condition=models.Q(('shop_state', True)), fields=['shop', 'category', 'price', 'product_info'], name='catalog_shop_price_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0012_catalog_price_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, verbose_name='Изменен'),
+        ),
+        migrations.AddField(
+            model_name='shop',
+            name='catalog_modified',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Каталог изменен'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:22
+
+from django.db import migrations, models
+
+# характеристики строк каталога парами [название, значение] в порядке ProductParameter, как в
+# backend.catalog.refresh_catalog; новое время изменения строки сбрасывает ее фрагмент JSON в кэше
+FILL_PARAMETER_PAIRS = """
+UPDATE backend_catalogentry SET updated_at = now(), parameters = COALESCE((
+    SELECT jsonb_agg(jsonb_build_array(parameter.name, product_parameter.value) ORDER BY product_parameter.id)
+    FROM backend_productparameter product_parameter
+    JOIN backend_parameter parameter ON parameter.id = product_parameter.parameter_id
+    WHERE product_parameter.product_info_id = backend_catalogentry.product_info_id
+), '[]'::jsonb);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0016_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='catalogentry',
+            name='parameters',
+            field=models.JSONField(default=list, verbose_name='Параметры'),
+        ),
+        migrations.RunSQL(FILL_PARAMETER_PAIRS, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,32 @@
+from django.db import migrations
+
+# итоги заказов, созданных до 0015, по позициям и текущим ценам, как в backend.totals.order_totals;
+# заказы с уже посчитанными итогами не меняются, заказы без позиций остаются с total_sum NULL
+FILL_ORDER_TOTALS = """
+UPDATE backend_order SET total_sum = totals.total_sum, item_count = totals.item_count,
+    shop_totals = totals.shop_totals
+FROM (
+    SELECT order_id, sum(total) AS total_sum, sum(count) AS item_count,
+        jsonb_object_agg(shop_id::text, total) AS shop_totals
+    FROM (
+        SELECT item.order_id, product_info.shop_id, sum(item.quantity::bigint * product_info.price) AS total,
+            sum(item.quantity) AS count
+        FROM backend_orderitem item
+        JOIN backend_productinfo product_info ON product_info.id = item.product_info_id
+        GROUP BY item.order_id, product_info.shop_id
+    ) shop_totals
+    GROUP BY order_id
+) totals
+WHERE backend_order.id = totals.order_id AND backend_order.total_sum IS NULL;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0017_catalog_parameter_pairs'),
+    ]
+
+    operations = [
+        migrations.RunSQL(FILL_ORDER_TOTALS, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0018_fill_order_totals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='bytes_processed',
+            field=models.PositiveBigIntegerField(default=0, verbose_name='Прочитано байт'),
+        ),
+        migrations.AddField(
+            model_name='importjob',
+            name='bytes_total',
+            field=models.PositiveBigIntegerField(blank=True, null=True, verbose_name='Размер прайса'),
+        ),
+    ]
@@ -1,3 +1,6 @@
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
+from django.core.exceptions import ValidationError
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 from django.utils.translation import gettext_lazy as _
@@ -21,6 +24,20 @@ USER_TYPE_CHOICES = (
 
 )
 
+PRICELIST_FORMAT_CHOICES = (
+    ('yaml', 'YAML'),
+    ('csv', 'CSV'),
+    ('jsonl', 'JSON Lines'),
+    ('msgpack', 'MessagePack'),
+)
+
+IMPORT_JOB_STATE_CHOICES = (
+    ('queued', 'В очереди'),
+    ('running', 'Выполняется'),
+    ('done', 'Завершен'),
+    ('failed', 'Ошибка'),
+)
+
 
 class UserManager(BaseUserManager):
     """
@@ -104,6 +121,10 @@ class Shop(models.Model):
                                 blank=True, null=True,
                                 on_delete=models.CASCADE)
     state = models.BooleanField(verbose_name='статус получения заказа', default=True)
+    # меняется при импорте и смене статуса, входит в ключ кэша ответов каталога
+    catalog_version = models.PositiveIntegerField(verbose_name='Версия каталога', default=0)
+    # время последнего изменения версии, Last-Modified ответов каталога
+    catalog_modified = models.DateTimeField(verbose_name='Каталог изменен', null=True, blank=True)
 
     class Meta:
         verbose_name = 'Магазин'
@@ -136,6 +157,9 @@ class Product(models.Model):
         verbose_name = 'Продукт'
         verbose_name_plural = 'Список продуктов'
         ordering = ('-name',)
+        constraints = [
+            models.UniqueConstraint(fields=['name', 'category'], name='unique_product'),
+        ]
 
     def __str__(self):
         return self.name
@@ -159,6 +183,10 @@ class ProductInfo(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['product', 'shop', 'external_id'], name='unique_product_info'),
         ]
+        indexes = [
+            # выборка предложений магазина постранично по курсору
+            models.Index(fields=['shop', 'id'], name='product_info_shop_id_idx'),
+        ]
 
 
 class Parameter(models.Model):
@@ -168,6 +196,9 @@ class Parameter(models.Model):
         verbose_name = 'Продукт'
         verbose_name_plural = 'Список продуктов'
         ordering = ('-name',)
+        constraints = [
+            models.UniqueConstraint(fields=['name'], name='unique_parameter'),
+        ]
 
     def __str__(self):
         return self.name
@@ -189,6 +220,140 @@ class ProductParameter(models.Model):
         ]
 
 
+class CatalogEntry(models.Model):
+    """
+    Денормализованная строка каталога: одно предложение магазина со всеми данными для выдачи.
+    Перестраивается при импорте прайса, каталог читается из нее одним запросом без соединений.
+    """
+    product_info = models.OneToOneField(ProductInfo, verbose_name='Информация о продукте', primary_key=True,
+                                        related_name='catalog_entry', on_delete=models.CASCADE)
+    shop = models.ForeignKey(Shop, verbose_name='Магазин', related_name='catalog_entries', db_index=False,
+                             on_delete=models.CASCADE)
+    shop_name = models.CharField(max_length=50, verbose_name='Название магазина')
+    shop_state = models.BooleanField(verbose_name='Магазин принимает заказы', default=True)
+    product = models.ForeignKey(Product, verbose_name='Продукт', related_name='catalog_entries',
+                                on_delete=models.CASCADE)
+    product_name = models.CharField(max_length=80, verbose_name='Название продукта')
+    category = models.ForeignKey(Category, verbose_name='Категория', related_name='catalog_entries', db_index=False,
+                                 on_delete=models.CASCADE)
+    category_name = models.CharField(max_length=80, verbose_name='Название категории')
+    model = models.CharField(max_length=80, verbose_name='Модель', blank=True)
+    external_id = models.PositiveIntegerField(verbose_name='Внешний ИД')
+    quantity = models.PositiveIntegerField(verbose_name='Количество')
+    price = models.PositiveIntegerField(verbose_name='Цена')
+    price_rrc = models.PositiveIntegerField(verbose_name='Рекомендуемая розничная цена')
+    # пары [название, значение] в порядке характеристик предложения
+    parameters = models.JSONField(verbose_name='Параметры', default=list)
+    # название, модель и значения характеристик для полнотекстового поиска, заполняется в refresh_catalog
+    search_vector = SearchVectorField(verbose_name='Поисковый вектор', null=True, editable=False)
+    # время перестроения строки, входит в ключ кэша готовых фрагментов JSON
+    updated_at = models.DateTimeField(verbose_name='Изменена', auto_now=True)
+
+    class Meta:
+        verbose_name = 'Строка каталога'
+        verbose_name_plural = 'Каталог для выдачи'
+        indexes = [
+            # фильтры shop_id / category_id вместе с постраничной выборкой по курсору
+            models.Index(fields=['shop', 'product_info'], name='catalog_shop_idx'),
+            models.Index(fields=['category', 'product_info'], name='catalog_category_idx'),
+            # фильтры price_min / price_max и сортировка по цене; каталог всегда читается с shop_state=True
+            models.Index(fields=['price', 'product_info'], condition=models.Q(shop_state=True),
+                         name='catalog_price_idx'),
+            models.Index(fields=['price_rrc', 'product_info'], condition=models.Q(shop_state=True),
+                         name='catalog_price_rrc_idx'),
+            models.Index(fields=['category', 'price', 'product_info'], condition=models.Q(shop_state=True),
+                         name='catalog_category_price_idx'),
+            models.Index(fields=['category', 'price_rrc', 'product_info'], condition=models.Q(shop_state=True),
+                         name='catalog_category_price_rrc_idx'),
+            models.Index(fields=['shop', 'category', 'price', 'product_info'], condition=models.Q(shop_state=True),
+                         name='catalog_shop_price_idx'),
+            # полнотекстовый поиск
+            GinIndex(fields=['search_vector'], name='catalog_search_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.shop_name} {self.product_name}'
+
+
+class CatalogParameter(models.Model):
+    """
+    Характеристика строки каталога отдельной строкой для фильтров и фасетов.
+    Числовое значение дублируется в number, чтобы фильтр по диапазону выполнялся по индексу,
+    магазин и категория - чтобы фасеты магазина и категории считались только по индексу.
+    """
+    entry = models.ForeignKey(CatalogEntry, verbose_name='Строка каталога', related_name='catalog_parameters',
+                              db_index=False, on_delete=models.CASCADE)
+    shop = models.ForeignKey(Shop, verbose_name='Магазин', related_name='catalog_parameters', db_index=False,
+                             on_delete=models.CASCADE)
+    shop_state = models.BooleanField(verbose_name='Магазин принимает заказы', default=True)
+    category = models.ForeignKey(Category, verbose_name='Категория', related_name='catalog_parameters',
+                                 db_index=False, on_delete=models.CASCADE)
+    name = models.CharField(max_length=40, verbose_name='Название')
+    value = models.CharField(max_length=100, verbose_name='Значение')
+    number = models.FloatField(verbose_name='Числовое значение', null=True)
+
+    class Meta:
+        verbose_name = 'Характеристика в каталоге'
+        verbose_name_plural = 'Характеристики в каталоге'
+        indexes = [
+            # фильтры по значению и по диапазону: строки каталога берутся прямо из индекса
+            models.Index(fields=['name', 'value', 'entry'], name='catalog_parameter_value_idx'),
+            models.Index(fields=['name', 'number', 'entry'], name='catalog_parameter_number_idx'),
+            # фасеты по отобранным строкам каталога и каскадное удаление
+            models.Index(fields=['entry', 'name', 'value', 'number'], name='catalog_parameter_entry_idx'),
+            # фасеты магазина и пересчет CatalogFacet по категориям
+            models.Index(fields=['shop', 'category', 'name', 'value', 'number'], condition=models.Q(shop_state=True),
+                         name='catalog_parameter_shop_idx'),
+            models.Index(fields=['category', 'name', 'value', 'number'], condition=models.Q(shop_state=True),
+                         name='catalog_parameter_category_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.name}: {self.value}'
+
+
+class CatalogFacet(models.Model):
+    """
+    Количество предложений работающих магазинов в категории по значению характеристики.
+    Фасеты без фильтров и по категории читаются отсюда, а не считаются по характеристикам всего каталога.
+    """
+    category = models.ForeignKey(Category, verbose_name='Категория', related_name='catalog_facets', db_index=False,
+                                 on_delete=models.CASCADE)
+    name = models.CharField(max_length=40, verbose_name='Название')
+    value = models.CharField(max_length=100, verbose_name='Значение')
+    number = models.FloatField(verbose_name='Числовое значение', null=True)
+    count = models.PositiveIntegerField(verbose_name='Количество предложений')
+
+    class Meta:
+        verbose_name = 'Фасет каталога'
+        verbose_name_plural = 'Фасеты каталога'
+        indexes = [
+            models.Index(fields=['category', 'name', 'value'], name='catalog_facet_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.name}: {self.value} ({self.count})'
+
+
+class SearchWord(models.Model):
+    """
+    Слово из названий и характеристик каталога для исправления опечаток в поисковых запросах.
+    Слов на порядки меньше, чем строк каталога, поэтому похожее слово по триграммам находится быстро.
+    """
+    word = models.CharField(max_length=80, verbose_name='Слово', unique=True)
+
+    class Meta:
+        verbose_name = 'Слово каталога'
+        verbose_name_plural = 'Словарь поиска'
+        indexes = [
+            # поиск похожих слов, нужно расширение pg_trgm
+            GinIndex(fields=['word'], opclasses=['gin_trgm_ops'], name='search_word_trgm_idx'),
+        ]
+
+    def __str__(self):
+        return self.word
+
+
 class Contact(models.Model):
     user = models.ForeignKey(User, verbose_name='Пользователь',
                              related_name='contacts', blank=True,
@@ -219,6 +384,12 @@ class Order(models.Model):
     contact = models.ForeignKey(Contact, verbose_name='Контакт',
                                 blank=True, null=True,
                                 on_delete=models.CASCADE)
+    # время последнего изменения, Last-Modified списка заказов
+    updated_at = models.DateTimeField(verbose_name='Изменен', auto_now=True)
+    # итоги по позициям, пересчитываются при каждом изменении позиций (backend.totals)
+    total_sum = models.PositiveBigIntegerField(verbose_name='Сумма', null=True, blank=True)
+    item_count = models.PositiveIntegerField(verbose_name='Количество товаров', default=0)
+    shop_totals = models.JSONField(verbose_name='Суммы по магазинам', default=dict, blank=True)
 
     class Meta:
         verbose_name = 'Заказ'
@@ -253,6 +424,74 @@ class OrderItem(models.Model):
         ]
 
 
+class ImportJob(models.Model):
+    user = models.ForeignKey(User, verbose_name='Пользователь',
+                             related_name='import_jobs',
+                             on_delete=models.CASCADE)
+    source = models.FileField(verbose_name='Файл прайса', upload_to='imports/', blank=True)
+    url = models.URLField(verbose_name='Ссылка на прайс', blank=True)
+    format = models.CharField(verbose_name='Формат прайса', choices=PRICELIST_FORMAT_CHOICES, max_length=10,
+                              default='yaml')
+    incremental = models.BooleanField(verbose_name='Инкрементальный импорт', default=False)
+    state = models.CharField(verbose_name='Статус', choices=IMPORT_JOB_STATE_CHOICES, max_length=15, default='queued')
+    goods_processed = models.PositiveIntegerField(verbose_name='Обработано товаров', default=0)
+    goods_total = models.PositiveIntegerField(verbose_name='Всего товаров', null=True, blank=True)
+    bytes_processed = models.PositiveBigIntegerField(verbose_name='Прочитано байт', default=0)
+    bytes_total = models.PositiveBigIntegerField(verbose_name='Размер прайса', null=True, blank=True)
+    stats = models.JSONField(verbose_name='Статистика', null=True, blank=True)
+    error = models.TextField(verbose_name='Ошибка', blank=True)
+    created_at = models.DateTimeField(verbose_name='Создана', auto_now_add=True)
+    started_at = models.DateTimeField(verbose_name='Запущена', null=True, blank=True)
+    finished_at = models.DateTimeField(verbose_name='Завершена', null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Задача импорта'
+        verbose_name_plural = 'Список задач импорта'
+        ordering = ('-created_at',)
+
+    def __str__(self):
+        return f'{self.id} {self.state}'
+
+    def clean(self):
+        # прайс берется либо из файла, либо по ссылке
+        if not self.source and not self.url:
+            raise ValidationError('Укажите файл прайса или ссылку на него')
+        if self.source and self.url:
+            raise ValidationError('Укажите либо файл прайса, либо ссылку на него')
+
+
+class IdempotencyKey(models.Model):
+    """
+    Ответ на изменяющий запрос с заголовком Idempotency-Key (backend.idempotency).
+    Повтор запроса с тем же ключом получает этот ответ и не выполняется заново.
+    """
+    user = models.ForeignKey(User, verbose_name='Пользователь',
+                             related_name='idempotency_keys',
+                             on_delete=models.CASCADE)
+    key = models.CharField(max_length=255, verbose_name='Ключ')
+    fingerprint = models.CharField(max_length=64, verbose_name='Отпечаток запроса')
+    status_code = models.PositiveSmallIntegerField(verbose_name='Код ответа', null=True, blank=True)
+    content_type = models.CharField(max_length=100, verbose_name='Тип ответа', blank=True)
+    content = models.BinaryField(verbose_name='Ответ', default=b'', blank=True)
+    # пока ответа нет, ключ занят запросом до этого времени, затем его может занять повтор запроса
+    locked_until = models.DateTimeField(verbose_name='Занят до', null=True, blank=True)
+    created_at = models.DateTimeField(verbose_name='Создан', auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Ключ идемпотентности'
+        verbose_name_plural = 'Ключи идемпотентности'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='unique_idempotency_key'),
+        ]
+        indexes = [
+            # удаление просроченных ключей
+            models.Index(fields=['created_at'], name='idempotency_key_created_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id} {self.key}'
+
+
 class ConfirmEmailToken(models.Model):
     class Meta:
         verbose_name = 'Токен подтвеждения Email'
@@ -0,0 +1,166 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from backend.catalog import PRICE_ORDERINGS
+
+
+class CatalogPagination(BasePagination):
+    "Размер страницы и формат ответа постраничного вывода каталога: ссылки next / previous и results"
+    page_size = 40
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return min(page_size, self.max_page_size) if page_size > 0 else self.page_size
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+
+def keyset_filter(ordering, position):
+    """
+    Условие на строки после position в порядке ordering, например для ('price', 'pk'):
+    price > p OR (price = p AND pk > id), для убывающей сортировки сравнения обратные.
+    Граница по первому полю повторяется отдельным условием, по ней выбирается диапазон составного индекса.
+    """
+    query = Q()
+    equal = {}
+    for field, value in zip(ordering, position):
+        name, lookup = (field[1:], 'lt') if field.startswith('-') else (field, 'gt')
+        query |= Q(**equal, **{f'{name}__{lookup}': value})
+        equal[name] = value
+    name, lookup = (ordering[0][1:], 'lte') if ordering[0].startswith('-') else (ordering[0], 'gte')
+    return Q(**{f'{name}__{lookup}': position[0]}) & query
+
+
+def reverse_ordering(ordering):
+    return tuple(field[1:] if field.startswith('-') else f'-{field}' for field in ordering)
+
+
+class CatalogCursorPagination(CatalogPagination):
+    """
+    Постраничный вывод каталога по курсору.
+
+    Курсор хранит ключ сортировки крайней строки страницы: pk или, с параметром
+    ordering=price / -price / price_rrc / -price_rrc, пару (цена, pk). Страница выбирается условием
+    keyset_filter по составному индексу, а не OFFSET, поэтому дальние страницы стоят столько же, сколько
+    первая, и не съезжают при импорте прайсов, а предложения с одинаковой ценой проходятся все.
+    В ответе ссылки next / previous с курсором.
+    """
+    ordering = ('pk',)
+    ordering_query_param = 'ordering'
+    cursor_query_param = 'cursor'
+
+    def get_ordering(self, request):
+        # сортировка проверена представлением через price_ordering, неизвестная дает порядок по pk
+        return PRICE_ORDERINGS.get(request.query_params.get(self.ordering_query_param, '').strip(), self.ordering)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.fields = self.get_ordering(request)
+        cursor = self.decode_cursor(request)
+        backwards = cursor is not None and cursor[0]
+
+        # страница назад выбирается в обратном порядке от первой строки текущей и затем переворачивается
+        ordering = reverse_ordering(self.fields) if backwards else self.fields
+        if cursor is not None:
+            queryset = queryset.filter(keyset_filter(ordering, cursor[1]))
+        results = list(queryset.order_by(*ordering)[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if backwards:
+            results.reverse()
+            # назад пришли со следующей страницы, поэтому она есть
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, cursor is not None
+        self.page = results
+        return results
+
+    def position(self, row):
+        return [row[field.lstrip('-')] for field in self.fields]
+
+    def decode_cursor(self, request):
+        "Направление и ключ сортировки из курсора запроса; без курсора - None, неверный курсор - 404"
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            backwards, position = json.loads(urlsafe_b64decode(encoded.encode()))
+        except (ValueError, TypeError):
+            raise NotFound('Неверный курсор')
+        valid = isinstance(backwards, bool) and isinstance(position, list) and len(position) == len(self.fields)
+        if not valid or not all(type(value) is int for value in position):
+            raise NotFound('Неверный курсор')
+        return backwards, position
+
+    def encode_cursor(self, backwards, row):
+        cursor = urlsafe_b64encode(json.dumps([backwards, self.position(row)]).encode()).decode()
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, cursor)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(False, self.page[-1])
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(True, self.page[0])
+
+
+class CatalogSearchPagination(CatalogPagination):
+    """
+    Постраничный вывод результатов поиска по каталогу.
+
+    Результаты упорядочены по релевантности, а она не уникальна и не годится для курсора,
+    поэтому страница выбирается номером. Общее число найденного не считается, чтобы не выполнять
+    второй запрос по всем совпадениям: выбирается на одну строку больше страницы, по ней понятно,
+    есть ли следующая. Ответ в том же формате, что у CatalogCursorPagination.
+    """
+    page_query_param = 'page'
+    # поиск полезен на первых страницах, дальние страницы ранжированной выдачи дороги
+    max_page = 50
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        try:
+            self.page = int(request.query_params.get(self.page_query_param, 1))
+        except ValueError:
+            raise NotFound('Неверный номер страницы')
+        if not 1 <= self.page <= self.max_page:
+            raise NotFound('Неверный номер страницы')
+
+        offset = (self.page - 1) * self.page_size
+        results = list(queryset[offset:offset + self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        return results[:self.page_size]
+
+    def get_next_link(self):
+        if not self.has_next or self.page >= self.max_page:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.page_query_param, self.page + 1)
+
+    def get_previous_link(self):
+        if self.page == 1:
+            return None
+        url = self.request.build_absolute_uri()
+        if self.page == 2:
+            return remove_query_param(url, self.page_query_param)
+        return replace_query_param(url, self.page_query_param, self.page - 1)
@@ -0,0 +1,256 @@
+import codecs
+import csv
+import io
+import json
+import os
+
+import yaml
+from yaml.events import (AliasEvent, DocumentEndEvent, DocumentStartEvent, MappingEndEvent, MappingStartEvent,
+                         ScalarEvent, SequenceEndEvent, SequenceStartEvent, StreamStartEvent)
+from yaml.nodes import ScalarNode
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# C-парсер из libyaml заметно быстрее, но доступен не во всех сборках PyYAML
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# форматы прайсов по MIME-типу и расширению файла
+CONTENT_TYPES = {
+    'application/x-yaml': 'yaml',
+    'application/yaml': 'yaml',
+    'text/yaml': 'yaml',
+    'text/x-yaml': 'yaml',
+    'text/csv': 'csv',
+    'application/csv': 'csv',
+    'application/x-ndjson': 'jsonl',
+    'application/jsonl': 'jsonl',
+    'application/x-jsonlines': 'jsonl',
+    'application/msgpack': 'msgpack',
+    'application/x-msgpack': 'msgpack',
+}
+EXTENSIONS = {
+    '.yaml': 'yaml',
+    '.yml': 'yaml',
+    '.csv': 'csv',
+    '.jsonl': 'jsonl',
+    '.ndjson': 'jsonl',
+    '.msgpack': 'msgpack',
+    '.mpk': 'msgpack',
+}
+
+# обязательные колонки CSV-прайса, остальные колонки считаются характеристиками товара
+CSV_COLUMNS = ('shop', 'category', 'category_name', 'id', 'model', 'name', 'price', 'price_rrc', 'quantity')
+CSV_INTEGER_COLUMNS = ('category', 'id', 'price', 'price_rrc', 'quantity')
+
+
+class PriceListFormatError(ValueError):
+    "Прайс не соответствует ожидаемой структуре shop / categories / goods"
+
+
+class YamlPriceListReader:
+    """
+    Потоковое чтение прайса в формате data/shop1.yaml.
+
+    Документ разбирается по событиям парсера, в памяти держится только текущий товар:
+    shop и categories читаются сразу, goods отдаются генератором по мере чтения потока.
+    Поэтому goods должен идти в документе последним ключом.
+    """
+
+    def __init__(self, stream):
+        self.loader = YamlLoader(stream)
+        # значения узлов с якорями (&anchor) для последующих ссылок (*anchor)
+        self.anchors = {}
+
+    def read(self):
+        "Возвращает {'shop': ..., 'categories': [...], 'goods': <генератор>}"
+        self.expect(StreamStartEvent)
+        self.expect(DocumentStartEvent)
+        self.expect(MappingStartEvent)
+
+        data = {}
+        while not self.loader.check_event(MappingEndEvent):
+            key = self.read_node()
+            if key == 'goods':
+                missing = {'shop', 'categories'} - data.keys()
+                if missing:
+                    raise PriceListFormatError(f'Ключ goods должен идти после {", ".join(sorted(missing))}')
+                data['goods'] = self.read_goods()
+                return data
+            data[key] = self.read_node()
+
+        raise PriceListFormatError('В прайсе нет списка goods')
+
+    def read_goods(self):
+        self.expect(SequenceStartEvent)
+        while not self.loader.check_event(SequenceEndEvent):
+            yield self.read_node()
+        self.expect(SequenceEndEvent)
+        self.expect(MappingEndEvent)
+        self.expect(DocumentEndEvent)
+        self.loader.dispose()
+
+    def expect(self, event_class):
+        event = self.loader.get_event()
+        if not isinstance(event, event_class):
+            raise PriceListFormatError(f'Неожиданный элемент {event} в прайсе')
+        return event
+
+    def read_node(self):
+        "Собирает значение следующего узла (скаляр, список или словарь) из событий парсера"
+        event = self.loader.get_event()
+        if isinstance(event, AliasEvent):
+            if event.anchor not in self.anchors:
+                raise PriceListFormatError(f'Неизвестная ссылка *{event.anchor} в прайсе')
+            return self.anchors[event.anchor]
+
+        if isinstance(event, ScalarEvent):
+            value = self.construct_scalar(event)
+        elif isinstance(event, SequenceStartEvent):
+            value = []
+            while not self.loader.check_event(SequenceEndEvent):
+                value.append(self.read_node())
+            self.loader.get_event()
+        elif isinstance(event, MappingStartEvent):
+            value = {}
+            while not self.loader.check_event(MappingEndEvent):
+                key = self.read_node()
+                value[key] = self.read_node()
+            self.loader.get_event()
+        else:
+            raise PriceListFormatError(f'Неожиданный элемент {event} в прайсе')
+
+        if event.anchor is not None:
+            self.anchors[event.anchor] = value
+        return value
+
+    def construct_scalar(self, event):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = self.loader.resolve(ScalarNode, event.value, event.implicit)
+        node = ScalarNode(tag, event.value, event.start_mark, event.end_mark, event.style)
+        # конструктор вызывается напрямую: construct_object запоминает каждый узел до конца документа
+        constructors = self.loader.yaml_constructors
+        return constructors.get(tag, constructors[None])(self.loader, node)
+
+
+def read_yaml(stream):
+    "Потоково читает YAML-прайс из строки, байтов или файлового объекта"
+    return YamlPriceListReader(stream).read()
+
+
+def as_binary(stream):
+    if isinstance(stream, str):
+        return io.BytesIO(stream.encode())
+    if isinstance(stream, bytes):
+        return io.BytesIO(stream)
+    return stream
+
+
+def check_header(header):
+    if not isinstance(header, dict) or not {'shop', 'categories'} <= header.keys():
+        raise PriceListFormatError('Первая запись прайса должна содержать shop и categories')
+    return header
+
+
+def read_jsonl(stream):
+    """
+    Прайс в формате JSON Lines: первая строка - {"shop": ..., "categories": [...]},
+    каждая следующая строка - один товар в той же структуре, что и в YAML.
+    """
+    lines = iter(as_binary(stream))
+    try:
+        header = check_header(json.loads(next(lines)))
+    except StopIteration:
+        raise PriceListFormatError('Пустой прайс')
+    return {'shop': header['shop'], 'categories': header['categories'],
+            'goods': (json.loads(line) for line in lines if line.strip())}
+
+
+def read_msgpack(stream):
+    """
+    Прайс в формате MessagePack: последовательность объектов, первый - shop и categories,
+    остальные - товары в той же структуре, что и в YAML.
+    """
+    if msgpack is None:
+        raise PriceListFormatError('Для прайсов в формате MessagePack нужен пакет msgpack')
+    unpacker = msgpack.Unpacker(as_binary(stream), raw=False, strict_map_key=False)
+    try:
+        header = check_header(next(unpacker))
+    except StopIteration:
+        raise PriceListFormatError('Пустой прайс')
+    return {'shop': header['shop'], 'categories': header['categories'], 'goods': unpacker}
+
+
+def read_csv(stream):
+    """
+    Прайс в формате CSV: одна строка на товар с колонками CSV_COLUMNS,
+    остальные колонки - характеристики, пустая ячейка означает отсутствие характеристики.
+
+    Категории нужны до записи товаров, поэтому файл читается в два прохода:
+    первый собирает магазин и категории, второй отдает товары. Нужен файл с произвольным доступом.
+    """
+    stream = as_binary(stream)
+    if not stream.seekable():
+        raise PriceListFormatError('CSV-прайс должен передаваться файлом')
+
+    # строки декодируются по одной, а не через TextIOWrapper, который закрыл бы исходный поток вместе с собой
+    reader = csv.reader(codecs.iterdecode(stream, 'utf-8-sig'))
+    header = next(reader, None)
+    missing = set(CSV_COLUMNS) - set(header or ())
+    if missing:
+        raise PriceListFormatError(f'В CSV-прайсе нет колонок: {", ".join(sorted(missing))}')
+    index = {column: header.index(column) for column in CSV_COLUMNS}
+    parameters = [(name, position) for position, name in enumerate(header) if name not in index]
+
+    shop = None
+    categories = {}
+    for row in reader:
+        shop = shop or row[index['shop']]
+        categories.setdefault(int(row[index['category']]), row[index['category_name']])
+    if shop is None:
+        raise PriceListFormatError('В CSV-прайсе нет товаров')
+
+    def goods():
+        stream.seek(0)
+        rows = csv.reader(codecs.iterdecode(stream, 'utf-8-sig'))
+        next(rows)
+        for row in rows:
+            item = {column: row[index[column]] for column in ('model', 'name')}
+            item.update((column, int(row[index[column]])) for column in CSV_INTEGER_COLUMNS)
+            item['parameters'] = {name: row[position] for name, position in parameters if row[position] != ''}
+            yield item
+
+    return {'shop': shop, 'categories': [{'id': category_id, 'name': name}
+                                         for category_id, name in categories.items()],
+            'goods': goods()}
+
+
+READERS = {
+    'yaml': read_yaml,
+    'csv': read_csv,
+    'jsonl': read_jsonl,
+    'msgpack': read_msgpack,
+}
+
+
+def detect_format(name=None, content_type=None):
+    "Определяет формат прайса по MIME-типу, а если он не подходит - по расширению файла"
+    if content_type:
+        content_type = content_type.split(';')[0].strip().lower()
+        if content_type in CONTENT_TYPES:
+            return CONTENT_TYPES[content_type]
+    if name:
+        extension = os.path.splitext(name.split('?')[0])[1].lower()
+        if extension in EXTENSIONS:
+            return EXTENSIONS[extension]
+    return 'yaml'
+
+
+def read_pricelist(stream, format='yaml'):
+    "Потоково читает прайс в указанном формате"
+    if format not in READERS:
+        raise PriceListFormatError(f'Неизвестный формат прайса {format}')
+    return READERS[format](stream)
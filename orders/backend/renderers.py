@@ -0,0 +1,69 @@
+import json
+
+from rest_framework.renderers import BrowsableAPIRenderer, JSONRenderer
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JSONFragment(bytes):
+    """
+    Готовый JSON одного значения, например строки каталога из кэша фрагментов.
+    FastJSONRenderer вставляет его в ответ как есть, без разбора и повторной сериализации.
+    """
+
+
+class FragmentJSONEncoder(JSONEncoder):
+    "JSONEncoder из DRF, который разбирает JSONFragment: для отступов, браузерного API и работы без orjson"
+
+    def default(self, obj):
+        if isinstance(obj, JSONFragment):
+            return json.loads(obj)
+        return super().default(obj)
+
+
+def render_fragment(data):
+    "JSONFragment со значением data в том же виде, в каком его записывает FastJSONRenderer"
+    return JSONFragment(FastJSONRenderer().render(data))
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer на orjson для больших списков: каталога и заказов.
+
+    Вывод побайтно совпадает с JSONRenderer: компактный JSON в UTF-8, а типы, которых нет в JSON, -
+    даты, Decimal, ленивые строки - передаются тому же JSONEncoder из DRF. Отличается только запись
+    float в экспоненциальной форме (1e16 вместо 1e+16), поэтому рендерер подключается к спискам без float.
+    Без orjson, с отступами по запросу (indent) и для данных, которые orjson не принимает,
+    работает обычный JSONRenderer. Значения JSONFragment вставляются как есть через orjson.Fragment,
+    а в старых версиях orjson без него разбираются JSONRenderer.
+    """
+    encoder_class = FragmentJSONEncoder
+    # datetime через JSONEncoder DRF, как в JSONRenderer: orjson форматирует часовой пояс UTC иначе
+    options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME if orjson is not None else 0
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if (orjson is None or data is None or not api_settings.COMPACT_JSON or not api_settings.UNICODE_JSON
+                or self.get_indent(accepted_media_type, renderer_context or {})):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(data, default=self.default, option=self.options)
+        except TypeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        # как в JSONRenderer: разделители строк U+2028 и U+2029 экранируются для встраивания в JavaScript
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+
+    def default(self, obj):
+        if isinstance(obj, JSONFragment):
+            if not hasattr(orjson, 'Fragment'):
+                raise TypeError('orjson без поддержки Fragment')
+            return orjson.Fragment(bytes(obj))
+        return self.encoder_class().default(obj)
+
+
+# рендереры представлений со списками: JSON на orjson и, как по умолчанию в DRF, браузерный API
+FAST_RENDERER_CLASSES = (FastJSONRenderer, BrowsableAPIRenderer)
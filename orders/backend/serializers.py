@@ -1,5 +1,11 @@
+from operator import itemgetter
+
 from rest_framework import serializers
-from backend.models import User, Shop, Category, Product, ProductInfo, Parameter, ProductParameter, Contact, Order, OrderItem
+from backend.caching import cached_fragments
+from backend.fieldsets import parse_fields
+from backend.models import User, Shop, Category, Product, ProductInfo, Parameter, ProductParameter, Contact, Order, OrderItem, \
+    ImportJob, CatalogEntry
+from backend.renderers import render_fragment
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -20,7 +26,7 @@ class CategorySerializer(serializers.ModelSerializer):
 class ProductSerializer(serializers.ModelSerializer):
     class Meta:
         model = Product
-        fields = ('id', 'name', 'category', 'slug', 'image')
+        fields = ('id', 'name', 'category')
 
 class ParameterSerializer(serializers.ModelSerializer):
     class Meta:
@@ -43,12 +49,104 @@ class ProductInfoSerializer(serializers.ModelSerializer):
         read_only_fields = ('id',)
 
 
+# поля ответа каталога в порядке ProductInfoSerializer: столбцы CatalogEntry для values(), из которых
+# собирается поле, и сборка поля из строки. Список каталога отдается без создания моделей
+CATALOG_ENTRY_FIELDS = {
+    'id': (('pk',), itemgetter('pk')),
+    'model': (('model',), itemgetter('model')),
+    'product': (('product_id', 'product_name', 'category_id'), lambda entry: {
+        'id': entry['product_id'], 'name': entry['product_name'], 'category': entry['category_id']}),
+    'shop': (('shop_id',), itemgetter('shop_id')),
+    'quantity': (('quantity',), itemgetter('quantity')),
+    'price': (('price',), itemgetter('price')),
+    'price_rrc': (('price_rrc',), itemgetter('price_rrc')),
+    'product_parameters': (('parameters',), lambda entry: [
+        {'parameter': name, 'value': value} for name, value in entry['parameters']]),
+}
+
+# pk нужен CatalogCursorPagination для курсора, price и price_rrc - для курсора при сортировке по цене
+CATALOG_CURSOR_VALUES = ('pk', 'price', 'price_rrc')
+
+
+def catalog_entry_values(fields=tuple(CATALOG_ENTRY_FIELDS), fragments=False):
+    """
+    Столбцы CatalogEntry для values(): нужные полям ответа fields и курсору страниц.
+    Для списка из кэша фрагментов - только курсор и время изменения строки, см. CatalogEntryListSerializer
+    """
+    if fragments:
+        return CATALOG_CURSOR_VALUES + ('updated_at',)
+    columns = [column for field in fields for column in CATALOG_ENTRY_FIELDS[field][0]]
+    return tuple(dict.fromkeys(CATALOG_CURSOR_VALUES + tuple(columns)))
+
+
+CATALOG_ENTRY_VALUES = catalog_entry_values()
+
+
+def catalog_fields(params):
+    "Поля ответа каталога из ?fields=id,price,quantity, без параметра - все; неизвестное поле - ValueError"
+    return parse_fields(params, tuple(CATALOG_ENTRY_FIELDS))
+
+
+def catalog_entry_fragments(entries):
+    """
+    Готовый JSON строк каталога entries - словарей с pk и updated_at - из кэша фрагментов.
+    Ключ фрагмента - предложение и время изменения строки: перестроенная при импорте строка получает новый ключ.
+    Строки, которых нет в кэше, выбираются одним запросом и сериализуются один раз.
+    """
+    def build(pks):
+        serializer = CatalogEntrySerializer()
+        return {entry['pk']: render_fragment(serializer.to_representation(entry))
+                for entry in CatalogEntry.objects.filter(pk__in=pks).values(*CATALOG_ENTRY_VALUES)}
+
+    return cached_fragments(
+        {entry['pk']: f'catalog-entry:{entry["pk"]}:{entry["updated_at"].timestamp()}' for entry in entries}, build)
+
+
+class CatalogEntryListSerializer(serializers.ListSerializer):
+    """
+    Список строк каталога. С context['fragments'] строки страницы содержат только курсор и время изменения,
+    а ответ собирается из готовых фрагментов JSON: цена сериализации списка почти не зависит от вложенности строки
+    """
+
+    def to_representation(self, data):
+        if self.context.get('fragments'):
+            return catalog_entry_fragments(data)
+        return super().to_representation(data)
+
+
+# строка денормализованного каталога из values(*catalog_entry_values(fields)) в том же виде,
+# что и ProductInfoSerializer; в ответе только поля из context['fields'], по умолчанию все
+class CatalogEntrySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = CatalogEntry
+        fields = ('product_info', 'model', 'product', 'shop', 'quantity', 'price', 'price_rrc', 'parameters',)
+        read_only_fields = fields
+        list_serializer_class = CatalogEntryListSerializer
+
+    def to_representation(self, entry):
+        fields = self.context.get('fields', CATALOG_ENTRY_FIELDS)
+        return {field: CATALOG_ENTRY_FIELDS[field][1](entry) for field in fields}
+
+
 class ContactSerializer(serializers.ModelSerializer):
     class Meta:
         model = Contact
         fields = ('id', 'city', 'street', 'house', 'structure', 'building', 'apartment', 'phone')
 
 
+class BasketItemSerializer(serializers.Serializer):
+    "Позиция для добавления в корзину; проверяется без запросов, предложения выбираются сразу для всех позиций"
+    product_info = serializers.IntegerField(min_value=1)
+    quantity = serializers.IntegerField(min_value=1)
+
+
+class BasketQuantitySerializer(serializers.Serializer):
+    "Новое количество позиции корзины, найденной по id позиции или по product_info; 0 - удалить позицию"
+    id = serializers.IntegerField(min_value=1, required=False)
+    product_info = serializers.IntegerField(min_value=1, required=False)
+    quantity = serializers.IntegerField(min_value=0)
+
+
 class OrderItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = OrderItem
@@ -61,8 +159,69 @@ class OrderItemSerializer(serializers.ModelSerializer):
 
 class OrderSerializer(serializers.ModelSerializer):
     ordered_items = OrderItemSerializer(read_only=True, many=True)
+    state = serializers.CharField(source='status', read_only=True)
 
     class Meta:
         model = Order
-        fields = ('id', 'ordered_items', 'state', 'dt', )
-        read_only_fields = ('id',)
+        fields = ('id', 'ordered_items', 'state', 'dt', 'total_sum', 'item_count', 'shop_totals',)
+        read_only_fields = ('id', 'total_sum', 'item_count', 'shop_totals',)
+
+
+# поля списка заказов в порядке OrderSerializer и вложенные объекты, которые раскрываются по ?expand=
+ORDER_FIELDS = ('id', 'ordered_items', 'state', 'dt', 'total_sum', 'item_count', 'shop_totals')
+ORDER_EXPAND = ('product_info',)
+
+
+def order_fieldsets(params):
+    """
+    Поля ответа из ?fields= и раскрываемые объекты из ?expand= для списка заказов; неверное значение - ValueError.
+    По умолчанию все поля, а предложение в позиции заказа - только идентификатор, как в OrderSerializer.
+    """
+    return parse_fields(params, ORDER_FIELDS), parse_fields(params, ORDER_EXPAND, 'expand', default=())
+
+
+def order_list_data(orders, fields=ORDER_FIELDS, expand=()):
+    """
+    Заказы orders в том же виде, что OrderSerializer(orders, many=True).data, без моделей и сериализаторов полей.
+    Заказы и их позиции выбираются через values_list() двумя запросами и собираются в словари за один проход,
+    поэтому prefetch_related для orders не нужен.
+
+    В ответе только поля fields: без ordered_items позиции не выбираются. С expand=('product_info',)
+    предложение в позиции раскрывается, как строка каталога, одним запросом к денормализованному каталогу.
+    Итоги total_sum, item_count и shop_totals читаются из строки заказа, их поддерживает backend.totals.
+    """
+    dt = serializers.DateTimeField()
+    rows = list(orders.prefetch_related(None).values_list(
+        'id', 'status', 'dt', 'total_sum', 'item_count', 'shop_totals'))
+
+    items = {}
+    if 'ordered_items' in fields:
+        for order_id, item_id, product_info_id, quantity in OrderItem.objects.filter(
+                order_id__in={row[0] for row in rows}).order_by('id').values_list(
+                'order_id', 'id', 'product_info_id', 'quantity'):
+            items.setdefault(order_id, []).append(
+                {'id': item_id, 'product_info': product_info_id, 'quantity': quantity})
+
+    if items and 'product_info' in expand:
+        entries = CatalogEntry.objects.filter(
+            pk__in={item['product_info'] for order_items in items.values() for item in order_items})
+        serializer = CatalogEntrySerializer()
+        products = {entry['pk']: serializer.to_representation(entry) for entry in entries.values(*CATALOG_ENTRY_VALUES)}
+        for order_items in items.values():
+            for item in order_items:
+                item['product_info'] = products.get(item['product_info'], item['product_info'])
+
+    data = [{'id': order_id, 'ordered_items': items.get(order_id, []), 'state': state,
+             'dt': dt.to_representation(created), 'total_sum': total_sum, 'item_count': item_count,
+             'shop_totals': shop_totals} for order_id, state, created, total_sum, item_count, shop_totals in rows]
+    if fields != ORDER_FIELDS:
+        data = [{field: order[field] for field in fields} for order in data]
+    return data
+
+
+class ImportJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ImportJob
+        fields = ('id', 'state', 'url', 'format', 'incremental', 'goods_processed', 'goods_total', 'stats', 'error',
+                  'bytes_processed', 'bytes_total', 'created_at', 'started_at', 'finished_at',)
+        read_only_fields = fields
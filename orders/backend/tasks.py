@@ -0,0 +1,114 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from tempfile import TemporaryFile
+
+import django
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, transaction
+from django.utils import timezone
+
+from backend.importer import PriceListImporter
+from backend.models import ImportJob
+from backend.parsers import read_pricelist
+from backend.transfer import start_download
+
+_executor = None
+
+
+def create_executor(max_workers):
+    """
+    Пул процессов с настроенным Django.
+    Процессы запускаются через spawn, чтобы не наследовать соединения с базой родителя.
+    """
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=get_context('spawn'), initializer=django.setup)
+
+
+def get_executor():
+    "Пул процессов для фоновых задач, создается при первом обращении"
+    global _executor
+    if _executor is None:
+        _executor = create_executor(settings.IMPORT_WORKERS)
+    return _executor
+
+
+def enqueue_import(job):
+    "Отправляет задачу импорта в пул после фиксации транзакции, в которой она создана"
+    transaction.on_commit(lambda: get_executor().submit(do_import, job.id))
+
+
+class ProgressReporter:
+    """
+    Пишет прогресс задачи через отдельное соединение с базой.
+    Импорт идет в одной транзакции, и изменения в ней не видны другим запросам до ее завершения.
+    Число товаров в прайсе заранее неизвестно, поэтому долю выполненной работы показывает
+    позиция чтения прайса из его размера.
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.stream = None
+        self.total = None
+        self.connection = connections.create_connection(DEFAULT_DB_ALIAS)
+        quote_name = self.connection.ops.quote_name
+        self.sql = 'UPDATE {table} SET {goods} = %s, {read} = %s, {total} = %s WHERE id = %s'.format(
+            table=quote_name(ImportJob._meta.db_table), goods=quote_name('goods_processed'),
+            read=quote_name('bytes_processed'), total=quote_name('bytes_total'))
+
+    def track(self, stream, total=None):
+        "Прогресс в байтах считается по позиции чтения stream; total - размер прайса, если он известен"
+        self.stream = stream
+        self.total = total
+        return stream
+
+    def __call__(self, goods_processed):
+        if self.connection.vendor == 'sqlite':
+            # SQLite не допускает второго пишущего соединения во время транзакции импорта
+            return
+        bytes_processed = self.stream.tell() if self.stream is not None else 0
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute(self.sql, [goods_processed, bytes_processed, self.total, self.job_id])
+        except DatabaseError:
+            # прогресс не обязателен, импорт не должен падать из-за него
+            pass
+
+    def close(self):
+        self.connection.close()
+
+
+def do_import(job_id):
+    "Фоновый импорт прайса из файла или по ссылке задачи"
+    job = ImportJob.objects.get(id=job_id)
+    job.state = 'running'
+    job.started_at = timezone.now()
+    job.save(update_fields=['state', 'started_at'])
+
+    progress = ProgressReporter(job.id)
+    try:
+        importer = PriceListImporter(job.user_id, incremental=job.incremental, progress=progress)
+        if job.url:
+            with TemporaryFile() as file, start_download(job.url, file) as download:
+                # импорт идет по мере скачивания: разбор читает файл вслед за загрузкой
+                stream = progress.track(download.open(), download.length)
+                job.stats = importer.run(read_pricelist(stream, job.format))
+                download.wait()
+                size = download.size
+        else:
+            size = job.source.size
+            with job.source.open('rb') as stream:
+                job.stats = importer.run(read_pricelist(progress.track(stream, size), job.format))
+    except Exception as error:
+        job.state = 'failed'
+        job.error = str(error)
+    else:
+        job.state = 'done'
+        # прайс читается один раз, поэтому общее число товаров известно только после импорта
+        job.goods_processed = job.goods_total = job.stats['counts']['goods']
+        job.bytes_processed = job.bytes_total = size
+        if job.source:
+            job.source.delete(save=False)
+    finally:
+        progress.close()
+
+    job.finished_at = timezone.now()
+    job.save()
@@ -1,3 +1,1045 @@
-from django.test import TestCase
+import gzip
+import io
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from datetime import timedelta
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+import yaml
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.models import Count, Sum
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from requests import Session
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory, force_authenticate
+from rest_framework.views import APIView
+
+from backend.basket import MAX_BASKET_ITEMS
+from backend.caching import get_cache
+from backend.catalog import search_catalog
+from backend.generator import write_pricelist
+from backend.idempotency import idempotent
+from backend.importer import Interner, PriceListImporter
+from backend.models import CatalogEntry, CatalogFacet, IdempotencyKey, ImportJob, Order, OrderItem, ProductInfo, \
+    Parameter, Product, ProductParameter, Shop, User
+from backend.parsers import PriceListFormatError, detect_format, read_pricelist, read_yaml
+from backend.renderers import render_fragment
+from backend.serializers import CATALOG_ENTRY_VALUES, CatalogEntrySerializer
+from backend.stock import StockError, checkout
+from backend.tasks import do_import
+from backend.transfer import CHUNK_SIZE, TransferError, read_chunks, receive_upload, start_download
+
+# прайс из комплекта проекта: один магазин, три категории, четыре товара
+PRICELIST = Path(settings.BASE_DIR).parent / 'data' / 'shop1.yaml'
+
+
+class InlineExecutor(Executor):
+    "Пул, выполняющий задачи сразу в текущем процессе: тест видит данные своей транзакции"
+
+    def __init__(self, max_workers=None):
+        pass
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+
+def create_shop_user(email='shop@example.com'):
+    return User.objects.create_user(email, 'password', type='shop', is_active=True)
+
+
+def import_pricelist(user, content=None, incremental=False):
+    "Импорт прайса content, по умолчанию data/shop1.yaml, от имени пользователя магазина"
+    content = PRICELIST.read_bytes() if content is None else content
+    return PriceListImporter(user.id, incremental=incremental).run(read_pricelist(io.BytesIO(content)))
+
+
+def generated_pricelist(goods, shop='Магазин', **kwargs):
+    "Синтетический прайс backend.generator в виде байтов"
+    stream = io.BytesIO()
+    write_pricelist(stream, shop, goods, **kwargs)
+    return stream.getvalue()
+
+
+class YamlReaderTest(SimpleTestCase):
+    def test_same_as_full_load(self):
+        content = PRICELIST.read_bytes()
+        data = read_yaml(io.BytesIO(content))
+        expected = yaml.safe_load(content)
+        self.assertEqual((data['shop'], data['categories']), (expected['shop'], expected['categories']))
+        self.assertEqual(list(data['goods']), expected['goods'])
+
+    def test_goods_are_read_lazily(self):
+        content = generated_pricelist(2000)
+        stream = io.BytesIO(content)
+        goods = read_yaml(stream)['goods']
+        self.assertEqual(next(goods)['id'], 1)
+        # прочитано только начало файла, остальные товары еще в потоке
+        self.assertLess(stream.tell(), len(content) // 10)
+        self.assertEqual(sum(1 for _ in goods), 1999)
+
+    def test_anchors(self):
+        data = read_yaml(
+            'shop: Связной\ncategories:\n  - &phones {id: 224, name: Смартфоны}\n'
+            'goods:\n'
+            '  - {id: 1, category: 224, model: a, name: A, price: 1, price_rrc: 2, quantity: 3,\n'
+            '     parameters: &black {Цвет: черный}}\n'
+            '  - {id: 2, category: 224, model: b, name: B, price: 1, price_rrc: 2, quantity: 3, parameters: *black}\n')
+        self.assertEqual(data['categories'], [{'id': 224, 'name': 'Смартфоны'}])
+        self.assertEqual([item['parameters'] for item in data['goods']], [{'Цвет': 'черный'}] * 2)
+
+        with self.assertRaisesMessage(PriceListFormatError, '*white'):
+            list(read_yaml('shop: x\ncategories: []\ngoods:\n  - *white\n')['goods'])
+
+    def test_goods_must_come_last(self):
+        with self.assertRaisesMessage(PriceListFormatError, 'categories'):
+            read_yaml('shop: x\ngoods: []\ncategories: []\n')
+        with self.assertRaisesMessage(PriceListFormatError, 'goods'):
+            read_yaml('shop: x\ncategories: []\n')
+
+
+class PriceListFormatsTest(SimpleTestCase):
+    def read(self, format, goods=50):
+        return read_pricelist(io.BytesIO(generated_pricelist(goods, format=format)), format)
+
+    def test_formats_match_yaml(self):
+        expected = self.read('yaml')
+        goods = list(expected['goods'])
+        for format in ('jsonl', 'msgpack'):
+            with self.subTest(format=format):
+                data = self.read(format)
+                self.assertEqual((data['shop'], data['categories']), (expected['shop'], expected['categories']))
+                self.assertEqual(list(data['goods']), goods)
+
+    def test_csv(self):
+        expected = self.read('yaml')
+        goods = list(expected['goods'])
+        data = self.read('csv')
+        self.assertEqual(data['shop'], expected['shop'])
+        # в CSV есть только категории, в которых есть товары
+        used = {item['category'] for item in goods}
+        self.assertCountEqual(data['categories'],
+                              [category for category in expected['categories'] if category['id'] in used])
+        # значения характеристик в CSV всегда строки
+        for item in goods:
+            item['parameters'] = {name: str(value) for name, value in item['parameters'].items()}
+        self.assertEqual(list(data['goods']), goods)
+
+    def test_csv_requires_seekable_file(self):
+        class Pipe(io.BytesIO):
+            def seekable(self):
+                return False
+
+        with self.assertRaisesMessage(PriceListFormatError, 'файлом'):
+            read_pricelist(Pipe(generated_pricelist(1, format='csv')), 'csv')
+        with self.assertRaisesMessage(PriceListFormatError, 'category_name'):
+            read_pricelist(io.BytesIO(b'shop,category,id\n'), 'csv')
+
+    def test_empty_and_unknown(self):
+        for format in ('jsonl', 'msgpack'):
+            with self.subTest(format=format), self.assertRaisesMessage(PriceListFormatError, 'Пустой прайс'):
+                read_pricelist(io.BytesIO(b''), format)
+        with self.assertRaisesMessage(PriceListFormatError, 'shop и categories'):
+            read_pricelist(io.BytesIO(b'{"id": 1}\n'), 'jsonl')
+        with self.assertRaisesMessage(PriceListFormatError, 'xml'):
+            read_pricelist(io.BytesIO(b''), 'xml')
+
+    def test_detect_format(self):
+        self.assertEqual(detect_format('shop.csv', 'application/x-msgpack; charset=binary'), 'msgpack')
+        self.assertEqual(detect_format('https://example.com/shop.NDJSON?token=1', 'application/octet-stream'),
+                         'jsonl')
+        self.assertEqual(detect_format('shop.txt'), 'yaml')
+
+
+class PriceListImporterTest(TestCase):
+    def setUp(self):
+        self.user = create_shop_user()
+
+    def test_counts(self):
+        stats = import_pricelist(self.user)
+        counts = stats['counts']
+        self.assertEqual((counts['goods'], counts['categories'], counts['product_infos_created']), (4, 3, 4))
+        self.assertEqual(counts['product_parameters_created'], ProductParameter.objects.count())
+        self.assertEqual(ProductInfo.objects.filter(shop_id=stats['shop']).count(), 4)
+        self.assertTrue({'shop', 'categories', 'catalog', 'total'} <= stats['timings'].keys())
+
+        # полный импорт пересоздает предложения, продукты и параметры уже есть в базе
+        counts = import_pricelist(self.user)['counts']
+        self.assertEqual((counts['product_infos_deleted'], counts['product_infos_created'],
+                          counts['products_created'], counts['parameters_created']), (4, 4, 0, 0))
+        self.assertEqual(ProductInfo.objects.count(), 4)
+
+    def test_interner_counts_unique_keys(self):
+        interner = Interner(Parameter, ('name',))
+        interner.resolve(['Цвет', 'Цвет', 'Вес'])
+        self.assertEqual(interner.stats(), {'size': 2, 'hits': 0, 'misses': 2, 'created': 2})
+        ids = interner.resolve(['Цвет', 'Объем', 'Объем'])
+        self.assertEqual(interner.stats(), {'size': 3, 'hits': 1, 'misses': 3, 'created': 3})
+        self.assertEqual(ids, dict(Parameter.objects.values_list('name', 'id')))
+
+    def test_interner_does_not_count_rows_created_elsewhere(self):
+        interner = Interner(Parameter, ('name',))
+        interner.preload(Parameter.objects.all())
+        # строку успел создать параллельный импорт уже после preload
+        parameter = Parameter.objects.create(name='Цвет')
+        ids = interner.resolve(['Цвет', 'Вес'])
+        self.assertEqual((interner.misses, interner.created), (2, 1))
+        self.assertEqual(ids['Цвет'], parameter.id)
+
+        before = Parameter.objects.count(), Product.objects.count()
+        counts = import_pricelist(self.user)['counts']
+        self.assertEqual((counts['parameters_created'], counts['products_created']),
+                         (Parameter.objects.count() - before[0], Product.objects.count() - before[1]))
+
+    def test_queries_do_not_depend_on_goods(self):
+        def count_queries(user, goods):
+            content = generated_pricelist(goods, shop=user.email, seed=goods)
+            with CaptureQueriesContext(connection) as queries:
+                import_pricelist(user, content)
+            return len(queries)
+
+        # первый импорт создает категории и параметры, дальше справочники общие
+        count_queries(self.user, 10)
+        # справочники и записи пишутся пачками, поэтому число запросов не растет вместе с прайсом
+        self.assertEqual(count_queries(create_shop_user('small@example.com'), 20),
+                         count_queries(create_shop_user('big@example.com'), 200))
+        self.assertEqual(ProductInfo.objects.count(), 230)
+
+    def test_incremental_writes_only_changes(self):
+        shop_id = import_pricelist(self.user)['shop']
+        ids = dict(ProductInfo.objects.values_list('external_id', 'id'))
+        data = yaml.safe_load(PRICELIST.read_bytes())
+        changed, removed, kept = data['goods'][0], data['goods'].pop(1), data['goods'][1]
+        changed['price'] += 1000
+        changed['parameters']['Цвет'] = 'черный'
+        data['goods'].append({**kept, 'id': 1, 'model': 'apple/iphone/new'})
+        buyer = User.objects.create_user('buyer@example.com', 'password', is_active=True)
+        basket = Order.objects.create(user=buyer, status='basket')
+        OrderItem.objects.create(order=basket, product_info_id=ids[kept['id']], shop_id=shop_id, quantity=1)
+
+        counts = PriceListImporter(self.user.id, incremental=True).run(data)['counts']
+        self.assertEqual({name: counts[name] for name in (
+            'product_infos_created', 'product_infos_updated', 'product_infos_unchanged', 'product_infos_deleted',
+            'product_parameters_updated')}, {
+            'product_infos_created': 1, 'product_infos_updated': 1, 'product_infos_unchanged': 2,
+            'product_infos_deleted': 1, 'product_parameters_updated': 1})
+
+        # неизмененные предложения сохраняют id, и позиции корзин с ними не удаляются каскадом
+        current = dict(ProductInfo.objects.values_list('external_id', 'id'))
+        self.assertEqual(current[kept['id']], ids[kept['id']])
+        self.assertNotIn(removed['id'], current)
+        self.assertTrue(OrderItem.objects.filter(order=basket).exists())
+        self.assertEqual(ProductInfo.objects.get(external_id=changed['id']).price, changed['price'])
+
+        # повтор того же прайса ничего не пишет и не меняет версию каталога
+        version = Shop.objects.get(id=shop_id).catalog_version
+        counts = PriceListImporter(self.user.id, incremental=True).run(data)['counts']
+        self.assertEqual(counts['product_infos_unchanged'], 4)
+        self.assertEqual(Shop.objects.get(id=shop_id).catalog_version, version)
+
+
+class ImportJobTest(TestCase):
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        override = override_settings(MEDIA_ROOT=media)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.user = create_shop_user()
+
+    def test_clean_requires_source_or_url(self):
+        with self.assertRaises(ValidationError):
+            ImportJob(user=self.user).full_clean()
+        with self.assertRaises(ValidationError):
+            ImportJob(user=self.user, url='https://example.com/shop.yaml',
+                      source=ContentFile(b'shop: x', name='shop.yaml')).full_clean()
+        ImportJob(user=self.user, url='https://example.com/shop.yaml').full_clean()
+
+    def test_resume_reruns_interrupted_jobs(self):
+        job = ImportJob(user=self.user, state='running', goods_processed=5)
+        job.source.save('shop1.yaml', ContentFile(PRICELIST.read_bytes()))
+        done = ImportJob.objects.create(user=self.user, url='https://example.com/shop.yaml', state='done')
+
+        with mock.patch('backend.management.commands.resume_import_jobs.create_executor', InlineExecutor):
+            call_command('resume_import_jobs', stdout=StringIO())
+
+        job.refresh_from_db()
+        self.assertEqual(job.state, 'done', job.error)
+        self.assertEqual(job.goods_processed, 4)
+        self.assertFalse(job.source)
+        self.assertEqual(ProductInfo.objects.filter(shop__user=self.user).count(), 4)
+        self.assertEqual(ImportJob.objects.get(id=done.id).state, 'done')
+
+    def test_resume_fail_marks_unfinished_jobs(self):
+        queued = ImportJob.objects.create(user=self.user, url='https://example.com/a.yaml')
+        running = ImportJob.objects.create(user=self.user, url='https://example.com/b.yaml', state='running')
+        done = ImportJob.objects.create(user=self.user, url='https://example.com/c.yaml', state='done')
+
+        call_command('resume_import_jobs', '--fail', stdout=StringIO())
+
+        states = dict(ImportJob.objects.values_list('id', 'state'))
+        self.assertEqual(states, {queued.id: 'failed', running.id: 'failed', done.id: 'done'})
+        self.assertTrue(ImportJob.objects.get(id=running.id).finished_at)
+
+
+class ImportPricelistsCommandTest(TestCase):
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.directory)
+        patcher = mock.patch('backend.management.commands.import_pricelists.create_executor', InlineExecutor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_imports_each_file_into_its_shop(self):
+        # у магазинов общие продукты, категории и характеристики
+        (self.directory / 'first.yaml').write_bytes(generated_pricelist(50, shop='Первый', products=20))
+        (self.directory / 'second.csv').write_bytes(
+            generated_pricelist(30, shop='Второй', products=20, seed=1, format='csv'))
+        (self.directory / 'readme.txt').write_text('не прайс')
+        stdout = StringIO()
+
+        call_command('import_pricelists', str(self.directory), stdout=stdout)
+
+        counts = dict(Shop.objects.values_list('name').annotate(Count('product_infos')))
+        self.assertEqual(counts, {'Первый': 50, 'Второй': 30})
+        self.assertIn('Файлов: 2 из 2, товаров: 80', stdout.getvalue())
+
+    def test_failed_file_does_not_stop_others(self):
+        (self.directory / 'good.yaml').write_bytes(generated_pricelist(10, shop='Первый'))
+        (self.directory / 'broken.yaml').write_bytes(b'shop: [')
+        stderr = StringIO()
+
+        with self.assertRaisesMessage(CommandError, 'Не удалось импортировать файлов: 1'):
+            call_command('import_pricelists', str(self.directory), stdout=StringIO(), stderr=stderr)
+
+        self.assertIn('broken.yaml: ошибка импорта', stderr.getvalue())
+        self.assertEqual(ProductInfo.objects.filter(shop__name='Первый').count(), 10)
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(test, do_get):
+    "Локальный HTTP-сервер с обработчиком do_get(handler) на время теста; возвращает его адрес"
+    server = ThreadingHTTPServer(('127.0.0.1', 0), type('Handler', (QuietHandler,), {'do_GET': do_get}))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    test.addCleanup(server.server_close)
+    test.addCleanup(server.shutdown)
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+def send(handler, body, status=200, **headers):
+    handler.send_response(status)
+    headers.setdefault('Content-Length', str(len(body)))
+    for name, value in headers.items():
+        handler.send_header(name.replace('_', '-'), value)
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+class TransferTest(SimpleTestCase):
+    def download(self, url, **kwargs):
+        file = tempfile.TemporaryFile()
+        self.addCleanup(file.close)
+        download = start_download(url, file, session=Session(), **kwargs)
+        if download is not None:
+            self.addCleanup(download.close)
+        return download
+
+    def test_not_modified(self):
+        def do_get(handler):
+            if handler.headers.get('If-None-Match') == '"v1"':
+                send(handler, b'', status=304)
+            else:
+                send(handler, b'shop: x', ETag='"v1"')
+        url = serve(self, do_get)
+
+        self.assertEqual(self.download(url + '/shop.yaml').wait()['size'], 7)
+        self.assertIsNone(self.download(url + '/shop.yaml', headers={'If-None-Match': '"v1"'}))
+
+    def test_oversized_content_length(self):
+        url = serve(self, lambda handler: send(handler, b'x' * 100))
+        with override_settings(PRICELIST_MAX_SIZE=10), self.assertRaises(TransferError):
+            self.download(url + '/shop.yaml')
+
+    def test_gzip(self):
+        body = b'shop: x\n' * 10000
+        url = serve(self, lambda handler: send(handler, gzip.compress(body), Content_Type='application/gzip'))
+
+        download = self.download(url + '/shop.yaml.gz')
+        self.assertEqual(download.wait(), {'size': len(body), 'hash': sha256(body).hexdigest()})
+        self.assertEqual(download.file.read(), body)
+
+        # ограничение применяется к распакованному размеру
+        with override_settings(PRICELIST_MAX_SIZE=1000), self.assertRaises(TransferError):
+            self.download(url + '/shop.yaml.gz').wait()
+
+    def test_truncated_gzip(self):
+        data = gzip.compress(b'shop: x\n' * 10000)
+        url = serve(self, lambda handler: send(handler, data[:len(data) // 2], Content_Type='application/gzip'))
+        with self.assertRaisesMessage(TransferError, 'оборван'):
+            self.download(url + '/shop.yaml.gz').wait()
+
+    def test_read_while_downloading(self):
+        head, tail = b'a' * CHUNK_SIZE * 2, b'b' * CHUNK_SIZE
+        release = threading.Event()
+
+        def do_get(handler):
+            handler.send_response(200)
+            handler.send_header('Content-Length', str(len(head) + len(tail)))
+            handler.end_headers()
+            handler.wfile.write(head)
+            handler.wfile.flush()
+            # вторая часть отдается только после того, как читатель получил первую
+            release.wait(10)
+            handler.wfile.write(tail)
+        url = serve(self, do_get)
+
+        download = self.download(url + '/shop.yaml')
+        reader = download.open()
+        self.assertEqual(reader.read(len(head)), head)
+        self.assertFalse(download.done)
+        release.set()
+        self.assertEqual(reader.read(), tail)
+        self.assertEqual(download.wait()['hash'], sha256(head + tail).hexdigest())
+
+    def test_receive_upload(self):
+        body = b'shop: x\n' * 10000
+        upload = receive_upload(read_chunks(io.BytesIO(gzip.compress(body))), 'shop.yaml.gz', compressed=True)
+        self.addCleanup(upload.close)
+        self.assertEqual((upload.name, upload.size, upload.read()), ('shop.yaml', len(body), body))
+        with self.assertRaises(TransferError):
+            receive_upload(read_chunks(io.BytesIO(body)), 'shop.yaml', max_size=100)
+
+
+class ImportDownloadTest(TestCase):
+    def test_url_job_imports_while_downloading(self):
+        body = PRICELIST.read_bytes()
+        url = serve(self, lambda handler: send(handler, body, Content_Type='application/x-yaml'))
+        job = ImportJob.objects.create(user=create_shop_user(), url=url + '/shop1.yaml')
+
+        with mock.patch('backend.tasks.read_pricelist', wraps=read_pricelist) as reader:
+            do_import(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual((job.state, job.goods_processed, job.goods_total), ('done', 4, 4), job.error)
+        # прайс разбирается один раз, прямо из скачиваемого потока
+        self.assertEqual(reader.call_count, 1)
+        self.assertIsInstance(reader.call_args.args[0], io.BufferedReader)
+
+
+class ImportProgressTest(TransactionTestCase):
+    "Прогресс задачи виден другим запросам, пока импорт еще идет"
+
+    def test_status_during_import(self):
+        body = generated_pricelist(3000)
+        half = len(body) // 2
+        resume = threading.Event()
+        self.addCleanup(resume.set)
+
+        def do_get(handler):
+            # первая половина прайса отдается сразу, остальное - после проверки статуса
+            handler.send_response(200)
+            handler.send_header('Content-Type', 'application/x-yaml')
+            handler.send_header('Content-Length', str(len(body)))
+            handler.end_headers()
+            handler.wfile.write(body[:half])
+            handler.wfile.flush()
+            resume.wait(30)
+            handler.wfile.write(body[half:])
+
+        user = create_shop_user()
+        job = ImportJob.objects.create(user=user, url=serve(self, do_get) + '/shop.yaml')
+
+        def run():
+            try:
+                do_import(job.id)
+            finally:
+                connection.close()
+
+        worker = threading.Thread(target=run)
+        worker.start()
+        self.client.force_login(user)
+        for _ in range(300):
+            status = self.client.get(f'/partner/update/{job.id}').json()
+            if status['goods_processed']:
+                break
+            time.sleep(0.1)
+        resume.set()
+        worker.join(30)
+
+        self.assertEqual(status['state'], 'running')
+        self.assertEqual(status['bytes_total'], len(body))
+        self.assertLess(0, status['bytes_processed'])
+        self.assertLessEqual(status['bytes_processed'], half)
+        self.assertLess(0, status['goods_processed'])
+        self.assertLess(status['goods_processed'], 3000)
+
+        status = self.client.get(f'/partner/update/{job.id}').json()
+        self.assertEqual(status['state'], 'done', status['error'])
+        self.assertEqual((status['goods_processed'], status['goods_total']), (3000, 3000))
+        self.assertEqual((status['bytes_processed'], status['bytes_total']), (len(body), len(body)))
+
+
+class CatalogTest(TestCase):
+    def setUp(self):
+        self.user = create_shop_user()
+        import_pricelist(self.user)
+
+    def test_parameters_keep_product_order(self):
+        items = self.client.get('/product_info/').json()['results']
+
+        expected = {}
+        for product_info_id, name, value in ProductParameter.objects.order_by('id').values_list(
+                'product_info_id', 'parameter__name', 'value'):
+            expected.setdefault(product_info_id, []).append({'parameter': name, 'value': value})
+        self.assertEqual({item['id']: item['product_parameters'] for item in items}, expected)
+        # jsonb упорядочил бы ключи объекта по длине, и первым оказался бы Цвет
+        self.assertEqual(items[0]['product_parameters'][0]['parameter'], 'Диагональ (дюйм)')
+
+    def follow(self, url, link='next', limit=100):
+        "Проходит каталог по ссылкам link, не больше limit страниц; возвращает (цена, id) предложений по страницам"
+        pages = []
+        while url and len(pages) < limit:
+            response = self.client.get(url).json()
+            pages.append([(item['price'], item['id']) for item in response['results']])
+            url = response[link]
+        return pages
+
+    def test_cursor_pages(self):
+        entries = CatalogEntry.objects.filter(shop_state=True)
+        for ordering, expected in (('', sorted(entries.values_list('price', 'pk'), key=lambda row: row[1])),
+                                   ('price', sorted(entries.values_list('price', 'pk'))),
+                                   ('-price', sorted(entries.values_list('price', 'pk'), reverse=True))):
+            with self.subTest(ordering=ordering):
+                pages = self.follow(f'/product_info/?page_size=1&ordering={ordering}')
+                self.assertEqual(pages, [[row] for row in expected])
+
+                # обратно по ссылкам previous с последней страницы
+                response = self.client.get(f'/product_info/?page_size={len(expected) - 1}&ordering={ordering}')
+                last = self.client.get(response.json()['next']).json()
+                self.assertEqual(last['next'], None)
+                previous = self.follow(last['previous'], 'previous')
+                self.assertEqual(previous, [[row for row in expected[:-1]]])
+
+        # предложения другого магазина в других категориях в выдачу с фильтром не попадают
+        import_pricelist(create_shop_user('other@example.com'), generated_pricelist(20, shop='Другой'))
+        self.assertGreater(entries.exclude(category_id=224).count(), 0)
+        category = self.follow('/product_info/?page_size=1&ordering=price&category_id=224')
+        self.assertEqual([page[0] for page in category],
+                         sorted(entries.filter(category_id=224).values_list('price', 'pk')))
+
+    def test_cursor_pages_tied_prices(self):
+        # одинаковых цен больше, чем offset_cutoff = 1000 у CursorPagination из DRF
+        import_pricelist(create_shop_user('other@example.com'), generated_pricelist(1100, shop='Другой'))
+        CatalogEntry.objects.exclude(price=110000).update(price=65000, price_rrc=70000)
+        ids = sorted(CatalogEntry.objects.values_list('pk', flat=True))
+        for ordering in ('price', '-price', 'price_rrc', '-price_rrc'):
+            with self.subTest(ordering=ordering):
+                pages = self.follow(f'/product_info/?page_size=200&ordering={ordering}')
+                found = [pk for page in pages for _, pk in page]
+                self.assertEqual(sorted(found), ids)
+                self.assertEqual(len(set(found)), len(found))
+
+                response = self.client.get(f'/product_info/?page_size=200&ordering={ordering}')
+                for _ in range(len(pages) - 1):
+                    response = self.client.get(response.json()['next'])
+                back = self.follow(response.json()['previous'], 'previous')
+                self.assertEqual([pk for page in reversed(back) for _, pk in page], found[:-len(pages[-1])])
+
+    def test_search_by_parameter_value(self):
+        items = self.client.get('/product_info/', {'search': 'золотистый'}).json()['results']
+        self.assertEqual([item['model'] for item in items], ['apple/iphone/xs-max'])
+
+    def test_search_ordering_covers_all_matches(self):
+        entries = CatalogEntry.objects.filter(shop_state=True)
+        expected = sorted(entries.filter(product_name__icontains='смартфон').values_list('price', 'pk'))
+        self.assertGreater(len(expected), 1)
+        # сортировка по цене не ограничивается первыми candidates совпадениями
+        found = search_catalog(entries, 'смартфон', candidates=1, ordering=('price', 'pk'))
+        self.assertEqual(list(found.values_list('price', 'pk')), expected)
+
+        items = self.client.get('/product_info/', {'search': 'смартфон', 'ordering': '-price'}).json()['results']
+        self.assertEqual([(item['price'], item['id']) for item in items],
+                         [(price, pk) for price, pk in reversed(expected)])
+
+    def test_facets_follow_deleted_offers(self):
+        data = read_pricelist(io.BytesIO(PRICELIST.read_bytes()))
+        facets = CatalogFacet.objects.filter(category_id=224)
+        self.assertEqual(facets.aggregate(Sum('count'))['count__sum'], ProductParameter.objects.count())
+
+        # строки каталога удаленных предложений удаляются каскадно, фасеты их категорий пересчитываются
+        data['goods'] = list(data['goods'])[:1]
+        PriceListImporter(self.user.id, incremental=True).run(data)
+        self.assertEqual(ProductInfo.objects.count(), 1)
+        self.assertEqual(facets.aggregate(Sum('count'))['count__sum'], ProductParameter.objects.count())
+
+        data['goods'] = []
+        PriceListImporter(self.user.id).run(data)
+        self.assertFalse(facets.exists())
+
+
+class CatalogCacheTest(TestCase):
+    def setUp(self):
+        # кэш в локальной памяти переживает тест, а id магазинов и версии в новой базе повторяются
+        get_cache().clear()
+        self.user = create_shop_user()
+        self.shop_id = import_pricelist(self.user)['shop']
+
+    def test_hit_after_miss(self):
+        for url in ('/product_info/', f'/product_info/?shop_id={self.shop_id}', '/category/', '/shops/'):
+            with self.subTest(url):
+                first = self.client.get(url)
+                second = self.client.get(url)
+                self.assertEqual((first['X-Cache'], second['X-Cache']), ('MISS', 'HIT'))
+                self.assertEqual(second.json(), first.json())
+
+    def test_conditional_get(self):
+        urls = ('/product_info/', f'/product_info/?shop_id={self.shop_id}', '/category/', '/shops/')
+        etags = {}
+        for url in urls:
+            with self.subTest(url):
+                response = self.client.get(url)
+                etags[url] = response['ETag']
+                self.assertTrue(response.has_header('Last-Modified'))
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etags[url])
+                self.assertEqual((response.status_code, response['ETag']), (304, etags[url]))
+                response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+                self.assertEqual(response.status_code, 304)
+
+        # импорт другого магазина не меняет версию каталога этого магазина
+        import_pricelist(create_shop_user('other@example.com'), generated_pricelist(5, shop='Другой'))
+        for url in urls:
+            with self.subTest(url):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etags[url])
+                if 'shop_id' in url:
+                    self.assertEqual(response.status_code, 304)
+                else:
+                    self.assertEqual(response.status_code, 200)
+                    self.assertNotEqual(response['ETag'], etags[url])
+
+        import_pricelist(self.user)
+        url = f'/product_info/?shop_id={self.shop_id}'
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etags[url]).status_code, 200)
+
+    def test_fragments(self):
+        with mock.patch('backend.serializers.render_fragment', wraps=render_fragment) as render:
+            items = self.client.get('/product_info/?ordering=price').json()['results']
+            self.assertEqual(render.call_count, 4)
+            # другой запрос собирается из тех же фрагментов без сериализации строк
+            self.assertEqual(self.client.get('/product_info/?ordering=-price').json()['results'], items[::-1])
+            self.assertEqual(render.call_count, 4)
+
+            # после импорта заново сериализуется только измененная строка
+            import_pricelist(self.user, PRICELIST.read_bytes().replace(b'price: 110000', b'price: 100000'),
+                             incremental=True)
+            items = self.client.get('/product_info/?ordering=price').json()['results']
+            self.assertEqual(render.call_count, 5)
+
+        # фрагменты совпадают с сериализацией строк без кэша
+        entries = CatalogEntry.objects.order_by('price', 'pk').values(*CATALOG_ENTRY_VALUES)
+        self.assertEqual(items, [CatalogEntrySerializer().to_representation(entry) for entry in entries])
+        self.assertIn(100000, [item['price'] for item in items])
+
+    def test_import_invalidates(self):
+        self.client.get('/product_info/')
+        data = yaml.safe_load(PRICELIST.read_bytes())
+        data['goods'][0]['price'] += 1000
+        import_pricelist(self.user, yaml.safe_dump(data, allow_unicode=True, sort_keys=False).encode())
+
+        response = self.client.get('/product_info/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertIn(data['goods'][0]['price'], [item['price'] for item in response.json()['results']])
+
+    def test_shop_state_invalidates(self):
+        self.assertEqual(len(self.client.get('/product_info/').json()['results']), 4)
+        response = self.client.patch(f'/shops/{self.shop_id}/', {'state': False}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get('/product_info/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.json()['results'], [])
+
+
+class PartnerOrdersTest(TestCase):
+    def test_order_listed_once(self):
+        user = create_shop_user()
+        import_pricelist(user)
+        buyer = User.objects.create_user('buyer@example.com', 'password', is_active=True)
+        order = Order.objects.create(user=buyer, status='new')
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product_info=product_info, shop_id=product_info.shop_id, quantity=1)
+            for product_info in ProductInfo.objects.all()[:2]
+        ])
+
+        self.client.force_login(user)
+        response = self.client.get('/partner_order/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['id'] for item in response.json()], [order.id])
+
+
+class BasketTest(TestCase):
+    def setUp(self):
+        self.shop_id = import_pricelist(create_shop_user())['shop']
+        self.offers = list(ProductInfo.objects.order_by('id').values_list('id', flat=True))
+        self.buyer = User.objects.create_user('buyer@example.com', 'password', is_active=True)
+        self.client.force_login(self.buyer)
+
+    def post(self, items):
+        return self.client.post('/user/basket', {'ordered_items': items}, content_type='application/json')
+
+    def test_add_items(self):
+        first, second, third, _ = self.offers
+        self.post([{'product_info': first, 'quantity': 1}])
+        response = self.post([{'product_info': second, 'quantity': 2}, {'product_info': second, 'quantity': 3},
+                              {'product_info': first, 'quantity': 1}, {'product_info': 10 ** 6, 'quantity': 1},
+                              {'product_info': third, 'quantity': 0}])
+        data = response.json()
+        self.assertEqual((data['Status'], data['Создано позиций']), (False, 1))
+        self.assertEqual([item['status'] for item in data['Позиции']], ['created'] + ['error'] * 4)
+        self.assertEqual(data['Позиции'][1]['errors'], {'product_info': ['Позиция повторяется в запросе']})
+        self.assertEqual(data['Позиции'][2]['errors'], {'product_info': ['Позиция уже есть в корзине']})
+        self.assertEqual(data['Позиции'][3]['errors'], {'product_info': ['Предложение не найдено']})
+        self.assertIn('quantity', data['Позиции'][4]['errors'])
+
+        # магазин позиции берется из предложения
+        items = OrderItem.objects.filter(order__user=self.buyer).order_by('product_info_id')
+        self.assertEqual(list(items.values_list('product_info_id', 'quantity', 'shop_id')),
+                         [(first, 1, self.shop_id), (second, 2, self.shop_id)])
+        self.assertEqual(data['Позиции'][0]['id'], items.get(product_info_id=second).id)
+
+    def test_add_limit(self):
+        items = [{'product_info': self.offers[0], 'quantity': 1}] * (MAX_BASKET_ITEMS + 1)
+        response = self.post(items)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(OrderItem.objects.exists())
+
+        # проверка и запись позиций не зависят от их числа
+        items = [{'product_info': product_info, 'quantity': 1} for product_info in self.offers]
+        # первый запрос еще и создает корзину
+        self.post(items[:1])
+        OrderItem.objects.all().delete()
+        with CaptureQueriesContext(connection) as one:
+            self.post(items[:1])
+        OrderItem.objects.all().delete()
+        with CaptureQueriesContext(connection) as many:
+            self.post(items)
+        self.assertEqual(len(many), len(one))
+        self.assertEqual(OrderItem.objects.count(), len(self.offers))
+
+    def put(self, items):
+        return self.client.put('/user/basket', {'ordered_items': items}, content_type='application/json')
+
+    def test_update_items(self):
+        first, second, third, fourth = self.offers
+        self.post([{'product_info': offer, 'quantity': 1} for offer in (first, second, third)])
+        response = self.put([{'product_info': first, 'quantity': 5}, {'product_info': second, 'quantity': 0},
+                             {'product_info': third, 'quantity': 2}, {'product_info': third, 'quantity': 3},
+                             {'product_info': fourth, 'quantity': 1}, {'product_info': first, 'quantity': -1}])
+        data = response.json()
+        self.assertEqual((data['Status'], data['Обновлено объектов'], data['Удалено позиций']), (False, 2, 1))
+        self.assertEqual([item['status'] for item in data['Позиции']],
+                         ['updated', 'deleted', 'updated', 'error', 'error', 'error'])
+        self.assertEqual(data['Позиции'][3]['errors'], {'product_info': ['Позиция повторяется в запросе']})
+        self.assertEqual(data['Позиции'][4]['errors'], {'product_info': ['Позиция не найдена в корзине']})
+        self.assertIn('quantity', data['Позиции'][5]['errors'])
+        self.assertEqual(dict(OrderItem.objects.values_list('product_info_id', 'quantity')), {first: 5, third: 2})
+
+        response = self.put([{'product_info': first, 'quantity': 1}] * (MAX_BASKET_ITEMS + 1))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(OrderItem.objects.get(product_info_id=first).quantity, 5)
+
+    def test_delete_items(self):
+        self.post([{'product_info': offer, 'quantity': 1} for offer in self.offers])
+        response = self.client.delete('/user/basket', {'ordered_items': [{'product_info': offer}
+                                                                         for offer in self.offers[:2]]},
+                                      content_type='application/json')
+        self.assertEqual(response.json(), {'Status': True, 'Удалено позиций': 2})
+        self.assertEqual(sorted(OrderItem.objects.values_list('product_info_id', flat=True)), self.offers[2:])
+
+
+    def assertTotals(self, url='/user/basket'):
+        "Итоги заказа в ответе url совпадают с суммой его позиций по текущим ценам"
+        order = self.client.get(url).json()[0]
+        items = OrderItem.objects.filter(order_id=order['id']).select_related('product_info')
+        shop_totals = {}
+        for item in items:
+            total = item.quantity * item.product_info.price
+            shop_totals[str(item.shop_id)] = shop_totals.get(str(item.shop_id), 0) + total
+        self.assertEqual((order['total_sum'], order['item_count'], order['shop_totals']),
+                         (sum(shop_totals.values()) if items else None, sum(item.quantity for item in items),
+                          shop_totals))
+        return order
+
+    def test_totals_follow_items(self):
+        other_shop = import_pricelist(create_shop_user('other@example.com'), generated_pricelist(3, shop='Другой'))
+        other = list(ProductInfo.objects.filter(shop_id=other_shop['shop']).values_list('id', flat=True))
+        self.post([{'product_info': offer, 'quantity': 2} for offer in self.offers[:2] + other[:1]])
+        self.assertEqual(len(self.assertTotals()['shop_totals']), 2)
+
+        self.put([{'product_info': self.offers[0], 'quantity': 5}, {'product_info': other[0], 'quantity': 0}])
+        self.assertEqual(list(self.assertTotals()['shop_totals']), [str(self.shop_id)])
+
+        self.client.delete('/user/basket', {'ordered_items': [{'product_info': self.offers[1]}]},
+                           content_type='application/json')
+        self.assertEqual(self.assertTotals()['item_count'], 5)
+
+        self.client.delete('/user/basket', {'ordered_items': [{'product_info': self.offers[0]}]},
+                           content_type='application/json')
+        self.assertEqual(self.assertTotals()['total_sum'], None)
+
+    def test_totals_in_order_lists(self):
+        self.post([{'product_info': offer, 'quantity': 1} for offer in self.offers])
+        basket = self.assertTotals()
+        Order.objects.filter(id=basket['id']).update(status='new')
+        order = self.assertTotals('/user/orders')
+        self.assertEqual(order['total_sum'], basket['total_sum'])
+
+        self.client.force_login(ProductInfo.objects.get(id=self.offers[0]).shop.user)
+        self.assertEqual(self.assertTotals('/partner_order/')['shop_totals'], basket['shop_totals'])
+        self.assertEqual(self.client.get('/partner_order/?fields=id,total_sum').json(),
+                         [{'id': basket['id'], 'total_sum': basket['total_sum']}])
+
+
+class OrderListTest(TestCase):
+    def test_etag_follows_catalog(self):
+        import_pricelist(create_shop_user())
+        buyer = User.objects.create_user('buyer@example.com', 'password', is_active=True)
+        order = Order.objects.create(user=buyer, status='new')
+        product_info = ProductInfo.objects.get(price=110000)
+        OrderItem.objects.create(order=order, product_info=product_info, shop_id=product_info.shop_id, quantity=1)
+        self.client.force_login(buyer)
+
+        url = '/user/orders?expand=product_info'
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # цена в каталоге изменилась, сам заказ нет: сохраненный клиентом ответ устарел
+        import_pricelist(ProductInfo.objects.get(pk=product_info.pk).shop.user,
+                         PRICELIST.read_bytes().replace(b'price: 110000', b'price: 100000'), incremental=True)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0]['ordered_items'][0]['product_info']['price'], 100000)
+
+
+class CheckoutConcurrencyTest(TransactionTestCase):
+    "Одновременные оформления корзин с одним предложением, каждое в своем соединении"
+
+    def setUp(self):
+        import_pricelist(create_shop_user())
+        self.product_info = ProductInfo.objects.get(price=110000)
+        ProductInfo.objects.filter(id=self.product_info.id).update(quantity=5)
+
+    def place_baskets(self, count, quantity, partial):
+        "count покупателей одновременно оформляют корзины по quantity единиц; результаты, отказ - None"
+        baskets = []
+        for number in range(count):
+            buyer = User.objects.create_user(f'buyer{number}@example.com', 'password', is_active=True)
+            basket = Order.objects.create(user=buyer, status='basket')
+            OrderItem.objects.create(order=basket, product_info=self.product_info, shop_id=self.product_info.shop_id,
+                                     quantity=quantity)
+            baskets.append(basket.id)
+        barrier = threading.Barrier(count)
+
+        def place(basket_id):
+            barrier.wait()
+            try:
+                return checkout(Order.objects.filter(id=basket_id), partial=partial)
+            except StockError:
+                return None
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(count) as pool:
+            return list(pool.map(place, baskets))
+
+    def assertStockLeft(self, quantity):
+        self.assertEqual(ProductInfo.objects.get(id=self.product_info.id).quantity, quantity)
+        self.assertEqual(CatalogEntry.objects.get(product_info_id=self.product_info.id).quantity, quantity)
+        self.assertEqual(OrderItem.objects.filter(order__status='new').aggregate(Sum('quantity'))['quantity__sum'],
+                         5 - quantity)
+
+    def test_no_oversell(self):
+        results = self.place_baskets(8, 2, partial=False)
+        self.assertEqual(sum(result is not None for result in results), 2)
+        self.assertStockLeft(1)
+
+    def test_partial_takes_rest(self):
+        results = self.place_baskets(8, 2, partial=True)
+        self.assertEqual(sorted(result[0]['reserved'] for result in results if result), [1, 2, 2])
+        self.assertStockLeft(0)
+
+
+class IdempotencyTest(TransactionTestCase):
+    "Idempotency-Key без общей транзакции: оформление фиксируется само, ответ сохраняется после него"
+
+    def setUp(self):
+        import_pricelist(create_shop_user())
+        self.product_info = ProductInfo.objects.get(price=110000)
+        self.buyer = User.objects.create_user('buyer@example.com', 'password', is_active=True)
+        self.client.force_login(self.buyer)
+        self.basket = Order.objects.create(user=self.buyer, status='basket')
+        OrderItem.objects.create(order=self.basket, product_info=self.product_info, shop_id=self.product_info.shop_id,
+                                 quantity=2)
+
+    def place(self, key, basket_id=None):
+        return self.client.post('/user/orders', {'id': basket_id or self.basket.id}, HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_replay(self):
+        first = self.place('order-1')
+        self.assertEqual(first.status_code, 200)
+        second = self.place('order-1')
+        self.assertEqual((second.status_code, second.content, second['Idempotent-Replayed']),
+                         (200, first.content, 'true'))
+        self.assertEqual(ProductInfo.objects.get(id=self.product_info.id).quantity, self.product_info.quantity - 2)
+        self.assertEqual(self.place('order-1', self.basket.id + 1).status_code, 422)
+
+    def test_retryable_response_not_stored(self):
+        ProductInfo.objects.filter(id=self.product_info.id).update(quantity=1)
+        self.assertEqual(self.place('order-1').status_code, 409)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+        ProductInfo.objects.filter(id=self.product_info.id).update(quantity=5)
+        self.assertEqual(self.place('order-1').status_code, 200)
+
+    def pending_key(self, fingerprint, lease):
+        "Ключ без ответа, занятый запросом с отпечатком fingerprint еще lease секунд"
+        return IdempotencyKey.objects.create(user=self.buyer, key='order-1', fingerprint=fingerprint,
+                                             locked_until=timezone.now() + timedelta(seconds=lease))
+
+    @mock.patch('backend.idempotency.request_fingerprint', return_value='order')
+    def test_pending_key(self, fingerprint):
+        self.pending_key('order', 60)
+        self.assertEqual(self.place('order-1').status_code, 409)
+        self.assertEqual(Order.objects.get(id=self.basket.id).status, 'basket')
+
+        # другие данные запроса - ошибка 422, даже пока первый запрос выполняется
+        IdempotencyKey.objects.update(fingerprint='other')
+        self.assertEqual(self.place('order-1').status_code, 422)
+
+    @mock.patch('backend.idempotency.request_fingerprint', return_value='order')
+    def test_stale_pending_key(self, fingerprint):
+        # процесс первого запроса завершился, не записав ответ: после аренды ключ занимает повтор
+        self.pending_key('order', -1)
+        first = self.place('order-1')
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(Order.objects.get(id=self.basket.id).status, 'new')
+        second = self.place('order-1')
+        self.assertEqual((second.content, second['Idempotent-Replayed']), (first.content, 'true'))
+
+        IdempotencyKey.objects.all().delete()
+        self.pending_key('other', -1)
+        self.assertEqual(self.place('order-1').status_code, 422)
+
+    def test_drf_response(self):
+        calls = []
+
+        class View(APIView):
+            @idempotent
+            def post(self, request):
+                calls.append(connection.in_atomic_block)
+                return Response({'Status': True, 'call': len(calls)})
+
+        def post():
+            request = APIRequestFactory().post('/view', {'a': 1}, format='json', HTTP_IDEMPOTENCY_KEY='key-1')
+            force_authenticate(request, user=self.buyer)
+            response = View.as_view()(request)
+            return response.render() if hasattr(response, 'render') else response
+
+        first, second = post(), post()
+        # метод выполняется вне транзакции ключа, Response сохраняется уже отрисованным
+        self.assertEqual(calls, [False])
+        self.assertEqual(first.content, b'{"Status":true,"call":1}')
+        self.assertEqual((second.content, second['Idempotent-Replayed']), (first.content, 'true'))
+
+    def test_lost_lease(self):
+        class View(APIView):
+            @idempotent
+            def post(self, request):
+                # запрос выполнялся дольше аренды, и ключ занял повтор
+                IdempotencyKey.objects.update(locked_until=timezone.now())
+                return Response({'Status': True})
+
+        request = APIRequestFactory().post('/view', {'a': 1}, format='json', HTTP_IDEMPOTENCY_KEY='key-1')
+        force_authenticate(request, user=self.buyer)
+        self.assertEqual(View.as_view()(request).status_code, 200)
+        # ответ не записывается в ключ, занятый другим запросом
+        self.assertEqual(IdempotencyKey.objects.get().status_code, None)
+
+
+class CatalogPlanTest(TestCase):
+    """
+    Планы запросов страницы каталога с фильтрами и сортировкой по цене.
+    Проверяется запрос, который выполняет само представление с CatalogCursorPagination. В тестовой базе
+    всего несколько строк, поэтому последовательное чтение и сортировка отключаются: если подходящего
+    индекса нет, в плане остаются Seq Scan или Sort.
+    """
+    # параметры запроса каталога и индекс, по которому должна выбираться страница
+    CASES = (
+        ('ordering=price', 'catalog_price_idx'),
+        ('ordering=-price', 'catalog_price_idx'),
+        ('ordering=price_rrc', 'catalog_price_rrc_idx'),
+        ('price_min=100000&price_max=200000&in_stock=true&ordering=price', 'catalog_price_idx'),
+        ('shop_id={shop}&ordering=price', 'catalog_price_idx'),
+        ('category_id={category}&ordering=price', 'catalog_category_price_idx'),
+        ('category_id={category}&ordering=-price_rrc', 'catalog_category_price_rrc_idx'),
+        ('category_id={category}&price_min=50000&price_max=150000&ordering=price', 'catalog_category_price_idx'),
+        ('shop_id={shop}&category_id={category}&in_stock=true&ordering=-price', 'catalog_shop_price_idx'),
+    )
+
+    def setUp(self):
+        self.user = create_shop_user()
+        self.shop_id = import_pricelist(self.user)['shop']
+
+    def explain(self, url):
+        "План запроса страницы, который выполняет представление по адресу url"
+        get_cache().clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        pages = [query['sql'] for query in queries
+                 if query['sql'].startswith('SELECT') and 'FROM "backend_catalogentry"' in query['sql']
+                 and ' LIMIT ' in query['sql']]
+        self.assertEqual(len(pages), 1, pages)
+        with connection.cursor() as cursor:
+            for setting in ('enable_seqscan', 'enable_bitmapscan', 'enable_sort'):
+                cursor.execute(f'SET LOCAL {setting} = off')
+            cursor.execute('EXPLAIN ' + pages[0])
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+            cursor.execute('RESET ALL')
+        return response, plan
+
+    def test_price_pages_use_indexes(self):
+        for params, index in self.CASES:
+            params = params.format(shop=self.shop_id, category=224)
+            with self.subTest(params):
+                response, plan = self.explain('/product_info/?page_size=2&' + params)
+                self.assertIn(index, plan)
+                self.assertNotIn('Seq Scan', plan)
+                self.assertNotRegex(plan, r'\bSort\s+\(')
+
+                # следующая страница выбирается по курсору с ценой тем же индексом
+                next_url = response.json()['next']
+                if next_url:
+                    _, plan = self.explain(next_url)
+                    self.assertIn(index, plan)
+                    self.assertNotRegex(plan, r'\bSort\s+\(')
@@ -0,0 +1,278 @@
+import io
+import os
+import threading
+import zlib
+from hashlib import sha256
+
+from django.conf import settings
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# размер блока при приеме и скачивании прайса
+CHUNK_SIZE = 64 * 1024
+
+# расширения и MIME-типы сжатых прайсов
+COMPRESSED_EXTENSIONS = ('.gz', '.gzip')
+COMPRESSED_CONTENT_TYPES = ('application/gzip', 'application/x-gzip')
+
+_session = None
+
+
+class TransferError(ValueError):
+    "Прайс не удалось принять или скачать"
+
+
+def get_session():
+    """
+    HTTP-сессия для скачивания прайсов, создается при первом обращении.
+    Соединения с серверами магазинов переиспользуются, обрывы соединения и ответы 502-504 повторяются.
+    """
+    global _session
+    if _session is None:
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504), allowed_methods=('GET',),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=retry)
+        _session = Session()
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+    return _session
+
+
+def is_compressed(name=None, content_type=None):
+    "Признак прайса в gzip по MIME-типу или расширению"
+    if content_type and content_type.split(';')[0].strip().lower() in COMPRESSED_CONTENT_TYPES:
+        return True
+    return bool(name) and os.path.splitext(name.split('?')[0])[1].lower() in COMPRESSED_EXTENSIONS
+
+
+def strip_compression(name):
+    "Имя файла или ссылка без расширения сжатия: shop.csv.gz -> shop.csv"
+    root, extension = os.path.splitext(name.split('?')[0])
+    return root if extension.lower() in COMPRESSED_EXTENSIONS else name
+
+
+class ChunkWriter:
+    """
+    Пишет блоки в file: распаковывает gzip, ограничивает размер распакованных данных и считает sha256.
+    Ограничение применяется к распакованному размеру, чтобы маленький архив не развернулся в гигабайты.
+    """
+
+    def __init__(self, file, compressed=False, max_size=None):
+        self.file = file
+        # wbits=MAX_WBITS | 16 - формат gzip с заголовком
+        self.decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16) if compressed else None
+        self.max_size = settings.PRICELIST_MAX_SIZE if max_size is None else max_size
+        self.size = 0
+        self.digest = sha256()
+
+    def write(self, chunk):
+        if self.decompressor is not None:
+            try:
+                # распакованный блок ограничен, остаток остается в unconsumed_tail до следующего вызова
+                data = self.decompressor.decompress(chunk, CHUNK_SIZE)
+                while data:
+                    self.write_data(data)
+                    data = self.decompressor.decompress(self.decompressor.unconsumed_tail, CHUNK_SIZE)
+            except zlib.error as error:
+                raise TransferError(f'Поврежденный gzip-архив прайса: {error}')
+        else:
+            self.write_data(chunk)
+
+    def write_data(self, data):
+        self.size += len(data)
+        if self.max_size and self.size > self.max_size:
+            raise TransferError(f'Прайс больше допустимых {self.max_size} байт')
+        self.digest.update(data)
+        self.file.write(data)
+
+    def finish(self):
+        if self.decompressor is not None and not self.decompressor.eof:
+            raise TransferError('Gzip-архив прайса оборван')
+        self.file.flush()
+        return {'size': self.size, 'hash': self.digest.hexdigest()}
+
+
+def receive_upload(chunks, name, content_type=None, compressed=False, max_size=None):
+    """
+    Потоково сохраняет загружаемый прайс во временный файл, распаковывая gzip.
+    chunks - итератор блоков: тело запроса или загруженный файл.
+    Возвращает TemporaryUploadedFile, который хранилище переносит на место без повторного копирования.
+    """
+    if compressed:
+        name = strip_compression(name)
+    upload = TemporaryUploadedFile(name, content_type, 0, None)
+    try:
+        writer = ChunkWriter(upload.file, compressed=compressed, max_size=max_size)
+        for chunk in chunks:
+            writer.write(chunk)
+        upload.size = writer.finish()['size']
+    except BaseException:
+        upload.close()
+        raise
+    upload.seek(0)
+    return upload
+
+
+def read_chunks(stream, size=CHUNK_SIZE):
+    "Итератор блоков из файлового объекта, например тела запроса"
+    while True:
+        chunk = stream.read(size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def open_download(url, headers=None, session=None, timeout=None, max_size=None):
+    """
+    Потоковый GET прайса через пул соединений. Возвращает ответ, тело которого еще не прочитано.
+    Если сервер заранее сообщил размер больше допустимого, соединение закрывается сразу.
+    """
+    session = session or get_session()
+    timeout = settings.PRICELIST_DOWNLOAD_TIMEOUT if timeout is None else timeout
+    response = session.get(url, headers=headers, stream=True, timeout=timeout)
+    if response.status_code == 304:
+        return response
+    try:
+        response.raise_for_status()
+        max_size = settings.PRICELIST_MAX_SIZE if max_size is None else max_size
+        length = response.headers.get('Content-Length', '')
+        # Content-Length сжатого ответа меньше распакованного размера, поэтому в ChunkWriter есть своя проверка
+        if max_size and length.isdigit() and int(length) > max_size:
+            raise TransferError(f'Прайс больше допустимых {max_size} байт')
+    except BaseException:
+        response.close()
+        raise
+    return response
+
+
+def start_download(url, file, headers=None, session=None):
+    """
+    Начинает скачивание прайса в file и возвращает Download.
+    Если сервер ответил 304 Not Modified на условный запрос, возвращает None.
+    """
+    response = open_download(url, headers=headers, session=session)
+    if response.status_code == 304:
+        response.close()
+        return None
+    compressed = is_compressed(url, response.headers.get('Content-Type'))
+    return Download(response, file, compressed=compressed).start()
+
+
+class Download:
+    """
+    Скачивание тела ответа в file в отдельном потоке.
+
+    Пока файл докачивается, его можно читать через open(): чтение ждет следующих блоков,
+    поэтому разбор прайса идет одновременно со скачиванием, а не после него.
+    Content-Encoding: gzip распаковывает requests, а прайсы в .gz распаковываются здесь.
+    """
+
+    def __init__(self, response, file, compressed=False, max_size=None):
+        self.response = response
+        self.file = file
+        self.writer = ChunkWriter(file, compressed=compressed, max_size=max_size)
+        self.condition = threading.Condition()
+        self.size = 0
+        # размер тела заранее известен по Content-Length, только если тело не распаковывается при скачивании
+        length = response.headers.get('Content-Length', '')
+        self.length = None
+        if length.isdigit() and not compressed and not response.headers.get('Content-Encoding'):
+            self.length = int(length)
+        self.done = False
+        self.cancelled = False
+        self.error = None
+        self.result = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        try:
+            for chunk in self.response.iter_content(CHUNK_SIZE):
+                if self.cancelled:
+                    return
+                self.writer.write(chunk)
+                self.writer.file.flush()
+                with self.condition:
+                    self.size = self.writer.size
+                    self.condition.notify_all()
+            self.result = self.writer.finish()
+        except Exception as error:
+            self.error = error
+        finally:
+            self.response.close()
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+
+    def wait_for(self, position):
+        "Ждет, пока в файле появятся данные дальше position или скачивание закончится"
+        with self.condition:
+            while self.size <= position and not self.done:
+                self.condition.wait()
+            if self.error is not None:
+                raise self.error
+            return self.size
+
+    def open(self):
+        "Буферизованный поток чтения скачиваемого файла"
+        return io.BufferedReader(DownloadReader(self), CHUNK_SIZE)
+
+    def wait(self):
+        "Дожидается окончания скачивания и возвращает размер и sha256 содержимого"
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        self.file.seek(0)
+        return self.result
+
+    def close(self):
+        "Прерывает скачивание, если оно еще идет"
+        self.cancelled = True
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class DownloadReader(io.RawIOBase):
+    "Чтение файла Download с собственной позицией, независимой от записи"
+
+    def __init__(self, download):
+        self.download = download
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = self.download.wait_for(self.position)
+        if size <= self.position:
+            return 0
+        data = os.pread(self.download.file.fileno(), min(len(buffer), size - self.position), self.position)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_END:
+            # конец файла известен только после окончания скачивания
+            self.download.wait()
+            offset += self.download.size
+        elif whence == io.SEEK_CUR:
+            offset += self.position
+        self.position = offset
+        return self.position
+
+    def tell(self):
+        return self.position
@@ -14,6 +14,8 @@ urlpatterns = [
     path('login/', views.login_view, name='login'),
     path('users/', views.users_view, name='users'),
     path('partner_order/', views.PartnerOrdersAPIView.as_view(), name='partner-load'),
+    path('partner/update', views.PartnerUpdateAPIView.as_view(), name='partner-update'),
+    path('partner/update/<int:pk>', views.ImportJobAPIView.as_view(), name='partner-update-job'),
     path('user/basket', views.BasketAPIView.as_view(), name='user-basket'),
     path('user/orders', views.OrderAPIView.as_view(), name='user-orders'),
     path('partner_order/', views.PartnerOrdersAPIView.as_view(), name='partner-order'),
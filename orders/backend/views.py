@@ -1,15 +1,38 @@
+from django.conf import settings
 from django.contrib.auth import authenticate, login
-from django.db.models import Q
+from django.core.files.base import ContentFile
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Max, Q
 from django.http import HttpResponse, JsonResponse
 from django.shortcuts import render
 from rest_framework import viewsets
+from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 from rest_framework.views import APIView
-import yaml
+from backend.basket import MAX_BASKET_ITEMS, add_basket_items, update_basket_items
+from backend.caching import bump_catalog_version, cached_response, catalog_version, conditional_get
+from backend.catalog import catalog_facets, filter_parameters, parameter_filters, price_filters, price_ordering, \
+    refresh_catalog, search_catalog
+from backend.renderers import FAST_RENDERER_CLASSES
 from backend.forms import UserRegistrationForm, LoginForm
-from backend.models import User, Product, ProductInfo, Category, Shop, Order, OrderItem, Parameter, ProductParameter
-from .serializers import ProductSerializer, ProductInfoSerializer, CategorySerializer, ShopSerializer, OrderSerializer, OrderItemSerializer
+from backend.idempotency import idempotent
+from backend.models import User, Product, ProductInfo, Category, Shop, Order, OrderItem, Parameter, ProductParameter, \
+    ImportJob, CatalogEntry
+from backend.pagination import CatalogCursorPagination, CatalogSearchPagination
+from backend.parsers import READERS, detect_format
+from backend.stock import StockError, checkout
+from backend.tasks import enqueue_import
+from backend.totals import refresh_order_totals
+from backend.transfer import TransferError, is_compressed, read_chunks, receive_upload, strip_compression
+from .serializers import ProductSerializer, ProductInfoSerializer, CategorySerializer, ShopSerializer, \
+    ImportJobSerializer, CatalogEntrySerializer, CATALOG_ENTRY_FIELDS, catalog_entry_values, catalog_fields, \
+    order_fieldsets, order_list_data
+
+
+# типы тела запроса, которые DRF разбирает в request.data; остальные принимаются как файл прайса
+FORM_CONTENT_TYPES = ('multipart/form-data', 'application/x-www-form-urlencoded', 'application/json')
 
 
 def register_view(request):
@@ -56,28 +79,63 @@ def users_view(request):
     context['user'] = user
     return render(request, base_template_users, context)
 
-class ProductAPIView(ModelViewSet):
+class CatalogCacheMixin:
+    """
+    Кэширование ответов списка и карточки. Изменение данных через API перестраивает затронутые строки
+    каталога по полю catalog_lookup предложения и сбрасывает версию каталога
+    """
+    catalog_lookup = None
+
+    @cached_response()
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @cached_response()
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        bump_catalog_version()
+
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        refresh_catalog(ProductInfo.objects.filter(**{self.catalog_lookup: serializer.instance}).values_list(
+            'id', flat=True))
+        bump_catalog_version()
+
+    def perform_destroy(self, instance):
+        super().perform_destroy(instance)
+        bump_catalog_version()
+
+
+class ProductAPIView(CatalogCacheMixin, ModelViewSet):
     "Список товаров"
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
+    catalog_lookup = 'product'
     ordering = ['id']
     search_fields = ['name']
 
-class CategoryAPIView(ModelViewSet):
+class CategoryAPIView(CatalogCacheMixin, ModelViewSet):
     "Список категорий"
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
+    catalog_lookup = 'product__category'
     search_fields = ['name']
 
-class ShopAPIView(ModelViewSet):
+class ShopAPIView(CatalogCacheMixin, ModelViewSet):
     "Список магазинов"
     queryset = Shop.objects.all()
     serializer_class = ShopSerializer
+    catalog_lookup = 'shop'
     ordering = ['name']
     search_fields = ['name']
 
 class PartnerOrdersAPIView(APIView):
     "Отображение заказов для поставщика"
+    renderer_classes = FAST_RENDERER_CLASSES
+
     def get(self, request, *args, **kwargs):
         if not request.user.is_authenticated:
             return JsonResponse({'Status': False,
@@ -85,52 +143,133 @@ class PartnerOrdersAPIView(APIView):
                                   status=403)
         if request.user.type != 'shop':
             return JsonResponse({'Status': False, 'Error': 'Only shops'}, status=403)
+        try:
+            fields, expand = order_fieldsets(request.query_params)
+        except ValueError as error:
+            return JsonResponse({'Status': False, 'Errors': str(error)}, status=400)
 
-        order = Order.objects.filter(ordered_items__product_info__shop__user_id=request.user.id).exclude(state='basket').prefetch_related('ordered_items__product_info__product__category')
-        serializer = OrderSerializer(order, many=True)
-        return Response(serializer.data)
+        # подзапрос вместо соединения: заказ с несколькими позициями магазина попадает в список один раз
+        order = Order.objects.filter(id__in=OrderItem.objects.filter(
+            product_info__shop__user_id=request.user.id).values('order_id')).exclude(status='basket')
+        return Response(order_list_data(order, fields, expand))
 
 class ProductInfoAPIView(viewsets.ReadOnlyModelViewSet):
     "Отображение информации о товаре"
     throttle_scope = 'anon'
-    serializer_class = ProductInfoSerializer
-    ordering = ('product')
+    serializer_class = CatalogEntrySerializer
+    pagination_class = CatalogCursorPagination
+    renderer_classes = FAST_RENDERER_CLASSES
 
     def get_queryset(self):
 
-        query = Q(shop__state=True)
+        query = Q(shop_state=True)
         shop_id = self.request.query_params.get('shop_id')
         category_id = self.request.query_params.get('category_id')
+        search = self.request.query_params.get('search', '').strip()
 
         if shop_id:
             query = query & Q(shop_id=shop_id)
 
         if category_id:
-            query = query & Q(product__category_id=category_id)
-
-        queryset = ProductInfo.objects.filter(query).select_related(
-            'shop', 'product__category'
-        ).prefetch_related(
-            'product_parameters__parameter'
-        ).distinct()
-
-        return queryset
+            query = query & Q(category_id=category_id)
+
+        # денормализованный каталог читается одним запросом без соединений
+        queryset = CatalogEntry.objects.filter(query)
+
+        # фильтры по цене, наличию и характеристикам param[...], param_min[...], param_max[...],
+        # разобранные в list и facets
+        queryset = queryset.filter(getattr(self, 'price_filters', Q()))
+        queryset = filter_parameters(queryset, getattr(self, 'parameter_filters', {}))
+
+        # поиск по названию, модели и характеристикам, результаты упорядочены по релевантности
+        # или по цене, если задан ordering; без поиска сортировку применяет CatalogCursorPagination
+        if search:
+            queryset = search_catalog(queryset, search, ordering=getattr(self, 'price_ordering', None))
+
+        # строки отдаются словарями values() без создания моделей, см. CatalogEntrySerializer;
+        # выбираются только столбцы полей из ?fields=, а для полного списка - только курсор и версия строки
+        return queryset.values(*catalog_entry_values(getattr(self, 'response_fields', CATALOG_ENTRY_FIELDS),
+                                                     self.use_fragments))
+
+    @property
+    def use_fragments(self):
+        "Полный список каталога собирается из кэша фрагментов JSON, выборочные поля и карточка - из строк"
+        return self.action == 'list' and len(getattr(self, 'response_fields', ())) == len(CATALOG_ENTRY_FIELDS)
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['fields'] = getattr(self, 'response_fields', CATALOG_ENTRY_FIELDS)
+        context['fragments'] = self.use_fragments
+        return context
+
+    def parse_filters(self, request):
+        """
+        Разбирает фильтры по цене, наличию и характеристикам, сортировку и поля ответа ?fields=;
+        неверный параметр - ValueError
+        """
+        self.price_filters = price_filters(request.query_params)
+        self.price_ordering = price_ordering(request.query_params)
+        self.parameter_filters = parameter_filters(request.query_params)
+        self.response_fields = catalog_fields(request.query_params)
+
+    @property
+    def paginator(self):
+        # результаты поиска отдаются по номеру страницы, обычный каталог - по курсору
+        if not hasattr(self, '_paginator'):
+            search = self.request.query_params.get('search', '').strip()
+            self._paginator = CatalogSearchPagination() if search else self.pagination_class()
+        return self._paginator
+
+    @cached_response(shop_param='shop_id')
+    def list(self, request, *args, **kwargs):
+        try:
+            self.parse_filters(request)
+        except ValueError as error:
+            return JsonResponse({'Status': False, 'Errors': str(error)}, status=400)
+        return super().list(request, *args, **kwargs)
+
+    @cached_response(shop_param='shop_id')
+    def retrieve(self, request, *args, **kwargs):
+        try:
+            self.response_fields = catalog_fields(request.query_params)
+        except ValueError as error:
+            return JsonResponse({'Status': False, 'Errors': str(error)}, status=400)
+        return super().retrieve(request, *args, **kwargs)
+
+    # в фасетах есть float, их JSONRenderer записывает иначе, чем orjson
+    @action(detail=False, renderer_classes=api_settings.DEFAULT_RENDERER_CLASSES)
+    @cached_response(shop_param='shop_id')
+    def facets(self, request, *args, **kwargs):
+        "Количество товаров по значениям характеристик с учетом текущих фильтров"
+        try:
+            self.parse_filters(request)
+            # поиск и фильтры по цене сужают фасеты до отобранных строк каталога
+            narrowed = request.query_params.get('search', '').strip() or self.price_filters
+            facets = catalog_facets(shop_id=request.query_params.get('shop_id'),
+                                    category_id=request.query_params.get('category_id'),
+                                    filters=self.parameter_filters, entries=self.get_queryset() if narrowed else None)
+        except ValueError as error:
+            return JsonResponse({'Status': False, 'Errors': str(error)}, status=400)
+        return Response(facets)
 
 
 class BasketAPIView(APIView):
     "Работа с корзиной для покупателя"
+    renderer_classes = FAST_RENDERER_CLASSES
+
     # отобразить корзину / get method
     def get(self, request, *args, **kwargs):
         if not request.user.is_authenticated:
             return JsonResponse({'Status': False, 'Error': 'Only for registered users'}, status=403)
-        basket = Order.objects.filter(
-            user_id=request.user.id, state='basket').prefetch_related(
-            'ordered_items__product_info__product__category')
-
-        serializer = OrderSerializer(basket, many=True)
-        return Response(serializer.data)
+        try:
+            fields, expand = order_fieldsets(request.query_params)
+        except ValueError as error:
+            return JsonResponse({'Status': False, 'Errors': str(error)}, status=400)
+        basket = Order.objects.filter(user_id=request.user.id, status='basket')
+        return Response(order_list_data(basket, fields, expand))
 
     # добавить позицию в корзину / post method
+    @idempotent
     def post(self, request, *args, **kwargs):
         if not request.user.is_authenticated:
             return JsonResponse({'Status': False, 'Error': 'Only for registered users'}, status=403)
@@ -138,25 +277,21 @@ class BasketAPIView(APIView):
         items = request.data.get('ordered_items')
 
         if items:
-            basket, created = Order.objects.get_or_create(user_id=request.user.id, state='basket')
-
-            objects_created = 0
-            for item in items:
-
-                exists_item = OrderItem.objects.filter(order=basket.id, product_info=item["product_info"])
-                if len(exists_item) > 0:
-                    return JsonResponse({'Status': False, 'Errors': f'Позиция product_info={item["product_info"]}'
-                                                                    f' уже есть в корзине'})
-
-                item.update({'order': basket.id})
-                serializer = OrderItemSerializer(data=item)
-                if serializer.is_valid():
-                    serializer.save()
-                    objects_created += 1
-                else:
-                    return JsonResponse({'Status': False, 'Errors': serializer.errors})
-
-            return JsonResponse({'Status': True, 'Создано позиций': objects_created})
+            if not isinstance(items, list) or len(items) > MAX_BASKET_ITEMS:
+                return JsonResponse({'Status': False, 'Errors': f'ordered_items: ожидается список '
+                                                                f'не длиннее {MAX_BASKET_ITEMS} позиций'}, status=400)
+            basket, created = Order.objects.get_or_create(user_id=request.user.id, status='basket')
+
+            # все позиции проверяются и добавляются вместе, результат - по каждой позиции
+            try:
+                results = add_basket_items(basket, items)
+            except IntegrityError:
+                return JsonResponse({'Status': False, 'Errors': 'Корзина изменена параллельным запросом, '
+                                                                'повторите запрос'}, status=409)
+            objects_created = sum(result['status'] == 'created' for result in results)
+
+            return JsonResponse({'Status': objects_created == len(results), 'Создано позиций': objects_created,
+                                 'Позиции': results})
 
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
@@ -168,13 +303,15 @@ class BasketAPIView(APIView):
         items = request.data.get('ordered_items')
 
         if items:
-            basket, created = Order.objects.get_or_create(user_id=request.user.id, state='basket')
+            basket, created = Order.objects.get_or_create(user_id=request.user.id, status='basket')
 
             query = Q()
             for item in items:
                 query = query | Q(order_id=basket.id, product_info=item["product_info"])
 
-            deleted_count = OrderItem.objects.filter(query).delete()[0]
+            with transaction.atomic():
+                deleted_count = OrderItem.objects.filter(query).delete()[0]
+                refresh_order_totals([basket.id])
 
             return JsonResponse({'Status': True, 'Удалено позиций': deleted_count})
 
@@ -188,33 +325,55 @@ class BasketAPIView(APIView):
         items = request.data.get('ordered_items')
 
         if items:
-            basket, created = Order.objects.get_or_create(user_id=request.user.id, state='basket')
+            if not isinstance(items, list) or len(items) > MAX_BASKET_ITEMS:
+                return JsonResponse({'Status': False, 'Errors': f'ordered_items: ожидается список '
+                                                                f'не длиннее {MAX_BASKET_ITEMS} позиций'}, status=400)
+            basket, created = Order.objects.get_or_create(user_id=request.user.id, status='basket')
 
-            objects_updated = 0
-            for item in items:
-                objects_updated += OrderItem.objects.filter(order_id=basket.id, product_info=item['product_info']).\
-                    update(quantity=item['quantity'])
+            # все количества записываются одним UPDATE, количество 0 удаляет позицию
+            results = update_basket_items(basket, items, key='product_info')
+            objects_updated = sum(result['status'] == 'updated' for result in results)
+            objects_deleted = sum(result['status'] == 'deleted' for result in results)
 
-                return JsonResponse({'Status': True, 'Обновлено объектов': objects_updated})
+            return JsonResponse({'Status': objects_updated + objects_deleted == len(results),
+                                 'Обновлено объектов': objects_updated, 'Удалено позиций': objects_deleted,
+                                 'Позиции': results})
 
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
+def order_version(request):
+    """
+    Версия списка заказов покупателя для условного GET: число заказов и время последнего изменения.
+    В список с ?expand=product_info входят цены и остатки каталога, поэтому в версию входит и версия каталога.
+    """
+    if not request.user.is_authenticated:
+        return None
+    versions = Order.objects.filter(user_id=request.user.id).exclude(status='basket').order_by().aggregate(
+        count=Count('id'), modified=Max('updated_at'))
+    modified = versions['modified']
+    version = f'orders{request.user.id}.{versions["count"]}.{modified.timestamp() if modified else 0}'
+    catalog, catalog_modified = catalog_version()
+    return f'{version}.{catalog}', max(filter(None, (modified, catalog_modified)), default=None)
+
 class OrderAPIView(APIView):
     "Заказы покупателя"
+    renderer_classes = FAST_RENDERER_CLASSES
+
+    @conditional_get(order_version)
     def get(self, request, *args, **kwargs):
         if not request.user.is_authenticated:
             return JsonResponse({'Status': False, 'Error': 'Только для зарегистрированных пользователей'}, status=403)
+        try:
+            fields, expand = order_fieldsets(request.query_params)
+        except ValueError as error:
+            return JsonResponse({'Status': False, 'Errors': str(error)}, status=400)
 
-        order = Order.objects.filter(
-            user_id=request.user.id).exclude(state='basket').prefetch_related(
-            'ordered_items__product_info__product__category',
-            'ordered_items__product_info__product_parameters__parameter').select_related('contact').distinct()
-
-        serializer = OrderSerializer(order, many=True)
+        order = Order.objects.filter(user_id=request.user.id).exclude(status='basket')
 
-        return Response(serializer.data)
+        return Response(order_list_data(order, fields, expand))
 
     # сделать новый заказ из корзины
+    @idempotent
     def post(self, request, *args, **kwargs):
         if not request.user.is_authenticated:
             return JsonResponse({'Status': False, 'Error': 'Только для зарегистрированных пользователей'}, status=403)
@@ -222,15 +381,22 @@ class OrderAPIView(APIView):
         id_order = request.data['id']
 
         if id_order:
-
-            data = Order.objects.filter(id=id_order, user=request.user.id, state='basket')
-
-            if len(data) == 0:
+            # partial=true - оформить то, что есть на складе, вместо отказа во всем заказе
+            partial = str(request.data.get('partial', '')).lower() in ('1', 'true', 'yes')
+
+            # корзина блокируется на время оформления, остатки списываются в той же транзакции
+            try:
+                results = checkout(Order.objects.filter(id=id_order, user=request.user.id), partial=partial)
+            except StockError as error:
+                return JsonResponse({'Status': False, 'Errors': str(error), 'Позиции': error.results}, status=409)
+            except IntegrityError:
+                return JsonResponse({'Status': False, 'Errors': 'Остатки изменены параллельным запросом, '
+                                                                'повторите запрос'}, status=409)
+
+            if results is None:
                 return JsonResponse({'Status': False, 'Errors': 'Не найдена корзина пользователя'})
 
-            data.update(state='new')
-
-            return JsonResponse({'Status': True})
+            return JsonResponse({'Status': True, 'Позиции': results})
 
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
@@ -244,35 +410,74 @@ class PartnerUpdateAPIView(APIView):
         if request.user.type != 'shop':
             return JsonResponse({'Status': False, 'Error': 'Only shop'}, status=403)
 
-        file = request.data.get('url')
+        # прайс передается загружаемым файлом file, текстом или ссылкой в поле url
+        # либо самим телом запроса с Content-Type прайса, параметры тогда берутся из строки запроса
+        content_type = request.content_type.split(';')[0].strip()
+        raw = bool(content_type) and content_type not in FORM_CONTENT_TYPES
+        params = request.query_params if raw else request.data
+
+        # incremental=true - обновить только изменившиеся товары вместо перезаливки каталога
+        incremental = str(params.get('incremental', '')).lower() in ('1', 'true', 'yes')
+
+        # формат можно указать явно, иначе он определяется по типу и имени файла или по ссылке
+        format = params.get('format')
+        job = ImportJob(user=request.user, incremental=incremental)
+        try:
+            if raw:
+                file = None
+                if request.stream is not None:
+                    name = params.get('name') or 'pricelist'
+                    compressed = (request.headers.get('Content-Encoding', '').lower() == 'gzip'
+                                  or is_compressed(name, content_type))
+                    file = receive_upload(read_chunks(request.stream), name, content_type, compressed)
+                    format = format or detect_format(file.name, None if compressed else content_type)
+            else:
+                file = request.FILES.get('file') or request.data.get('url')
+                if isinstance(file, str) and file.startswith(('http://', 'https://')):
+                    job.url = file
+                    format = format or detect_format(strip_compression(file))
+                elif isinstance(file, str) and file:
+                    format = format or 'yaml'
+                    file = ContentFile(file.encode(), name=f'pricelist.{format}')
+                elif file:
+                    if is_compressed(file.name, file.content_type):
+                        # сжатый прайс распаковывается при приеме, импорт читает обычный файл
+                        file = receive_upload(file.chunks(), file.name, compressed=True)
+                    elif file.size > settings.PRICELIST_MAX_SIZE:
+                        raise TransferError(f'Прайс больше допустимых {settings.PRICELIST_MAX_SIZE} байт')
+                    format = format or detect_format(file.name, file.content_type)
+        except TransferError as error:
+            return JsonResponse({'Status': False, 'Errors': str(error)})
 
         if file:
-            data = yaml.load(file, Loader=yaml.FullLoader)
-
-            shop, _ = Shop.objects.get_or_create(name=data['shop'], user_id=request.user.id)
-
-            for category in data['categories']:
-                category_object, _ = Category.objects.get_or_create(id=category['id'], name=category['name'])
-                category_object.shops.add(shop.id)
-                category_object.save()
-
-            ProductInfo.objects.filter(shop_id=shop.id).delete()
-            for item in data['goods']:
-                product, _ = Product.objects.get_or_create(name=item['name'], category_id=item['category'])
-
-                product_info = ProductInfo.objects.create(product_id=product.id,
-                                                          external_id=item['id'],
-                                                          model=item['model'],
-                                                          price=item['price'],
-                                                          price_rrc=item['price_rrc'],
-                                                          quantity=item['quantity'],
-                                                          shop_id=shop.id)
-                for name, value in item['parameters'].items():
-                    parameter_object, _ = Parameter.objects.get_or_create(name=name)
-                    ProductParameter.objects.create(product_info_id=product_info.id,
-                                                    parameter_id=parameter_object.id,
-                                                    value=value)
-
-            return JsonResponse({'Status': True})
+            if format not in READERS:
+                return JsonResponse({'Status': False, 'Errors': f'Неизвестный формат прайса {format}'})
+
+            # импорт выполняется в фоне, клиент получает id задачи для отслеживания статуса
+            job.format = format
+            if job.url:
+                job.save()
+            else:
+                job.source.save(file.name, file)
+                # временный файл уже перенесен в хранилище, закрытие не должно пытаться его удалить
+                file.close()
+            enqueue_import(job)
+
+            return JsonResponse({'Status': True, 'Job': job.id})
 
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
+
+
+class ImportJobAPIView(APIView):
+    "Статус и прогресс задачи импорта прайса"
+
+    def get(self, request, pk, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
+
+        job = ImportJob.objects.filter(id=pk, user_id=request.user.id).first()
+        if job is None:
+            return JsonResponse({'Status': False, 'Error': 'Задача не найдена'}, status=404)
+
+        serializer = ImportJobSerializer(job)
+        return Response(serializer.data)
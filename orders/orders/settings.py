@@ -37,6 +37,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'backend'
 ]
 
@@ -122,6 +123,41 @@ USE_TZ = True
 
 STATIC_URL = 'templates/'
 
+MEDIA_ROOT = BASE_DIR / 'media'
+
+MEDIA_URL = 'media/'
+
+# Количество процессов для фоновых задач импорта прайсов
+IMPORT_WORKERS = 2
+
+# Максимальный размер прайса после распаковки, байт
+PRICELIST_MAX_SIZE = 200 * 1024 * 1024
+
+# Таймаут соединения и чтения при скачивании прайса, секунд
+PRICELIST_DOWNLOAD_TIMEOUT = (5, 30)
+
+# Локальная память подходит для разработки и тестов; в продакшене кэш должен быть общим для всех процессов,
+# например django.core.cache.backends.redis.RedisCache или memcached
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+# Кэш ответов каталога и время хранения записей, секунд. Устаревшие записи отсекаются версией каталога,
+# таймаут только освобождает память
+CATALOG_CACHE = 'default'
+CATALOG_CACHE_TIMEOUT = 60 * 60
+
+# Сколько хранится ответ на запрос с заголовком Idempotency-Key, секунд: повтор с тем же ключом
+# в течение этого времени получает сохраненный ответ
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+
+# Сколько ключ без ответа считается занятым выполняющимся запросом, секунд. Если процесс запроса завершился,
+# не записав ответ, по истечении этого времени повтор с тем же ключом выполняется заново;
+# значение должно быть больше времени выполнения самого долгого запроса
+IDEMPOTENCY_KEY_LEASE = 5 * 60
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
@@ -0,0 +1,110 @@
+from django.db import transaction
+from django.db.models import Case, PositiveIntegerField, Value, When
+
+from backend.models import OrderItem, ProductInfo
+from backend.serializers import BasketItemSerializer, BasketQuantitySerializer
+from backend.totals import refresh_order_totals
+
+# сколько позиций можно передать в корзину одним запросом
+MAX_BASKET_ITEMS = 1000
+
+
+def add_basket_items(basket, items):
+    """
+    Добавляет в корзину basket позиции items - словари с product_info и quantity - за постоянное число запросов.
+
+    Сначала проверяются все позиции, затем одним запросом выбираются все указанные предложения и одним
+    запросом - позиции, которые уже есть в корзине. Остальные создаются одним bulk_create в транзакции.
+    Ошибка в одной позиции не мешает добавить другие. Возвращает результаты в порядке items:
+    {'product_info', 'status': 'created', 'id'} или {'product_info', 'status': 'error', 'errors'}.
+    Итоги корзины пересчитываются в той же транзакции. Позицию, добавленную параллельным запросом
+    между проверкой и записью, отклоняет уникальный индекс с IntegrityError, тогда транзакция откатывается целиком.
+    """
+    results, quantities = [], {}
+    for item in items:
+        serializer = BasketItemSerializer(data=item)
+        result = {'product_info': item.get('product_info') if isinstance(item, dict) else None}
+        results.append(result)
+        if not serializer.is_valid():
+            result.update(status='error', errors=serializer.errors)
+        elif serializer.validated_data['product_info'] in quantities:
+            result.update(status='error', errors={'product_info': ['Позиция повторяется в запросе']})
+        else:
+            quantities[serializer.validated_data['product_info']] = serializer.validated_data['quantity']
+            result['product_info'] = serializer.validated_data['product_info']
+
+    with transaction.atomic():
+        found = set(ProductInfo.objects.filter(id__in=quantities).values_list('id', flat=True))
+        existing = set(OrderItem.objects.filter(order_id=basket.id, product_info_id__in=found).values_list(
+            'product_info_id', flat=True))
+        created = OrderItem.objects.bulk_create([
+            OrderItem(order_id=basket.id, product_info_id=product_info_id, quantity=quantity)
+            for product_info_id, quantity in quantities.items()
+            if product_info_id in found and product_info_id not in existing
+        ])
+        if created:
+            refresh_order_totals([basket.id])
+    ids = {item.product_info_id: item.id for item in created}
+
+    for result in results:
+        if 'status' in result:
+            continue
+        if result['product_info'] not in found:
+            result.update(status='error', errors={'product_info': ['Предложение не найдено']})
+        elif result['product_info'] in existing:
+            result.update(status='error', errors={'product_info': ['Позиция уже есть в корзине']})
+        else:
+            result.update(status='created', id=ids.get(result['product_info']))
+    return results
+
+
+def update_basket_items(basket, items, key='id'):
+    """
+    Меняет количество позиций корзины basket за постоянное число запросов.
+
+    items - словари с key и quantity, где key - 'id' позиции заказа или 'product_info' предложения;
+    количество 0 удаляет позицию. В одной транзакции одним запросом блокируются найденные позиции,
+    затем все новые количества записываются одним UPDATE с CASE, а удаляемые позиции - одним DELETE,
+    и пересчитываются итоги корзины.
+    Возвращает результаты в порядке items: {key, 'status': 'updated' | 'deleted'} или {key, 'status': 'error', 'errors'}.
+    """
+    lookup = 'id' if key == 'id' else 'product_info_id'
+    results, quantities = [], {}
+    for item in items:
+        serializer = BasketQuantitySerializer(data=item)
+        result = {key: item.get(key) if isinstance(item, dict) else None}
+        results.append(result)
+        if not serializer.is_valid():
+            result.update(status='error', errors=serializer.errors)
+        elif key not in serializer.validated_data:
+            result.update(status='error', errors={key: ['Обязательное поле.']})
+        elif serializer.validated_data[key] in quantities:
+            result.update(status='error', errors={key: ['Позиция повторяется в запросе']})
+        else:
+            quantities[serializer.validated_data[key]] = serializer.validated_data['quantity']
+            result[key] = serializer.validated_data[key]
+
+    lines = OrderItem.objects.filter(order_id=basket.id)
+    with transaction.atomic():
+        existing = set(lines.filter(**{f'{lookup}__in': quantities}).select_for_update().values_list(
+            lookup, flat=True))
+        updated = {value: quantities[value] for value in existing if quantities[value]}
+        deleted = [value for value in existing if not quantities[value]]
+        if updated:
+            lines.filter(**{f'{lookup}__in': updated}).update(quantity=Case(
+                *[When(**{lookup: value}, then=Value(quantity)) for value, quantity in updated.items()],
+                output_field=PositiveIntegerField(),
+            ))
+        if deleted:
+            lines.filter(**{f'{lookup}__in': deleted}).delete()
+        if existing:
+            refresh_order_totals([basket.id])
+
+    for result in results:
+        if 'status' in result:
+            continue
+        if result[key] not in existing:
+            result.update(status='error', errors={key: ['Позиция не найдена в корзине']})
+        else:
+            result['status'] = 'updated' if quantities[result[key]] else 'deleted'
+    return results
@@ -0,0 +1,87 @@
+from tempfile import TemporaryFile
+
+from django.utils import timezone
+
+from backend.importer import PriceListImporter
+from backend.parsers import detect_format, read_pricelist
+from backend.transfer import is_compressed, start_download, strip_compression
+
+
+def fetch_feed(url, file, etag='', last_modified='', session=None):
+    """
+    Условный GET прайса: начинает скачивать его в file в фоне через пул соединений.
+    Если сервер ответил 304 Not Modified, возвращает None.
+    Формат прайса определяется по Content-Type ответа, а если он не подходит - по расширению в ссылке.
+    sha256 содержимого появляется в feed['hash'] после wait_feed.
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
+    download = start_download(url, file, headers=headers, session=session)
+    if download is None:
+        return None
+
+    content_type = download.response.headers.get('Content-Type')
+    return {
+        'etag': download.response.headers.get('ETag', ''),
+        'last_modified': download.response.headers.get('Last-Modified', ''),
+        'format': detect_format(strip_compression(url), None if is_compressed(url, content_type) else content_type),
+        'download': download,
+    }
+
+
+def wait_feed(feed):
+    "Дожидается окончания скачивания прайса и запоминает хеш его содержимого"
+    feed['hash'] = feed['download'].wait()['hash']
+    return feed
+
+
+def remember_feed(shop, url, feed):
+    """
+    Сохраняет у магазина ссылку и признаки версии прайса для следующей условной загрузки
+    """
+    shop.url = url
+    shop.feed_etag = feed['etag']
+    shop.feed_last_modified = feed['last_modified']
+    shop.feed_hash = feed['hash']
+    shop.feed_checked_at = timezone.now()
+    shop.save(update_fields=['url', 'feed_etag', 'feed_last_modified', 'feed_hash', 'feed_checked_at'])
+
+
+def sync_shop_feed(shop, session=None, force=False):
+    """
+    Проверяет прайс магазина по Shop.url и импортирует его только если он изменился.
+
+    Возвращает статус:
+    not_modified - сервер ответил 304, прайс не скачивался;
+    unchanged - прайс скачан, но его хеш совпал с предыдущим, разбор и запись в базу пропущены;
+    imported - прайс изменился и был импортирован инкрементально.
+    """
+    with TemporaryFile() as file:
+        if force:
+            feed = fetch_feed(shop.url, file, session=session)
+        else:
+            feed = fetch_feed(shop.url, file, shop.feed_etag, shop.feed_last_modified, session=session)
+
+        if feed is None:
+            shop.feed_checked_at = timezone.now()
+            shop.save(update_fields=['feed_checked_at'])
+            return {'shop': shop.id, 'status': 'not_modified'}
+
+        with feed['download']:
+            importer = PriceListImporter(shop.user_id, incremental=True)
+            if force or not shop.feed_hash:
+                # сравнивать не с чем, поэтому импорт идет прямо по мере скачивания
+                stats = importer.run(read_pricelist(feed['download'].open(), feed['format']))
+                wait_feed(feed)
+            else:
+                if wait_feed(feed)['hash'] == shop.feed_hash:
+                    remember_feed(shop, shop.url, feed)
+                    return {'shop': shop.id, 'status': 'unchanged'}
+                stats = importer.run(read_pricelist(file, feed['format']))
+
+    remember_feed(shop, shop.url, feed)
+    return {'shop': shop.id, 'status': 'imported', 'stats': stats}
@@ -0,0 +1,16 @@
+def parse_fields(params, available, name='fields', default=None):
+    """
+    Выборочные поля ответа: значения параметра запроса name через запятую, например fields=id,price,quantity.
+
+    Возвращает кортеж выбранных значений в порядке available, чтобы порядок полей в ответе не зависел
+    от запроса. Без параметра - default, по умолчанию все available. Неизвестное значение - ValueError.
+    """
+    value = params.get(name)
+    if value is None:
+        return tuple(available if default is None else default)
+    requested = {field.strip() for field in value.split(',') if field.strip()}
+    unknown = requested.difference(available)
+    if unknown:
+        raise ValueError(f'{name}: неизвестные поля {", ".join(sorted(unknown))}, '
+                         f'ожидаются {", ".join(available)}')
+    return tuple(field for field in available if field in requested)
@@ -0,0 +1,141 @@
+import json
+from datetime import timedelta
+from functools import wraps
+from hashlib import sha256
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+
+from backend.models import IdempotencyKey
+
+# наибольшая длина ключа, как у IdempotencyKey.key
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+# ответы с этими кодами не сохраняются, запрос можно повторить с тем же ключом
+RETRYABLE_STATUSES = {409, 429}
+
+
+def request_fingerprint(request):
+    "Отпечаток запроса по методу, пути и разобранным данным: повтор с тем же ключом должен совпадать с первым"
+    data = request.data
+    if hasattr(data, 'lists'):
+        data = dict(data.lists())
+    payload = json.dumps([request.method, request.path, data], sort_keys=True, ensure_ascii=False, default=str)
+    return sha256(payload.encode()).hexdigest()
+
+
+def expired_keys():
+    "Ключи идемпотентности старше settings.IDEMPOTENCY_KEY_TTL"
+    return IdempotencyKey.objects.filter(
+        created_at__lt=timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL))
+
+
+def claim_key(user_id, key, fingerprint):
+    """
+    Занимает ключ key пользователя за текущим запросом на settings.IDEMPOTENCY_KEY_LEASE секунд.
+
+    Возвращает запись ключа или None, если ключ уже получил ответ или занят другим запросом.
+    Ключ без ответа с истекшей арендой остался от запроса, процесс которого завершился, не записав ответ
+    и не удалив ключ: такой ключ блокируется select_for_update и занимается повтором с теми же данными,
+    а из параллельных повторов его получает только один.
+    """
+    now = timezone.now()
+    locked_until = now + timedelta(seconds=settings.IDEMPOTENCY_KEY_LEASE)
+    with transaction.atomic():
+        expired_keys().filter(user_id=user_id, key=key).delete()
+        try:
+            with transaction.atomic():
+                return IdempotencyKey.objects.create(user_id=user_id, key=key, fingerprint=fingerprint,
+                                                     locked_until=locked_until)
+        except IntegrityError:
+            # ключ уже записан другим запросом, выполненным, выполняющимся или прерванным
+            pass
+        record = IdempotencyKey.objects.select_for_update().filter(
+            Q(locked_until__lt=now) | Q(locked_until__isnull=True),
+            user_id=user_id, key=key, fingerprint=fingerprint, status_code__isnull=True).first()
+        if record is not None:
+            record.locked_until = locked_until
+            record.save(update_fields=['locked_until'])
+        return record
+
+
+def held(record):
+    """
+    Запись ключа, пока она занята этим запросом: если аренда истекла и ключ занял повтор,
+    ответ и удаление ключа этим запросом его не затрагивают
+    """
+    return IdempotencyKey.objects.filter(id=record.id, locked_until=record.locked_until, status_code__isnull=True)
+
+
+def is_stored(response):
+    "Сохраняются ответы, кроме ошибок сервера и ответов, после которых запрос стоит повторить"
+    return response.status_code < 500 and response.status_code not in RETRYABLE_STATUSES
+
+
+def idempotent(method):
+    """
+    Заголовок Idempotency-Key для изменяющих методов представления, например оформления заказа.
+
+    Первый запрос с ключом занимает ключ без ответа отдельной короткой транзакцией (claim_key), затем метод
+    выполняется как обычно, со своими транзакциями: блокировки оформления и отправка писем не ждут записи ответа.
+    Ответ сохраняется после выполнения метода, а при ошибке сервера, исключении или ответе, после которого
+    запрос стоит повторить, ключ удаляется. Повтор с тем же ключом в течение settings.IDEMPOTENCY_KEY_TTL
+    получает сохраненный ответ с заголовком Idempotent-Replayed, метод не вызывается и таблицы заказов
+    не читаются; пока первый запрос выполняется, повтор получает 409, а после истечения аренды ключа
+    без ответа выполняется заново. Ключ с другими данными запроса - ошибка 422.
+    Без заголовка и для анонимного пользователя метод вызывается как обычно.
+    """
+
+    @wraps(method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None or not request.user.is_authenticated:
+            return method(self, request, *args, **kwargs)
+        if not 0 < len(key) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+            return JsonResponse({'Status': False, 'Errors': f'Idempotency-Key: ожидается строка '
+                                                            f'не длиннее {IDEMPOTENCY_KEY_MAX_LENGTH} символов'},
+                                status=400)
+
+        fingerprint = request_fingerprint(request)
+        record = claim_key(request.user.id, key, fingerprint)
+        if record is None:
+            return replay(request, key, fingerprint)
+
+        try:
+            response = method(self, request, *args, **kwargs)
+        except BaseException:
+            held(record).delete()
+            raise
+        if not is_stored(response):
+            held(record).delete()
+            return response
+
+        # Response из DRF получает формат ответа и содержимое только в dispatch, после метода представления
+        if not getattr(response, 'is_rendered', True):
+            response = self.finalize_response(request, response, *args, **kwargs)
+            response.render()
+        held(record).update(status_code=response.status_code, content_type=response.get('Content-Type', ''),
+                            content=response.content)
+        return response
+
+    return wrapper
+
+
+def replay(request, key, fingerprint):
+    """
+    Сохраненный ответ на запрос пользователя с ключом key; 422 для других данных запроса,
+    даже если первый запрос еще выполняется, иначе 409, пока он выполняется
+    """
+    record = IdempotencyKey.objects.filter(user_id=request.user.id, key=key).first()
+    if record is not None and record.fingerprint != fingerprint:
+        return JsonResponse({'Status': False, 'Errors': 'Idempotency-Key уже использован '
+                                                        'с другими данными запроса'}, status=422)
+    if record is None or record.status_code is None:
+        return JsonResponse({'Status': False, 'Errors': 'Запрос с этим Idempotency-Key еще выполняется, '
+                                                        'повторите запрос'}, status=409)
+    response = HttpResponse(bytes(record.content), status=record.status_code, content_type=record.content_type)
+    response['Idempotent-Replayed'] = 'true'
+    return response
@@ -0,0 +1,365 @@
+from contextlib import contextmanager
+from itertools import islice
+from time import perf_counter
+
+from django.db import transaction
+
+from backend.caching import bump_catalog_version
+from backend.catalog import refresh_catalog, rename_catalog_categories
+from backend.models import Shop, Category, Product, ProductInfo, Parameter, ProductParameter, CatalogEntry
+from backend.parsers import PriceListFormatError
+from backend.totals import refresh_basket_totals
+
+# размер пачки для bulk_create и для запросов вида id__in
+BATCH_SIZE = 1000
+
+# поля ProductInfo, которые сравниваются при инкрементальном импорте
+PRODUCT_INFO_FIELDS = ('product_id', 'model', 'price', 'price_rrc', 'quantity')
+
+# счетчики импорта, ненулевое значение которых означает изменение каталога
+CATALOG_CHANGE_COUNTS = ('categories_created', 'categories_renamed', 'product_infos_created',
+                         'product_infos_updated', 'product_infos_deleted', 'product_parameters_created',
+                         'product_parameters_updated', 'product_parameters_deleted')
+
+
+def chunked(iterable, size):
+    "Разбивает последовательность на списки длиной не больше size"
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class Interner:
+    """
+    Кеш ключ -> id справочной таблицы на время одного импорта.
+
+    preload загружает существующие строки одним запросом, resolve отдает id из памяти
+    и создает недостающие строки одним bulk_create на пачку товаров.
+    """
+
+    def __init__(self, model, fields, batch_size=BATCH_SIZE):
+        self.model = model
+        self.fields = fields
+        self.batch_size = batch_size
+        self.ids = {}
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+
+    def make_key(self, values):
+        return tuple(values) if len(self.fields) > 1 else values[0]
+
+    def split_key(self, key):
+        return key if len(self.fields) > 1 else (key,)
+
+    def load(self, queryset, keys=None):
+        for *values, pk in queryset.order_by().values_list(*self.fields, 'id'):
+            key = self.make_key(values)
+            if keys is None or key in keys:
+                self.ids[key] = pk
+
+    def preload(self, queryset):
+        "Загружает существующие строки одним запросом"
+        self.load(queryset)
+
+    def resolve(self, keys):
+        "Возвращает словарь ключ -> id, ключи, которых нет в базе, создаются"
+        keys = set(keys)
+        missing = keys - self.ids.keys()
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+        if not missing:
+            return self.ids
+
+        lookups = {f'{field}__in': {self.split_key(key)[index] for key in missing}
+                   for index, field in enumerate(self.fields)}
+        # строки, созданные параллельными импортами после preload, не считаются созданными этим импортом
+        self.load(self.model.objects.filter(**lookups), missing)
+        absent = missing - self.ids.keys()
+        if absent:
+            # общие для магазинов строки вставляются с ignore_conflicts и в отсортированном порядке,
+            # чтобы параллельные импорты не падали на дублях и не блокировали друг друга крест-накрест
+            self.model.objects.bulk_create(
+                [self.model(**dict(zip(self.fields, self.split_key(key)))) for key in sorted(absent)],
+                batch_size=self.batch_size, ignore_conflicts=True)
+            # id перечитываются, так как строку мог создать параллельный импорт
+            self.load(self.model.objects.filter(**lookups), absent)
+            self.created += len(absent)
+        return self.ids
+
+    def stats(self):
+        return {'size': len(self.ids), 'hits': self.hits, 'misses': self.misses, 'created': self.created}
+
+
+class PriceListImporter:
+    """
+    Импорт прайса поставщика пачками.
+
+    Существующие продукты и параметры загружаются в память одним запросом в начале импорта,
+    недостающие создаются одним запросом на пачку товаров.
+    ProductInfo и ProductParameter пишутся через bulk_create в одной транзакции.
+
+    В инкрементальном режиме (incremental=True) каталог магазина не пересоздается:
+    товары сопоставляются с существующими по external_id и в базу уходят только
+    добавленные, измененные и удаленные строки.
+
+    progress - необязательная функция, которая вызывается после каждой пачки
+    с количеством обработанных товаров.
+    """
+
+    def __init__(self, user_id, batch_size=BATCH_SIZE, incremental=False, progress=None):
+        self.user_id = user_id
+        self.batch_size = batch_size
+        self.incremental = incremental
+        self.progress = progress
+        self.counts = {
+            'goods': 0,
+            'categories': 0,
+            'categories_created': 0,
+            'categories_renamed': 0,
+            'products_created': 0,
+            'parameters_created': 0,
+            'product_infos_created': 0,
+            'product_infos_updated': 0,
+            'product_infos_unchanged': 0,
+            'product_infos_deleted': 0,
+            'product_parameters_created': 0,
+            'product_parameters_updated': 0,
+            'product_parameters_deleted': 0,
+        }
+        self.timings = {}
+        # предложения, строки каталога для выдачи которых нужно перестроить
+        self.catalog_ids = set()
+        # категории удаленных предложений: их строки каталога удаляются каскадно, а фасеты нужно пересчитать
+        self.deleted_categories = set()
+        self.products = Interner(Product, ('name', 'category_id'), batch_size)
+        self.parameters = Interner(Parameter, ('name',), batch_size)
+
+    @contextmanager
+    def stage(self, name):
+        "Замер времени этапа импорта, время этапов суммируется по всем пачкам"
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0) + perf_counter() - started
+
+    def run(self, data):
+        """
+        Импортирует прайс вида {'shop': ..., 'categories': [...], 'goods': [...]}.
+        goods может быть любым итерируемым объектом, он читается пачками по batch_size.
+        Возвращает количество записей и время по этапам.
+        """
+        started = perf_counter()
+        with transaction.atomic():
+            with self.stage('shop'):
+                shop = self.get_shop(data['shop'])
+            with self.stage('categories'):
+                self.import_categories(shop, data['categories'])
+            with self.stage('preload'):
+                self.products.preload(Product.objects.filter(
+                    category_id__in=[category['id'] for category in data['categories']]))
+                self.parameters.preload(Parameter.objects.all())
+            if self.incremental:
+                self.sync_goods(shop, data['goods'])
+            else:
+                self.replace_goods(shop, data['goods'])
+            with self.stage('catalog'):
+                refresh_catalog(self.catalog_ids, batch_size=self.batch_size, categories=self.deleted_categories)
+            # корзины показывают текущие цены, позиции удаленных предложений удалены вместе с ними
+            if self.counts['product_infos_updated'] or self.counts['product_infos_deleted']:
+                with self.stage('order_totals'):
+                    refresh_basket_totals([shop.id])
+            # версия меняется в той же транзакции, поэтому кэш не увидит новую версию раньше новых данных
+            if any(self.counts[name] for name in CATALOG_CHANGE_COUNTS):
+                # категории общие для всех магазинов, их переименование меняет каталоги всех магазинов
+                bump_catalog_version(None if self.counts['categories_renamed'] else [shop.id])
+        self.timings['total'] = perf_counter() - started
+        return self.stats(shop)
+
+    def stats(self, shop):
+        return {
+            'shop': shop.id,
+            'incremental': self.incremental,
+            'counts': self.counts,
+            'cache': {'products': self.products.stats(), 'parameters': self.parameters.stats()},
+            'timings': {name: round(value, 4) for name, value in self.timings.items()},
+        }
+
+    def get_shop(self, name):
+        if self.user_id is None:
+            # импорт без пользователя (manage.py import_pricelists) обновляет магазин с тем же названием
+            return Shop.objects.filter(name=name).order_by('id').first() or Shop.objects.create(name=name)
+        shop, _ = Shop.objects.get_or_create(name=name, user_id=self.user_id)
+        return shop
+
+    def import_categories(self, shop, categories):
+        "Создает недостающие категории, переименовывает измененные и привязывает их к магазину"
+        names = {category['id']: category['name'] for category in categories}
+        existing = dict(Category.objects.filter(id__in=names).values_list('id', 'name'))
+
+        # как и в Interner.resolve, строки вставляются с ignore_conflicts и в отсортированном порядке
+        created = [Category(id=category_id, name=name) for category_id, name in sorted(names.items())
+                   if category_id not in existing]
+        renamed = [Category(id=category_id, name=name) for category_id, name in sorted(names.items())
+                   if category_id in existing and existing[category_id] != name]
+        Category.objects.bulk_create(created, batch_size=self.batch_size, ignore_conflicts=True)
+        Category.objects.bulk_update(renamed, ['name'], batch_size=self.batch_size)
+        self.counts['categories_created'] += len(created)
+        self.counts['categories_renamed'] += len(renamed)
+        rename_catalog_categories(renamed)
+
+        through = Category.shops.through
+        through.objects.bulk_create(
+            [through(category_id=category_id, shop_id=shop.id) for category_id in names],
+            batch_size=self.batch_size, ignore_conflicts=True)
+        self.counts['categories'] += len(names)
+
+    def resolve_references(self, goods):
+        "id продуктов и параметров для пачки товаров"
+        with self.stage('products'):
+            products = self.products.resolve([(item['name'], item['category']) for item in goods])
+            self.counts['products_created'] = self.products.created
+        with self.stage('parameters'):
+            parameters = self.parameters.resolve([name for item in goods for name in item['parameters']])
+            self.counts['parameters_created'] = self.parameters.created
+        return products, parameters
+
+    def goods_processed(self, count):
+        self.counts['goods'] += count
+        if self.progress:
+            self.progress(self.counts['goods'])
+
+    def replace_goods(self, shop, goods):
+        "Полная перезапись каталога магазина"
+        with self.stage('cleanup'):
+            self.deleted_categories.update(
+                CatalogEntry.objects.filter(shop_id=shop.id).values_list('category_id', flat=True).distinct())
+            self.counts['product_infos_deleted'] += ProductInfo.objects.filter(shop_id=shop.id).delete()[1].get(
+                ProductInfo._meta.label, 0)
+        for chunk in chunked(goods, self.batch_size):
+            products, parameters = self.resolve_references(chunk)
+            self.create_goods(shop, chunk, products, parameters)
+            self.goods_processed(len(chunk))
+
+    def sync_goods(self, shop, goods):
+        "Инкрементальное обновление каталога магазина по external_id"
+        with self.stage('diff'):
+            stale = set(ProductInfo.objects.filter(shop_id=shop.id).values_list('external_id', flat=True))
+        seen = set()
+        for chunk in chunked(goods, self.batch_size):
+            for item in chunk:
+                if item['id'] in seen:
+                    raise PriceListFormatError(f'Товар с id {item["id"]} встречается в прайсе несколько раз')
+                seen.add(item['id'])
+            products, parameters = self.resolve_references(chunk)
+            with self.stage('diff'):
+                existing = {
+                    row[1]: row for row in ProductInfo.objects.filter(
+                        shop_id=shop.id, external_id__in={item['id'] for item in chunk}).values_list(
+                        'id', 'external_id', *PRODUCT_INFO_FIELDS)
+                }
+            self.create_goods(shop, [item for item in chunk if item['id'] not in existing], products, parameters)
+            self.update_goods([item for item in chunk if item['id'] in existing], existing, products, parameters)
+            stale.difference_update(item['id'] for item in chunk)
+            self.goods_processed(len(chunk))
+
+        with self.stage('cleanup'):
+            for external_ids in chunked(stale, self.batch_size):
+                self.deleted_categories.update(CatalogEntry.objects.filter(
+                    shop_id=shop.id, external_id__in=external_ids).values_list('category_id', flat=True).distinct())
+                self.counts['product_infos_deleted'] += ProductInfo.objects.filter(
+                    shop_id=shop.id, external_id__in=external_ids).delete()[1].get(ProductInfo._meta.label, 0)
+
+    @staticmethod
+    def product_info_values(item, products):
+        "Значения полей PRODUCT_INFO_FIELDS для товара из прайса"
+        return (products[(item['name'], item['category'])], item['model'], item['price'], item['price_rrc'],
+                item['quantity'])
+
+    @staticmethod
+    def parameter_values(item, parameters):
+        "Словарь parameter_id -> value для товара из прайса"
+        return {parameters[name]: str(value) for name, value in item['parameters'].items()}
+
+    def create_goods(self, shop, goods, products, parameters):
+        "Записывает новые товары: ProductInfo и их параметры"
+        if not goods:
+            return
+        with self.stage('product_infos'):
+            ProductInfo.objects.bulk_create(
+                [ProductInfo(shop_id=shop.id, external_id=item['id'],
+                             **dict(zip(PRODUCT_INFO_FIELDS, self.product_info_values(item, products))))
+                 for item in goods],
+                batch_size=self.batch_size)
+            # id вставленных строк выбираются отдельно, так как не все СУБД возвращают их из bulk_create
+            product_info_ids = {
+                (product_id, external_id): product_info_id
+                for product_info_id, product_id, external_id in ProductInfo.objects.filter(
+                    shop_id=shop.id, external_id__in={item['id'] for item in goods}).values_list(
+                    'id', 'product_id', 'external_id')
+            }
+
+        with self.stage('product_parameters'):
+            product_parameters = [
+                ProductParameter(
+                    product_info_id=product_info_ids[(products[(item['name'], item['category'])], item['id'])],
+                    parameter_id=parameter_id,
+                    value=value)
+                for item in goods for parameter_id, value in self.parameter_values(item, parameters).items()
+            ]
+            ProductParameter.objects.bulk_create(product_parameters, batch_size=self.batch_size)
+
+        self.catalog_ids.update(product_info_ids.values())
+        self.counts['product_infos_created'] += len(goods)
+        self.counts['product_parameters_created'] += len(product_parameters)
+
+    def update_goods(self, goods, existing, products, parameters):
+        "Сравнивает товары с текущими строками базы и записывает только отличия"
+        if not goods:
+            return
+        with self.stage('product_infos'):
+            changed = []
+            for item in goods:
+                row = existing[item['id']]
+                values = self.product_info_values(item, products)
+                if values != row[2:]:
+                    changed.append(ProductInfo(id=row[0], **dict(zip(PRODUCT_INFO_FIELDS, values))))
+            ProductInfo.objects.bulk_update(changed, PRODUCT_INFO_FIELDS, batch_size=self.batch_size)
+            self.catalog_ids.update(product_info.id for product_info in changed)
+            self.counts['product_infos_updated'] += len(changed)
+            self.counts['product_infos_unchanged'] += len(goods) - len(changed)
+
+        with self.stage('product_parameters'):
+            current = {}
+            for product_parameter_id, product_info_id, parameter_id, value in ProductParameter.objects.filter(
+                    product_info_id__in=[row[0] for row in existing.values()]).values_list(
+                    'id', 'product_info_id', 'parameter_id', 'value'):
+                current.setdefault(product_info_id, {})[parameter_id] = (product_parameter_id, value)
+
+            to_create, to_update, to_delete = [], [], []
+            for item in goods:
+                product_info_id = existing[item['id']][0]
+                old = current.get(product_info_id, {})
+                new = self.parameter_values(item, parameters)
+                for parameter_id, value in new.items():
+                    if parameter_id not in old:
+                        to_create.append(ProductParameter(product_info_id=product_info_id,
+                                                          parameter_id=parameter_id, value=value))
+                    elif old[parameter_id][1] != value:
+                        to_update.append(ProductParameter(id=old[parameter_id][0], value=value))
+                to_delete.extend(old[parameter_id][0] for parameter_id in old.keys() - new.keys())
+                if {parameter_id: value for parameter_id, (_, value) in old.items()} != new:
+                    self.catalog_ids.add(product_info_id)
+
+            ProductParameter.objects.bulk_create(to_create, batch_size=self.batch_size)
+            ProductParameter.objects.bulk_update(to_update, ['value'], batch_size=self.batch_size)
+            if to_delete:
+                ProductParameter.objects.filter(id__in=to_delete).delete()
+
+        self.counts['product_parameters_created'] += len(to_create)
+        self.counts['product_parameters_updated'] += len(to_update)
+        self.counts['product_parameters_deleted'] += len(to_delete)
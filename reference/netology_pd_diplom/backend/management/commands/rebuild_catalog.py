@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from backend.caching import bump_catalog_version
+from backend.catalog import CATALOG_BATCH_SIZE, rebuild_catalog
+from backend.models import CatalogEntry, ProductInfo
+
+
+class Command(BaseCommand):
+    help = 'Перестраивает денормализованный каталог для выдачи, например после обновления или ручной правки базы'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shop', type=int, action='append', dest='shops', help='id магазина')
+        parser.add_argument('--batch-size', type=int, default=CATALOG_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        product_infos = ProductInfo.objects.all()
+        if options['shops']:
+            product_infos = product_infos.filter(shop_id__in=options['shops'])
+
+        with transaction.atomic():
+            rebuild_catalog(product_infos, batch_size=options['batch_size'])
+            bump_catalog_version(options['shops'])
+
+        entries = CatalogEntry.objects.all()
+        if options['shops']:
+            entries = entries.filter(shop_id__in=options['shops'])
+        self.stdout.write(f'Строк каталога: {entries.count()}')
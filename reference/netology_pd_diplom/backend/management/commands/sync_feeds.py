@@ -0,0 +1,47 @@
+from time import sleep
+
+from django.core.management.base import BaseCommand
+
+from backend.feeds import sync_shop_feed
+from backend.models import Shop
+from backend.transfer import get_session
+
+
+class Command(BaseCommand):
+    help = 'Проверяет прайсы магазинов по Shop.url и импортирует только изменившиеся'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Повторять проверку каждые N секунд (0 - проверить один раз)')
+        parser.add_argument('--shop', type=int, action='append', dest='shops', help='id магазина')
+        parser.add_argument('--force', action='store_true', help='Импортировать без проверки изменений')
+
+    def handle(self, *args, **options):
+        # одна сессия с пулом соединений на все магазины и все проверки
+        session = get_session()
+        while True:
+            self.sync(session, options['shops'], options['force'])
+            if not options['interval']:
+                return
+            sleep(options['interval'])
+
+    def sync(self, session, shop_ids, force):
+        shops = Shop.objects.exclude(url__isnull=True).exclude(url='')
+        if shop_ids:
+            shops = shops.filter(id__in=shop_ids)
+
+        for shop in shops:
+            try:
+                result = sync_shop_feed(shop, session=session, force=force)
+            except Exception as error:
+                # ошибка одного магазина не должна останавливать проверку остальных
+                self.stderr.write(f'{shop}: ошибка синхронизации прайса: {error}')
+                continue
+
+            if result['status'] == 'imported':
+                counts = result['stats']['counts']
+                self.stdout.write(f'{shop}: прайс импортирован, добавлено {counts["product_infos_created"]}, '
+                                  f'изменено {counts["product_infos_updated"]}, '
+                                  f'удалено {counts["product_infos_deleted"]}')
+            else:
+                self.stdout.write(f'{shop}: прайс не изменился ({result["status"]})')
@@ -1,7 +1,13 @@
 # Верстальщик
+from operator import itemgetter
+
 from rest_framework import serializers
 
-from backend.models import User, Category, Shop, ProductInfo, Product, ProductParameter, OrderItem, Order, Contact
+from backend.caching import cached_fragments
+from backend.fieldsets import parse_fields
+from backend.models import User, Category, Shop, ProductInfo, Product, ProductParameter, OrderItem, Order, Contact, \
+    ImportJob, CatalogEntry
+from backend.renderers import render_fragment
 
 
 class ContactSerializer(serializers.ModelSerializer):
@@ -63,6 +69,98 @@ class ProductInfoSerializer(serializers.ModelSerializer):
         read_only_fields = ('id',)
 
 
+# поля ответа каталога в порядке ProductInfoSerializer: столбцы CatalogEntry для values(), из которых
+# собирается поле, и сборка поля из строки. Список каталога отдается без создания моделей
+CATALOG_ENTRY_FIELDS = {
+    'id': (('pk',), itemgetter('pk')),
+    'model': (('model',), itemgetter('model')),
+    'product': (('product_name', 'category_name'), lambda entry: {
+        'name': entry['product_name'], 'category': entry['category_name']}),
+    'shop': (('shop_id',), itemgetter('shop_id')),
+    'quantity': (('quantity',), itemgetter('quantity')),
+    'price': (('price',), itemgetter('price')),
+    'price_rrc': (('price_rrc',), itemgetter('price_rrc')),
+    'product_parameters': (('parameters',), lambda entry: [
+        {'parameter': name, 'value': value} for name, value in entry['parameters']]),
+}
+
+# pk нужен CatalogCursorPagination для курсора, price и price_rrc - для курсора при сортировке по цене
+CATALOG_CURSOR_VALUES = ('pk', 'price', 'price_rrc')
+
+
+def catalog_entry_values(fields=tuple(CATALOG_ENTRY_FIELDS), fragments=False):
+    """
+    Столбцы CatalogEntry для values(): нужные полям ответа fields и курсору страниц.
+    Для списка из кэша фрагментов - только курсор и время изменения строки, см. CatalogEntryListSerializer
+    """
+    if fragments:
+        return CATALOG_CURSOR_VALUES + ('updated_at',)
+    columns = [column for field in fields for column in CATALOG_ENTRY_FIELDS[field][0]]
+    return tuple(dict.fromkeys(CATALOG_CURSOR_VALUES + tuple(columns)))
+
+
+CATALOG_ENTRY_VALUES = catalog_entry_values()
+
+
+def catalog_fields(params):
+    "Поля ответа каталога из ?fields=id,price,quantity, без параметра - все; неизвестное поле - ValueError"
+    return parse_fields(params, tuple(CATALOG_ENTRY_FIELDS))
+
+
+def catalog_entry_fragments(entries):
+    """
+    Готовый JSON строк каталога entries - словарей с pk и updated_at - из кэша фрагментов.
+    Ключ фрагмента - предложение и время изменения строки: перестроенная при импорте строка получает новый ключ.
+    Строки, которых нет в кэше, выбираются одним запросом и сериализуются один раз.
+    """
+    def build(pks):
+        serializer = CatalogEntrySerializer()
+        return {entry['pk']: render_fragment(serializer.to_representation(entry))
+                for entry in CatalogEntry.objects.filter(pk__in=pks).values(*CATALOG_ENTRY_VALUES)}
+
+    return cached_fragments(
+        {entry['pk']: f'catalog-entry:{entry["pk"]}:{entry["updated_at"].timestamp()}' for entry in entries}, build)
+
+
+class CatalogEntryListSerializer(serializers.ListSerializer):
+    """
+    Список строк каталога. С context['fragments'] строки страницы содержат только курсор и время изменения,
+    а ответ собирается из готовых фрагментов JSON: цена сериализации списка почти не зависит от вложенности строки
+    """
+
+    def to_representation(self, data):
+        if self.context.get('fragments'):
+            return catalog_entry_fragments(data)
+        return super().to_representation(data)
+
+
+# строка денормализованного каталога из values(*catalog_entry_values(fields)) в том же виде,
+# что и ProductInfoSerializer; в ответе только поля из context['fields'], по умолчанию все
+class CatalogEntrySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = CatalogEntry
+        fields = ('product_info', 'model', 'product', 'shop', 'quantity', 'price', 'price_rrc', 'parameters',)
+        read_only_fields = fields
+        list_serializer_class = CatalogEntryListSerializer
+
+    def to_representation(self, entry):
+        fields = self.context.get('fields', CATALOG_ENTRY_FIELDS)
+        return {field: CATALOG_ENTRY_FIELDS[field][1](entry) for field in fields}
+
+
+class BasketItemSerializer(serializers.Serializer):
+    "Позиция для добавления в корзину; проверяется без запросов, предложения выбираются сразу для всех позиций"
+    product_info = serializers.IntegerField(min_value=1)
+    quantity = serializers.IntegerField(min_value=1)
+
+
+class BasketQuantitySerializer(serializers.Serializer):
+    "Новое количество позиции корзины, найденной по id позиции или по product_info; 0 - удалить позицию"
+    id = serializers.IntegerField(min_value=1, required=False)
+    product_info = serializers.IntegerField(min_value=1, required=False)
+    quantity = serializers.IntegerField(min_value=0)
+
+
 class OrderItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = OrderItem
@@ -87,3 +185,103 @@ class OrderSerializer(serializers.ModelSerializer):
         model = Order
         fields = ('id', 'ordered_items', 'state', 'dt', 'total_sum', 'contact',)
         read_only_fields = ('id',)
+
+
+# поля контакта в порядке ContactSerializer, без write_only поля user
+CONTACT_VALUES = ('id', 'city', 'street', 'house', 'structure', 'building', 'apartment', 'phone')
+
+# поля списка заказов в порядке OrderSerializer и вложенные объекты, которые раскрываются по ?expand=
+ORDER_FIELDS = ('id', 'ordered_items', 'state', 'dt', 'total_sum', 'contact')
+ORDER_EXPAND = ('product_info', 'product_parameters', 'contact')
+
+# поля предложения в позиции заказа в порядке ProductInfoSerializer, кроме характеристик
+ORDER_PRODUCT_VALUES = ('product_info__model', 'product_info__product__name', 'product_info__product__category__name',
+                        'product_info__shop_id', 'product_info__quantity', 'product_info__price',
+                        'product_info__price_rrc')
+
+
+def order_fieldsets(params):
+    """
+    Поля ответа из ?fields= и раскрываемые объекты из ?expand= для списка заказов; неверное значение - ValueError.
+    По умолчанию все поля и все вложенные объекты, как в OrderSerializer. Нераскрытые предложение
+    и контакт отдаются идентификаторами, без product_parameters в предложении нет характеристик.
+    """
+    return parse_fields(params, ORDER_FIELDS), parse_fields(params, ORDER_EXPAND, 'expand')
+
+
+def shop_total(shop_totals, shop_ids):
+    "Сумма позиций магазинов shop_ids по shop_totals заказа, None, если их позиций в заказе нет"
+    totals = [shop_totals[str(shop_id)] for shop_id in shop_ids if str(shop_id) in shop_totals]
+    return sum(totals) if totals else None
+
+
+def order_list_data(orders, fields=ORDER_FIELDS, expand=ORDER_EXPAND, shop_ids=None):
+    """
+    Заказы orders в том же виде, что OrderSerializer(orders, many=True).data, без моделей и вложенных сериализаторов.
+
+    Заказы, позиции с товарами, характеристики и контакты выбираются через values_list() четырьмя запросами
+    и собираются в словари за один проход. Одинаковые товары в разных позициях собираются один раз.
+    prefetch_related для orders не нужен.
+
+    В ответе только поля fields, а из вложенных объектов раскрываются только expand: запросы и соединения
+    для остальных не выполняются. total_sum читается из строки заказа, для магазинов shop_ids - сумма их позиций.
+    """
+    dt = serializers.DateTimeField()
+    rows = list(orders.prefetch_related(None).values_list(
+        'id', 'state', 'dt', 'contact_id', 'total_sum' if shop_ids is None else 'shop_totals'))
+
+    items, products = {}, {}
+    if 'ordered_items' in fields and 'product_info' in expand:
+        for order_id, item_id, quantity, product_info_id, *product_info in OrderItem.objects.filter(
+                order_id__in={row[0] for row in rows}).order_by('id').values_list(
+                'order_id', 'id', 'quantity', 'product_info_id', *ORDER_PRODUCT_VALUES):
+            if product_info_id not in products:
+                model, name, category, product_shop_id, in_stock, price, price_rrc = product_info
+                products[product_info_id] = {
+                    'id': product_info_id,
+                    'model': model,
+                    'product': {'name': name, 'category': category},
+                    'shop': product_shop_id,
+                    'quantity': in_stock,
+                    'price': price,
+                    'price_rrc': price_rrc,
+                }
+                if 'product_parameters' in expand:
+                    products[product_info_id]['product_parameters'] = []
+            items.setdefault(order_id, []).append(
+                {'id': item_id, 'product_info': products[product_info_id], 'quantity': quantity})
+    elif 'ordered_items' in fields:
+        for order_id, item_id, quantity, product_info_id in OrderItem.objects.filter(
+                order_id__in={row[0] for row in rows}).order_by('id').values_list(
+                'order_id', 'id', 'quantity', 'product_info_id'):
+            items.setdefault(order_id, []).append({'id': item_id, 'product_info': product_info_id, 'quantity': quantity})
+
+    if products and 'product_parameters' in expand:
+        for product_info_id, name, value in ProductParameter.objects.filter(
+                product_info_id__in=products).order_by('id').values_list('product_info_id', 'parameter__name', 'value'):
+            products[product_info_id]['product_parameters'].append({'parameter': name, 'value': value})
+
+    contacts = {}
+    if 'contact' in fields and 'contact' in expand:
+        contacts = {row[0]: dict(zip(CONTACT_VALUES, row)) for row in Contact.objects.filter(
+            id__in={row[3] for row in rows if row[3] is not None}).values_list(*CONTACT_VALUES)}
+
+    data = [{
+        'id': order_id,
+        'ordered_items': items.get(order_id, []),
+        'state': state,
+        'dt': dt.to_representation(created),
+        'total_sum': total if shop_ids is None else shop_total(total, shop_ids),
+        'contact': contacts.get(contact_id) if 'contact' in expand else contact_id,
+    } for order_id, state, created, contact_id, total in rows]
+    if fields != ORDER_FIELDS:
+        data = [{field: order[field] for field in fields} for order in data]
+    return data
+
+
+class ImportJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ImportJob
+        fields = ('id', 'url', 'state', 'incremental', 'goods_processed', 'goods_total', 'stats', 'error',
+                  'bytes_processed', 'bytes_total', 'created_at', 'started_at', 'finished_at',)
+        read_only_fields = fields
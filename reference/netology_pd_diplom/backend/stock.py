@@ -0,0 +1,102 @@
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, PositiveIntegerField, Value, When
+from django.utils import timezone
+
+from backend.caching import bump_catalog_version
+from backend.catalog import update_catalog_quantities
+from backend.models import Order, OrderItem, ProductInfo
+from backend.totals import refresh_order_totals
+
+
+class StockError(Exception):
+    "Остатков не хватает для оформления заказа; results - результаты резервирования по позициям"
+
+    def __init__(self, results):
+        super().__init__('Недостаточно товара на складе')
+        self.results = results
+
+
+def quantity_case(quantities, lookup):
+    "CASE lookup WHEN ключ THEN количество для словаря quantities"
+    return Case(*[When(**{lookup: key}, then=Value(quantity)) for key, quantity in quantities.items()],
+                output_field=PositiveIntegerField())
+
+
+def reserve_stock(order_id, partial=False):
+    """
+    Списывает остатки предложений под позиции заказа order_id, вызывается внутри транзакции оформления.
+
+    Предложения блокируются одним SELECT ... FOR UPDATE в порядке id: параллельные оформления с общими
+    предложениями ждут друг друга без взаимоблокировок и видят остатки после чужого списания. Затем все
+    остатки уменьшаются одним условным UPDATE ... WHERE quantity >= n, строки каталога получают новые остатки.
+
+    Если остатка не хватает, без partial заказ не резервируется целиком и выбрасывается StockError.
+    С partial количество позиции уменьшается до остатка, позиция без остатка удаляется из заказа,
+    StockError - только если не зарезервировано ничего. Возвращает результаты по позициям в порядке
+    предложений: {'product_info', 'quantity', 'reserved', 'status': 'reserved' | 'partial' | 'rejected'}.
+    """
+    lines = list(OrderItem.objects.filter(order_id=order_id).order_by('product_info_id').values_list(
+        'product_info_id', 'quantity'))
+    stock = {row[0]: row[1:] for row in ProductInfo.objects.filter(
+        id__in=[product_info_id for product_info_id, _ in lines]).select_for_update().order_by('id').values_list(
+        'id', 'quantity', 'shop_id')}
+
+    results, reserved = [], {}
+    for product_info_id, quantity in lines:
+        available = stock.get(product_info_id, (0, None))[0]
+        count = quantity if available >= quantity else available if partial else 0
+        if count:
+            reserved[product_info_id] = count
+        results.append({
+            'product_info': product_info_id,
+            'quantity': quantity,
+            'reserved': count,
+            'status': 'reserved' if count == quantity else 'partial' if count else 'rejected',
+        })
+    if lines and (not reserved or not partial and len(reserved) < len(lines)):
+        raise StockError(results)
+
+    if reserved:
+        case = quantity_case(reserved, 'id')
+        updated = ProductInfo.objects.filter(id__in=reserved, quantity__gte=case).update(
+            quantity=F('quantity') - case)
+        # остатки заблокированы, поэтому условие может не выполниться, только если их изменили в обход блокировки
+        if updated != len(reserved):
+            raise IntegrityError('Остатки предложений изменились во время резервирования')
+        update_catalog_quantities({product_info_id: stock[product_info_id][0] - count
+                                   for product_info_id, count in reserved.items()})
+        # версия каталога меняется после фиксации: строка магазина не блокируется до конца оформления
+        shop_ids = {stock[product_info_id][1] for product_info_id in reserved}
+        transaction.on_commit(lambda: bump_catalog_version(shop_ids))
+
+    cut = {result['product_info']: result['reserved'] for result in results if result['status'] != 'reserved'}
+    if cut:
+        items = OrderItem.objects.filter(order_id=order_id)
+        kept = {product_info_id: count for product_info_id, count in cut.items() if count}
+        dropped = [product_info_id for product_info_id, count in cut.items() if not count]
+        if kept:
+            items.filter(product_info_id__in=kept).update(quantity=quantity_case(kept, 'product_info_id'))
+        if dropped:
+            items.filter(product_info_id__in=dropped).delete()
+        refresh_order_totals([order_id])
+    return results
+
+
+def checkout(baskets, partial=False, **values):
+    """
+    Оформляет заказ из корзины: baskets - QuerySet корзин пользователя, обычно отобранный по id.
+
+    В одной транзакции корзина блокируется, остатки резервируются через reserve_stock, затем статус меняется
+    на new и записываются values, например contact_id. Повторное оформление той же корзины ждет блокировки
+    и уже не находит корзину. Возвращает результаты резервирования по позициям, без корзины - None.
+    Если остатков не хватает, транзакция откатывается и выбрасывается StockError, при неверном внешнем ключе
+    в values - IntegrityError.
+    """
+    with transaction.atomic():
+        order_id = baskets.filter(state='basket').select_for_update().order_by('id').values_list(
+            'id', flat=True).first()
+        if order_id is None:
+            return None
+        results = reserve_stock(order_id, partial)
+        Order.objects.filter(id=order_id).update(state='new', updated_at=timezone.now(), **values)
+    return results
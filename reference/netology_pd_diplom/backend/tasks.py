@@ -0,0 +1,137 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from tempfile import TemporaryFile
+
+import django
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, transaction
+from django.utils import timezone
+
+from backend.feeds import fetch_feed, remember_feed, wait_feed
+from backend.importer import PriceListImporter
+from backend.models import ImportJob, Shop
+from backend.parsers import read_pricelist
+
+_executor = None
+
+
+def create_executor(max_workers):
+    """
+    Пул процессов с настроенным Django.
+    Процессы запускаются через spawn, чтобы не наследовать соединения с базой родителя.
+    """
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=get_context('spawn'), initializer=django.setup)
+
+
+def get_executor():
+    """
+    Пул процессов для фоновых задач, создается при первом обращении
+    """
+    global _executor
+    if _executor is None:
+        _executor = create_executor(settings.IMPORT_WORKERS)
+    return _executor
+
+
+def enqueue_import(job):
+    """
+    Отправляет задачу импорта в пул после фиксации транзакции, в которой она создана
+    """
+    transaction.on_commit(lambda: get_executor().submit(do_import, job.id))
+
+
+class ProgressReporter:
+    """
+    Пишет прогресс задачи через отдельное соединение с базой.
+    Импорт идет в одной транзакции, и изменения в ней не видны другим запросам до ее завершения.
+    Число товаров в прайсе заранее неизвестно, поэтому долю выполненной работы показывает
+    позиция чтения прайса из его размера.
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.stream = None
+        self.total = None
+        self.connection = connections.create_connection(DEFAULT_DB_ALIAS)
+        quote_name = self.connection.ops.quote_name
+        self.sql = 'UPDATE {table} SET {goods} = %s, {read} = %s, {total} = %s WHERE id = %s'.format(
+            table=quote_name(ImportJob._meta.db_table), goods=quote_name('goods_processed'),
+            read=quote_name('bytes_processed'), total=quote_name('bytes_total'))
+
+    def track(self, stream, total=None):
+        """
+        Прогресс в байтах считается по позиции чтения stream; total - размер прайса, если он известен
+        """
+        self.stream = stream
+        self.total = total
+        return stream
+
+    def __call__(self, goods_processed):
+        if self.connection.vendor == 'sqlite':
+            # SQLite не допускает второго пишущего соединения во время транзакции импорта
+            return
+        bytes_processed = self.stream.tell() if self.stream is not None else 0
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute(self.sql, [goods_processed, bytes_processed, self.total, self.job_id])
+        except DatabaseError:
+            # прогресс не обязателен, импорт не должен падать из-за него
+            pass
+
+    def close(self):
+        self.connection.close()
+
+
+def do_import(job_id):
+    """
+    Фоновый импорт прайса по ссылке из задачи.
+    Если прайс не изменился с прошлой загрузки по этой ссылке, разбор и запись в базу пропускаются.
+    """
+    job = ImportJob.objects.get(id=job_id)
+    job.state = 'running'
+    job.started_at = timezone.now()
+    job.save(update_fields=['state', 'started_at'])
+
+    shop = Shop.objects.filter(user_id=job.user_id, url=job.url).first()
+    progress = ProgressReporter(job.id)
+    try:
+        with TemporaryFile() as file:
+            if shop and job.incremental:
+                feed = fetch_feed(job.url, file, shop.feed_etag, shop.feed_last_modified)
+            else:
+                # полная перезаливка каталога выполняется всегда
+                feed = fetch_feed(job.url, file)
+
+            if feed is None:
+                job.stats = {'shop': shop.id, 'unchanged': True}
+            else:
+                with feed['download']:
+                    importer = PriceListImporter(job.user_id, incremental=job.incremental, progress=progress)
+                    if shop and job.incremental and shop.feed_hash:
+                        # хеш известен только после скачивания, поэтому прайс сначала докачивается целиком
+                        if wait_feed(feed)['hash'] == shop.feed_hash:
+                            job.stats = {'shop': shop.id, 'unchanged': True}
+                        else:
+                            stream = progress.track(file, feed['download'].size)
+                            job.stats = importer.run(read_pricelist(stream, feed['format']))
+                    else:
+                        # сравнивать не с чем, поэтому импорт идет прямо по мере скачивания
+                        stream = progress.track(feed['download'].open(), feed['download'].length)
+                        job.stats = importer.run(read_pricelist(stream, feed['format']))
+                        wait_feed(feed)
+                if 'counts' in job.stats:
+                    remember_feed(Shop.objects.get(id=job.stats['shop']), job.url, feed)
+    except Exception as error:
+        job.state = 'failed'
+        job.error = str(error)
+    else:
+        job.state = 'done'
+        if 'counts' in job.stats:
+            # прайс читается один раз, поэтому общее число товаров известно только после импорта
+            job.goods_processed = job.goods_total = job.stats['counts']['goods']
+            job.bytes_processed = job.bytes_total = feed['download'].size
+    finally:
+        progress.close()
+
+    job.finished_at = timezone.now()
+    job.save()
@@ -1,3 +1,427 @@
-from django.test import TestCase
+import gzip
+import io
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core import mail
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Sum
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from requests import Session
+from rest_framework.authtoken.models import Token
+
+from backend.caching import get_cache
+from backend.catalog import search_catalog
+from backend.feeds import sync_shop_feed
+from backend.importer import PriceListImporter
+from backend.models import CatalogEntry, CatalogFacet, Contact, IdempotencyKey, ImportJob, Order, OrderItem, \
+    ProductInfo, ProductParameter, Shop, User
+from backend.parsers import read_pricelist
+from backend.stock import StockError, checkout
+from backend.tasks import do_import
+from backend.totals import refresh_order_totals
+from backend.transfer import CHUNK_SIZE, TransferError, read_chunks, receive_upload, start_download
+
+# прайс из комплекта проекта: один магазин, три категории, четыре товара
+PRICELIST = Path(settings.BASE_DIR).parent.parent / 'data' / 'shop1.yaml'
+
+
+def create_shop_user(email='shop@example.com'):
+    return User.objects.create_user(email, 'password', type='shop', is_active=True)
+
+
+def import_pricelist(user, content=None, incremental=False):
+    """
+    Импорт прайса content, по умолчанию data/shop1.yaml, от имени пользователя магазина
+    """
+    content = PRICELIST.read_bytes() if content is None else content
+    return PriceListImporter(user.id, incremental=incremental).run(read_pricelist(io.BytesIO(content)))
+
+
+class ImportJobTest(TestCase):
+    def setUp(self):
+        self.user = create_shop_user()
+
+    def test_resume_fail_marks_unfinished_jobs(self):
+        queued = ImportJob.objects.create(user=self.user, url='https://example.com/a.yaml')
+        running = ImportJob.objects.create(user=self.user, url='https://example.com/b.yaml', state='running')
+        done = ImportJob.objects.create(user=self.user, url='https://example.com/c.yaml', state='done')
+
+        call_command('resume_import_jobs', '--fail', stdout=StringIO())
+
+        states = dict(ImportJob.objects.values_list('id', 'state'))
+        self.assertEqual(states, {queued.id: 'failed', running.id: 'failed', done.id: 'done'})
+        self.assertTrue(ImportJob.objects.get(id=running.id).finished_at)
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(test, do_get):
+    "Локальный HTTP-сервер с обработчиком do_get(handler) на время теста; возвращает его адрес"
+    server = ThreadingHTTPServer(('127.0.0.1', 0), type('Handler', (QuietHandler,), {'do_GET': do_get}))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    test.addCleanup(server.server_close)
+    test.addCleanup(server.shutdown)
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+def send(handler, body, status=200, **headers):
+    handler.send_response(status)
+    headers.setdefault('Content-Length', str(len(body)))
+    for name, value in headers.items():
+        handler.send_header(name.replace('_', '-'), value)
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+class TransferTest(SimpleTestCase):
+    def download(self, url, **kwargs):
+        file = tempfile.TemporaryFile()
+        self.addCleanup(file.close)
+        download = start_download(url, file, session=Session(), **kwargs)
+        if download is not None:
+            self.addCleanup(download.close)
+        return download
+
+    def test_not_modified(self):
+        def do_get(handler):
+            if handler.headers.get('If-None-Match') == '"v1"':
+                send(handler, b'', status=304)
+            else:
+                send(handler, b'shop: x', ETag='"v1"')
+        url = serve(self, do_get)
+
+        self.assertEqual(self.download(url + '/shop.yaml').wait()['size'], 7)
+        self.assertIsNone(self.download(url + '/shop.yaml', headers={'If-None-Match': '"v1"'}))
+
+    def test_oversized_content_length(self):
+        url = serve(self, lambda handler: send(handler, b'x' * 100))
+        with override_settings(PRICELIST_MAX_SIZE=10), self.assertRaises(TransferError):
+            self.download(url + '/shop.yaml')
+
+    def test_gzip(self):
+        body = b'shop: x\n' * 10000
+        url = serve(self, lambda handler: send(handler, gzip.compress(body), Content_Type='application/gzip'))
+
+        download = self.download(url + '/shop.yaml.gz')
+        self.assertEqual(download.wait(), {'size': len(body), 'hash': sha256(body).hexdigest()})
+        self.assertEqual(download.file.read(), body)
+
+        # ограничение применяется к распакованному размеру
+        with override_settings(PRICELIST_MAX_SIZE=1000), self.assertRaises(TransferError):
+            self.download(url + '/shop.yaml.gz').wait()
+
+    def test_truncated_gzip(self):
+        data = gzip.compress(b'shop: x\n' * 10000)
+        url = serve(self, lambda handler: send(handler, data[:len(data) // 2], Content_Type='application/gzip'))
+        with self.assertRaisesMessage(TransferError, 'оборван'):
+            self.download(url + '/shop.yaml.gz').wait()
+
+    def test_read_while_downloading(self):
+        head, tail = b'a' * CHUNK_SIZE * 2, b'b' * CHUNK_SIZE
+        release = threading.Event()
+
+        def do_get(handler):
+            handler.send_response(200)
+            handler.send_header('Content-Length', str(len(head) + len(tail)))
+            handler.end_headers()
+            handler.wfile.write(head)
+            handler.wfile.flush()
+            # вторая часть отдается только после того, как читатель получил первую
+            release.wait(10)
+            handler.wfile.write(tail)
+        url = serve(self, do_get)
+
+        download = self.download(url + '/shop.yaml')
+        reader = download.open()
+        self.assertEqual(reader.read(len(head)), head)
+        self.assertFalse(download.done)
+        release.set()
+        self.assertEqual(reader.read(), tail)
+        self.assertEqual(download.wait()['hash'], sha256(head + tail).hexdigest())
+
+    def test_receive_upload(self):
+        body = b'shop: x\n' * 10000
+        upload = receive_upload(read_chunks(io.BytesIO(gzip.compress(body))), 'shop.yaml.gz', compressed=True)
+        self.addCleanup(upload.close)
+        self.assertEqual((upload.name, upload.size, upload.read()), ('shop.yaml', len(body), body))
+        with self.assertRaises(TransferError):
+            receive_upload(read_chunks(io.BytesIO(body)), 'shop.yaml', max_size=100)
+
+
+class FeedSyncTest(TestCase):
+    def test_conditional_get_and_hash(self):
+        feed = {'etag': '"v1"', 'body': PRICELIST.read_bytes()}
+        requests = []
+
+        def do_get(handler):
+            requests.append(handler.headers.get('If-None-Match'))
+            if handler.headers.get('If-None-Match') == feed['etag']:
+                send(handler, b'', status=304)
+            else:
+                send(handler, feed['body'], ETag=feed['etag'], Content_Type='application/x-yaml')
+        url = serve(self, do_get)
+        shop = Shop.objects.create(name='Связной', user=create_shop_user(), url=url + '/shop1.yaml')
+        session = Session()
+
+        self.assertEqual(sync_shop_feed(shop, session=session)['status'], 'imported')
+        self.assertEqual(ProductInfo.objects.filter(shop=shop).count(), 4)
+        shop.refresh_from_db()
+        self.assertEqual((shop.feed_etag, shop.feed_hash), ('"v1"', sha256(feed['body']).hexdigest()))
+
+        self.assertEqual(sync_shop_feed(shop, session=session)['status'], 'not_modified')
+
+        # новый ETag с тем же содержимым: прайс скачивается, но не импортируется
+        feed['etag'] = '"v2"'
+        self.assertEqual(sync_shop_feed(shop, session=session)['status'], 'unchanged')
+
+        feed['etag'], feed['body'] = '"v3"', feed['body'].replace(b'price: 110000', b'price: 100000')
+        result = sync_shop_feed(shop, session=session)
+        self.assertEqual(result['status'], 'imported')
+        self.assertEqual(result['stats']['counts']['product_infos_updated'], 1)
+        self.assertEqual(requests, [None, '"v1"', '"v1"', '"v2"'])
+
+
+class ImportDownloadTest(TestCase):
+    def test_url_job_imports_while_downloading(self):
+        feed = {'etag': '"v1"'}
+        body = PRICELIST.read_bytes()
+        url = serve(self, lambda handler: send(handler, body, ETag=feed['etag'], Content_Type='application/x-yaml'))
+        user = create_shop_user()
+        job = ImportJob.objects.create(user=user, url=url + '/shop1.yaml')
+
+        with mock.patch('backend.tasks.read_pricelist', wraps=read_pricelist) as reader:
+            do_import(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual((job.state, job.goods_processed, job.goods_total), ('done', 4, 4), job.error)
+        # прайс разбирается один раз, прямо из скачиваемого потока
+        self.assertEqual(reader.call_count, 1)
+        self.assertIsInstance(reader.call_args.args[0], io.BufferedReader)
+        self.assertEqual(Shop.objects.get(user=user).feed_hash, sha256(body).hexdigest())
+
+        # тот же прайс с новым ETag: скачивается, но по хешу не импортируется
+        feed['etag'] = '"v2"'
+        job = ImportJob.objects.create(user=user, url=url + '/shop1.yaml', incremental=True)
+        with mock.patch('backend.tasks.read_pricelist', wraps=read_pricelist) as reader:
+            do_import(job.id)
+        job.refresh_from_db()
+        self.assertEqual((job.state, job.stats.get('unchanged')), ('done', True), job.error)
+        self.assertEqual(reader.call_count, 0)
+
+
+class CatalogTest(TestCase):
+    def setUp(self):
+        self.user = create_shop_user()
+        import_pricelist(self.user)
+
+    def test_parameters_keep_product_order(self):
+        items = self.client.get('/api/v1/products').json()['results']
+
+        expected = {}
+        for product_info_id, name, value in ProductParameter.objects.order_by('id').values_list(
+                'product_info_id', 'parameter__name', 'value'):
+            expected.setdefault(product_info_id, []).append({'parameter': name, 'value': value})
+        self.assertEqual({item['id']: item['product_parameters'] for item in items}, expected)
+        # jsonb упорядочил бы ключи объекта по длине, и первым оказался бы Цвет
+        self.assertEqual(items[0]['product_parameters'][0]['parameter'], 'Диагональ (дюйм)')
+
+    def test_search_by_parameter_value(self):
+        items = self.client.get('/api/v1/products', {'search': 'золотистый'}).json()['results']
+        self.assertEqual([item['model'] for item in items], ['apple/iphone/xs-max'])
+
+    def test_search_ordering_covers_all_matches(self):
+        entries = CatalogEntry.objects.filter(shop_state=True)
+        expected = sorted(entries.filter(product_name__icontains='смартфон').values_list('price', 'pk'))
+        self.assertGreater(len(expected), 1)
+        # сортировка по цене не ограничивается первыми candidates совпадениями
+        found = search_catalog(entries, 'смартфон', candidates=1, ordering=('price', 'pk'))
+        self.assertEqual(list(found.values_list('price', 'pk')), expected)
+
+        items = self.client.get('/api/v1/products', {'search': 'смартфон', 'ordering': '-price'}).json()['results']
+        self.assertEqual([(item['price'], item['id']) for item in items],
+                         [(price, pk) for price, pk in reversed(expected)])
+
+    def test_facets_follow_deleted_offers(self):
+        data = read_pricelist(io.BytesIO(PRICELIST.read_bytes()))
+        facets = CatalogFacet.objects.filter(category_id=224)
+        self.assertEqual(facets.aggregate(Sum('count'))['count__sum'], ProductParameter.objects.count())
+
+        # строки каталога удаленных предложений удаляются каскадно, фасеты их категорий пересчитываются
+        data['goods'] = list(data['goods'])[:1]
+        PriceListImporter(self.user.id, incremental=True).run(data)
+        self.assertEqual(ProductInfo.objects.count(), 1)
+        self.assertEqual(facets.aggregate(Sum('count'))['count__sum'], ProductParameter.objects.count())
+
+        data['goods'] = []
+        PriceListImporter(self.user.id).run(data)
+        self.assertFalse(facets.exists())
+
+
+class PartnerOrdersTest(TestCase):
+    def test_total_covers_partner_items(self):
+        partner, other = create_shop_user(), create_shop_user('other@example.com')
+        import_pricelist(partner)
+        import_pricelist(other)
+        buyer = User.objects.create_user('buyer@example.com', 'password', is_active=True)
+        order = Order.objects.create(user=buyer, state='new')
+        own, foreign = ProductInfo.objects.get(shop__user=partner, price=110000), \
+            ProductInfo.objects.get(shop__user=other, price=110000)
+        OrderItem.objects.bulk_create([OrderItem(order=order, product_info=own, quantity=2),
+                                       OrderItem(order=order, product_info=foreign, quantity=1)])
+        refresh_order_totals([order.id])
+
+        token = Token.objects.create(user=partner)
+        response = self.client.get('/api/v1/partner/orders', HTTP_AUTHORIZATION=f'Token {token.key}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(item['id'], item['total_sum']) for item in response.json()], [(order.id, 220000)])
+
+
+class CheckoutConcurrencyTest(TransactionTestCase):
+    "Одновременные оформления корзин с одним предложением, каждое в своем соединении"
+
+    def setUp(self):
+        import_pricelist(create_shop_user())
+        self.product_info = ProductInfo.objects.get(price=110000)
+        ProductInfo.objects.filter(id=self.product_info.id).update(quantity=5)
+
+    def place_baskets(self, count, quantity, partial):
+        "count покупателей одновременно оформляют корзины по quantity единиц; результаты, отказ - None"
+        baskets = []
+        for number in range(count):
+            buyer = User.objects.create_user(f'buyer{number}@example.com', 'password', is_active=True)
+            basket = Order.objects.create(user=buyer, state='basket')
+            OrderItem.objects.create(order=basket, product_info=self.product_info, quantity=quantity)
+            baskets.append(basket.id)
+        barrier = threading.Barrier(count)
+
+        def place(basket_id):
+            barrier.wait()
+            try:
+                return checkout(Order.objects.filter(id=basket_id), partial=partial)
+            except StockError:
+                return None
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(count) as pool:
+            return list(pool.map(place, baskets))
+
+    def assertStockLeft(self, quantity):
+        self.assertEqual(ProductInfo.objects.get(id=self.product_info.id).quantity, quantity)
+        self.assertEqual(CatalogEntry.objects.get(product_info_id=self.product_info.id).quantity, quantity)
+        self.assertEqual(OrderItem.objects.filter(order__state='new').aggregate(Sum('quantity'))['quantity__sum'],
+                         5 - quantity)
+
+    def test_no_oversell(self):
+        results = self.place_baskets(8, 2, partial=False)
+        self.assertEqual(sum(result is not None for result in results), 2)
+        self.assertStockLeft(1)
+
+    def test_partial_takes_rest(self):
+        results = self.place_baskets(8, 2, partial=True)
+        self.assertEqual(sorted(result[0]['reserved'] for result in results if result), [1, 2, 2])
+        self.assertStockLeft(0)
+
+
+class IdempotencyTest(TransactionTestCase):
+    "Idempotency-Key без общей транзакции: оформление и письмо о заказе не зависят от записи ответа"
+
+    def setUp(self):
+        import_pricelist(create_shop_user())
+        self.product_info = ProductInfo.objects.get(price=110000)
+        self.buyer = User.objects.create_user('buyer@example.com', 'password', is_active=True)
+        self.token = Token.objects.create(user=self.buyer)
+        self.contact = Contact.objects.create(user=self.buyer, city='Москва', street='Тверская', phone='+7900')
+        self.basket = Order.objects.create(user=self.buyer, state='basket')
+        OrderItem.objects.create(order=self.basket, product_info=self.product_info, quantity=2)
+
+    def place(self, key, contact_id=None):
+        return self.client.post('/api/v1/order', {'id': self.basket.id, 'contact': contact_id or self.contact.id},
+                                HTTP_AUTHORIZATION=f'Token {self.token.key}', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_replay(self):
+        first = self.place('order-1')
+        self.assertEqual((first.status_code, first.json()['Status']), (200, True))
+        second = self.place('order-1')
+        self.assertEqual((second.content, second['Idempotent-Replayed']), (first.content, 'true'))
+        self.assertEqual(ProductInfo.objects.get(id=self.product_info.id).quantity, self.product_info.quantity - 2)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_invalid_contact(self):
+        # внешний ключ проверяется при фиксации транзакции оформления, до ответа представления
+        response = self.place('order-1', self.contact.id + 100)
+        self.assertEqual(response.json()['Status'], False)
+        self.assertEqual(Order.objects.get(id=self.basket.id).state, 'basket')
+        self.assertEqual(ProductInfo.objects.get(id=self.product_info.id).quantity, self.product_info.quantity)
+
+
+class CatalogPlanTest(TestCase):
+    """
+    Планы запросов страницы каталога с фильтрами и сортировкой по цене.
+    Проверяется запрос, который выполняет само представление с CatalogCursorPagination. В тестовой базе
+    всего несколько строк, поэтому последовательное чтение и сортировка отключаются: если подходящего
+    индекса нет, в плане остаются Seq Scan или Sort.
+    """
+    # параметры запроса каталога и индекс, по которому должна выбираться страница
+    CASES = (
+        ('ordering=price', 'catalog_price_idx'),
+        ('ordering=-price', 'catalog_price_idx'),
+        ('ordering=price_rrc', 'catalog_price_rrc_idx'),
+        ('price_min=100000&price_max=200000&in_stock=true&ordering=price', 'catalog_price_idx'),
+        ('shop_id={shop}&ordering=price', 'catalog_price_idx'),
+        ('category_id={category}&ordering=price', 'catalog_category_price_idx'),
+        ('category_id={category}&ordering=-price_rrc', 'catalog_category_price_rrc_idx'),
+        ('category_id={category}&price_min=50000&price_max=150000&ordering=price', 'catalog_category_price_idx'),
+        ('shop_id={shop}&category_id={category}&in_stock=true&ordering=-price', 'catalog_shop_price_idx'),
+    )
+
+    def setUp(self):
+        self.user = create_shop_user()
+        self.shop_id = import_pricelist(self.user)['shop']
+
+    def explain(self, url):
+        "План запроса страницы, который выполняет представление по адресу url"
+        get_cache().clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        pages = [query['sql'] for query in queries
+                 if query['sql'].startswith('SELECT') and 'FROM "backend_catalogentry"' in query['sql']
+                 and ' LIMIT ' in query['sql']]
+        self.assertEqual(len(pages), 1, pages)
+        with connection.cursor() as cursor:
+            for setting in ('enable_seqscan', 'enable_bitmapscan', 'enable_sort'):
+                cursor.execute(f'SET LOCAL {setting} = off')
+            cursor.execute('EXPLAIN ' + pages[0])
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+            cursor.execute('RESET ALL')
+        return response, plan
+
+    def test_price_pages_use_indexes(self):
+        for params, index in self.CASES:
+            params = params.format(shop=self.shop_id, category=224)
+            with self.subTest(params):
+                response, plan = self.explain('/api/v1/products?page_size=2&' + params)
+                self.assertIn(index, plan)
+                self.assertNotIn('Seq Scan', plan)
+                self.assertNotRegex(plan, r'\bSort\s+\(')
+
+                # следующая страница выбирается по курсору с ценой тем же индексом
+                next_url = response.json()['next']
+                if next_url:
+                    _, plan = self.explain(next_url)
+                    self.assertIn(index, plan)
+                    self.assertNotRegex(plan, r'\bSort\s+\(')
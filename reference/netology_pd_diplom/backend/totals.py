@@ -0,0 +1,52 @@
+from django.db.models import F, Sum
+
+from backend.models import Order, OrderItem
+
+# сколько заказов пересчитывается одним запросом
+ORDER_TOTALS_BATCH_SIZE = 1000
+
+
+def order_totals(order_ids):
+    """
+    Итоги заказов order_ids одним запросом по позициям: {order_id: {'total_sum', 'item_count', 'shop_totals'}}.
+
+    Суммы считаются по текущим ценам предложений, item_count - количество товаров, shop_totals - суммы
+    по магазинам с id магазина строкой в ключе. У заказа без позиций total_sum None, как у Sum по пустому набору.
+    """
+    totals = {order_id: {'total_sum': None, 'item_count': 0, 'shop_totals': {}} for order_id in order_ids}
+    for order_id, shop_id, total, count in OrderItem.objects.filter(order_id__in=totals).order_by().values(
+            'order_id', 'product_info__shop_id').annotate(
+            total=Sum(F('quantity') * F('product_info__price')), count=Sum('quantity')).values_list(
+            'order_id', 'product_info__shop_id', 'total', 'count'):
+        order = totals[order_id]
+        order['total_sum'] = (order['total_sum'] or 0) + total
+        order['item_count'] += count
+        order['shop_totals'][str(shop_id)] = total
+    return totals
+
+
+def refresh_order_totals(order_ids):
+    """
+    Пересчитывает total_sum, item_count и shop_totals заказов order_ids по их позициям.
+
+    Вызывается внутри транзакции, которая меняет позиции. Строки заказов сначала блокируются в порядке id,
+    поэтому параллельные изменения одного заказа пересчитывают итоги по очереди, и последний пересчет
+    видит все зафиксированные позиции. Затем итоги пачки заказов считаются одним запросом
+    и записываются одним bulk_update.
+    """
+    order_ids = sorted(set(order_ids))
+    for start in range(0, len(order_ids), ORDER_TOTALS_BATCH_SIZE):
+        locked = Order.objects.select_for_update().filter(
+            id__in=order_ids[start:start + ORDER_TOTALS_BATCH_SIZE]).order_by('id').values_list('id', flat=True)
+        Order.objects.bulk_update(
+            [Order(id=order_id, **values) for order_id, values in order_totals(list(locked)).items()],
+            ['total_sum', 'item_count', 'shop_totals'])
+
+
+def refresh_basket_totals(shop_ids):
+    """
+    Пересчитывает итоги корзин с позициями магазинов shop_ids после изменения или удаления их предложений.
+    Итоги размещенных заказов не меняются: сумма заказа остается такой, какой была при оформлении.
+    """
+    refresh_order_totals(Order.objects.filter(state='basket').filter(
+        shop_totals__has_any_keys=[str(shop_id) for shop_id in shop_ids]).values_list('id', flat=True))
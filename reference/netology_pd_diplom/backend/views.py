@@ -4,22 +4,33 @@ from django.contrib.auth import authenticate
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError
 from django.core.validators import URLValidator
-from django.db import IntegrityError
-from django.db.models import Q, Sum, F
+from django.db import IntegrityError, transaction
+from django.db.models import Q, F, Count, Max
 from django.http import JsonResponse
-from requests import get
+from django.utils import timezone
 from rest_framework.authtoken.models import Token
 from rest_framework.generics import ListAPIView
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from rest_framework.views import APIView
 from ujson import loads as load_json
-from yaml import load as load_yaml, Loader
 
+from backend.basket import MAX_BASKET_ITEMS, add_basket_items, update_basket_items
+from backend.caching import cached_response, catalog_version, conditional_get
+from backend.catalog import catalog_facets, filter_parameters, parameter_filters, price_filters, price_ordering, \
+    refresh_shop_catalog, search_catalog
+from backend.idempotency import idempotent
 from backend.models import Shop, Category, Product, ProductInfo, Parameter, ProductParameter, Order, OrderItem, \
-    Contact, ConfirmEmailToken
-from backend.serializers import UserSerializer, CategorySerializer, ShopSerializer, ProductInfoSerializer, \
-    OrderItemSerializer, OrderSerializer, ContactSerializer
+    Contact, ConfirmEmailToken, ImportJob, CatalogEntry
+from backend.pagination import CatalogCursorPagination, CatalogSearchPagination
+from backend.renderers import FAST_RENDERER_CLASSES
+from backend.serializers import UserSerializer, CategorySerializer, ShopSerializer, \
+    ContactSerializer, ImportJobSerializer, CatalogEntrySerializer, CATALOG_ENTRY_FIELDS, catalog_entry_values, \
+    catalog_fields, order_fieldsets, order_list_data
 from backend.signals import new_user_registered, new_order
+from backend.stock import StockError, checkout
+from backend.tasks import enqueue_import
+from backend.totals import refresh_order_totals
 
 
 class RegisterAccount(APIView):
@@ -154,6 +165,10 @@ class CategoryView(ListAPIView):
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
 
+    @cached_response()
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
 
 class ShopView(ListAPIView):
     """
@@ -162,53 +177,115 @@ class ShopView(ListAPIView):
     queryset = Shop.objects.filter(state=True)
     serializer_class = ShopSerializer
 
+    @cached_response()
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
 
 class ProductInfoView(APIView):
     """
     Класс для поиска товаров
     """
-    def get(self, request, *args, **kwargs):
-
-        query = Q(shop__state=True)
+    renderer_classes = FAST_RENDERER_CLASSES
+
+    def get_queryset(self, request, fields=CATALOG_ENTRY_FIELDS, fragments=False):
+        """
+        Строки каталога по фильтрам запроса: магазин, категория, цена, наличие, характеристики и поисковый запрос.
+        Выбираются только столбцы полей ответа fields, а для списка из кэша фрагментов (fragments) -
+        только курсор и версия строки. Неверный фильтр или сортировка - ValueError.
+        """
+        query = Q(shop_state=True)
         shop_id = request.query_params.get('shop_id')
         category_id = request.query_params.get('category_id')
+        search = request.query_params.get('search', '').strip()
 
         if shop_id:
             query = query & Q(shop_id=shop_id)
 
         if category_id:
-            query = query & Q(product__category_id=category_id)
+            query = query & Q(category_id=category_id)
 
-        # фильтруем и отбрасываем дуликаты
-        queryset = ProductInfo.objects.filter(
-            query).select_related(
-            'shop', 'product__category').prefetch_related(
-            'product_parameters__parameter').distinct()
+        # денормализованный каталог читается одним запросом без соединений
+        queryset = CatalogEntry.objects.filter(query)
 
-        serializer = ProductInfoSerializer(queryset, many=True)
+        # фильтры по цене, наличию и характеристикам param[...], param_min[...], param_max[...]
+        queryset = queryset.filter(price_filters(request.query_params))
+        queryset = filter_parameters(queryset, parameter_filters(request.query_params))
+        ordering = price_ordering(request.query_params)
 
-        return Response(serializer.data)
+        # поиск по названию, модели и характеристикам, результаты упорядочены по релевантности
+        # или по цене, если задан ordering; без поиска сортировку применяет CatalogCursorPagination
+        if search:
+            queryset = search_catalog(queryset, search, ordering=ordering)
+
+        # строки отдаются словарями values() без создания моделей, см. CatalogEntrySerializer
+        return queryset.values(*catalog_entry_values(fields, fragments))
+
+    @cached_response(shop_param='shop_id')
+    def get(self, request, *args, **kwargs):
+        try:
+            fields = catalog_fields(request.query_params)
+            # полный список собирается из кэша фрагментов JSON, выборочные поля - из строк страницы
+            fragments = len(fields) == len(CATALOG_ENTRY_FIELDS)
+            queryset = self.get_queryset(request, fields, fragments)
+        except ValueError as error:
+            return JsonResponse({'Status': False, 'Errors': str(error)}, status=400)
+
+        # результаты поиска отдаются по номеру страницы, каталог без поиска - страницами по курсору
+        if request.query_params.get('search', '').strip():
+            paginator = CatalogSearchPagination()
+        else:
+            paginator = CatalogCursorPagination()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        serializer = CatalogEntrySerializer(page, many=True, context={'fields': fields, 'fragments': fragments})
+
+        return paginator.get_paginated_response(serializer.data)
+
+
+class ProductFacetsView(ProductInfoView):
+    """
+    Класс для фасетов: количество товаров по значениям характеристик с учетом фильтров поиска товаров
+    """
+    # в фасетах есть float, их JSONRenderer записывает иначе, чем orjson
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES
+
+    @cached_response(shop_param='shop_id')
+    def get(self, request, *args, **kwargs):
+        try:
+            # параметры проверяются так же, как при поиске товаров;
+            # поиск и фильтры по цене сужают фасеты до отобранных строк каталога
+            queryset = self.get_queryset(request)
+            narrowed = request.query_params.get('search', '').strip() or price_filters(request.query_params)
+            facets = catalog_facets(shop_id=request.query_params.get('shop_id'),
+                                    category_id=request.query_params.get('category_id'),
+                                    filters=parameter_filters(request.query_params),
+                                    entries=queryset if narrowed else None)
+        except ValueError as error:
+            return JsonResponse({'Status': False, 'Errors': str(error)}, status=400)
+
+        return Response(facets)
 
 
 class BasketView(APIView):
     """
     Класс для работы с корзиной пользователя
     """
+    renderer_classes = FAST_RENDERER_CLASSES
 
     # получить корзину
     def get(self, request, *args, **kwargs):
         if not request.user.is_authenticated:
             return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
-        basket = Order.objects.filter(
-            user_id=request.user.id, state='basket').prefetch_related(
-            'ordered_items__product_info__product__category',
-            'ordered_items__product_info__product_parameters__parameter').annotate(
-            total_sum=Sum(F('ordered_items__quantity') * F('ordered_items__product_info__price'))).distinct()
+        try:
+            fields, expand = order_fieldsets(request.query_params)
+        except ValueError as error:
+            return JsonResponse({'Status': False, 'Errors': str(error)}, status=400)
+        basket = Order.objects.filter(user_id=request.user.id, state='basket')
 
-        serializer = OrderSerializer(basket, many=True)
-        return Response(serializer.data)
+        return Response(order_list_data(basket, fields, expand))
 
     # редактировать корзину
+    @idempotent
     def post(self, request, *args, **kwargs):
         if not request.user.is_authenticated:
             return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
@@ -220,24 +297,22 @@ class BasketView(APIView):
             except ValueError:
                 JsonResponse({'Status': False, 'Errors': 'Неверный формат запроса'})
             else:
+                if not isinstance(items_dict, list) or len(items_dict) > MAX_BASKET_ITEMS:
+                    return JsonResponse({'Status': False, 'Errors': f'items: ожидается список '
+                                                                    f'не длиннее {MAX_BASKET_ITEMS} позиций'},
+                                        status=400)
                 basket, _ = Order.objects.get_or_create(user_id=request.user.id, state='basket')
-                objects_created = 0
-                for order_item in items_dict:
-                    order_item.update({'order': basket.id})
-                    serializer = OrderItemSerializer(data=order_item)
-                    if serializer.is_valid():
-                        try:
-                            serializer.save()
-                        except IntegrityError as error:
-                            return JsonResponse({'Status': False, 'Errors': str(error)})
-                        else:
-                            objects_created += 1
-
-                    else:
-
-                        JsonResponse({'Status': False, 'Errors': serializer.errors})
 
-                return JsonResponse({'Status': True, 'Создано объектов': objects_created})
+                # все позиции проверяются и добавляются вместе, результат - по каждой позиции
+                try:
+                    results = add_basket_items(basket, items_dict)
+                except IntegrityError:
+                    return JsonResponse({'Status': False, 'Errors': 'Корзина изменена параллельным запросом, '
+                                                                    'повторите запрос'}, status=409)
+                objects_created = sum(result['status'] == 'created' for result in results)
+
+                return JsonResponse({'Status': objects_created == len(results), 'Создано объектов': objects_created,
+                                     'Позиции': results})
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
     # удалить товары из корзины
@@ -257,7 +332,9 @@ class BasketView(APIView):
                     objects_deleted = True
 
             if objects_deleted:
-                deleted_count = OrderItem.objects.filter(query).delete()[0]
+                with transaction.atomic():
+                    deleted_count = OrderItem.objects.filter(query).delete()[0]
+                    refresh_order_totals([basket.id])
                 return JsonResponse({'Status': True, 'Удалено объектов': deleted_count})
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
@@ -273,14 +350,20 @@ class BasketView(APIView):
             except ValueError:
                 JsonResponse({'Status': False, 'Errors': 'Неверный формат запроса'})
             else:
+                if not isinstance(items_dict, list) or len(items_dict) > MAX_BASKET_ITEMS:
+                    return JsonResponse({'Status': False, 'Errors': f'items: ожидается список '
+                                                                    f'не длиннее {MAX_BASKET_ITEMS} позиций'},
+                                        status=400)
                 basket, _ = Order.objects.get_or_create(user_id=request.user.id, state='basket')
-                objects_updated = 0
-                for order_item in items_dict:
-                    if type(order_item['id']) == int and type(order_item['quantity']) == int:
-                        objects_updated += OrderItem.objects.filter(order_id=basket.id, id=order_item['id']).update(
-                            quantity=order_item['quantity'])
 
-                return JsonResponse({'Status': True, 'Обновлено объектов': objects_updated})
+                # все количества записываются одним UPDATE, количество 0 удаляет позицию
+                results = update_basket_items(basket, items_dict, key='id')
+                objects_updated = sum(result['status'] == 'updated' for result in results)
+                objects_deleted = sum(result['status'] == 'deleted' for result in results)
+
+                return JsonResponse({'Status': objects_updated + objects_deleted == len(results),
+                                     'Обновлено объектов': objects_updated, 'Удалено объектов': objects_deleted,
+                                     'Позиции': results})
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
 
@@ -303,37 +386,37 @@ class PartnerUpdate(APIView):
             except ValidationError as e:
                 return JsonResponse({'Status': False, 'Error': str(e)})
             else:
-                stream = get(url).content
-
-                data = load_yaml(stream, Loader=Loader)
-
-                shop, _ = Shop.objects.get_or_create(name=data['shop'], user_id=request.user.id)
-                for category in data['categories']:
-                    category_object, _ = Category.objects.get_or_create(id=category['id'], name=category['name'])
-                    category_object.shops.add(shop.id)
-                    category_object.save()
-                ProductInfo.objects.filter(shop_id=shop.id).delete()
-                for item in data['goods']:
-                    product, _ = Product.objects.get_or_create(name=item['name'], category_id=item['category'])
-
-                    product_info = ProductInfo.objects.create(product_id=product.id,
-                                                              external_id=item['id'],
-                                                              model=item['model'],
-                                                              price=item['price'],
-                                                              price_rrc=item['price_rrc'],
-                                                              quantity=item['quantity'],
-                                                              shop_id=shop.id)
-                    for name, value in item['parameters'].items():
-                        parameter_object, _ = Parameter.objects.get_or_create(name=name)
-                        ProductParameter.objects.create(product_info_id=product_info.id,
-                                                        parameter_id=parameter_object.id,
-                                                        value=value)
+                # incremental=true - обновить только изменившиеся товары вместо перезаливки каталога
+                try:
+                    incremental = strtobool(request.data.get('incremental', 'false'))
+                except ValueError as error:
+                    return JsonResponse({'Status': False, 'Errors': str(error)})
 
-                return JsonResponse({'Status': True})
+                # импорт выполняется в фоне, клиент получает id задачи для отслеживания статуса
+                job = ImportJob.objects.create(user_id=request.user.id, url=url, incremental=incremental)
+                enqueue_import(job)
+
+                return JsonResponse({'Status': True, 'Job': job.id})
 
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
 
+class PartnerUpdateJob(APIView):
+    """
+    Класс для получения статуса и прогресса задачи импорта
+    """
+    def get(self, request, pk, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
+
+        job = ImportJob.objects.filter(id=pk, user_id=request.user.id).first()
+        if job is None:
+            return JsonResponse({'Status': False, 'Error': 'Задача не найдена'}, status=404)
+
+        serializer = ImportJobSerializer(job)
+        return Response(serializer.data)
+
+
 class PartnerState(APIView):
     """
     Класс для работы со статусом поставщика
@@ -361,7 +444,12 @@ class PartnerState(APIView):
         state = request.data.get('state')
         if state:
             try:
-                Shop.objects.filter(user_id=request.user.id).update(state=strtobool(state))
+                # смена статуса меняет каталог магазина, поэтому версия увеличивается в том же запросе
+                Shop.objects.filter(user_id=request.user.id).update(state=strtobool(state),
+                                                                    catalog_version=F('catalog_version') + 1,
+                                                                    catalog_modified=timezone.now())
+                for shop in Shop.objects.filter(user_id=request.user.id):
+                    refresh_shop_catalog(shop)
                 return JsonResponse({'Status': True})
             except ValueError as error:
                 return JsonResponse({'Status': False, 'Errors': str(error)})
@@ -373,21 +461,26 @@ class PartnerOrders(APIView):
     """
     Класс для получения заказов поставщиками
     """
+    renderer_classes = FAST_RENDERER_CLASSES
+
     def get(self, request, *args, **kwargs):
         if not request.user.is_authenticated:
             return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
 
         if request.user.type != 'shop':
             return JsonResponse({'Status': False, 'Error': 'Только для магазинов'}, status=403)
+        try:
+            fields, expand = order_fieldsets(request.query_params)
+        except ValueError as error:
+            return JsonResponse({'Status': False, 'Errors': str(error)}, status=400)
 
-        order = Order.objects.filter(
-            ordered_items__product_info__shop__user_id=request.user.id).exclude(state='basket').prefetch_related(
-            'ordered_items__product_info__product__category',
-            'ordered_items__product_info__product_parameters__parameter').select_related('contact').annotate(
-            total_sum=Sum(F('ordered_items__quantity') * F('ordered_items__product_info__price'))).distinct()
+        # заказы с позициями магазина без соединения с позициями, поэтому без повторов и distinct
+        order = Order.objects.filter(id__in=OrderItem.objects.filter(
+            product_info__shop__user_id=request.user.id).values('order_id')).exclude(state='basket')
+        shop_ids = list(Shop.objects.filter(user_id=request.user.id).values_list('id', flat=True))
 
-        serializer = OrderSerializer(order, many=True)
-        return Response(serializer.data)
+        # сумма заказа для поставщика - сумма позиций всех его магазинов
+        return Response(order_list_data(order, fields, expand, shop_ids=shop_ids))
 
 
 class ContactView(APIView):
@@ -455,6 +548,8 @@ class ContactView(APIView):
                     serializer = ContactSerializer(contact, data=request.data, partial=True)
                     if serializer.is_valid():
                         serializer.save()
+                        # контакт входит в список заказов, поэтому меняется и время изменения его заказов
+                        Order.objects.filter(contact_id=contact.id).update(updated_at=timezone.now())
                         return JsonResponse({'Status': True})
                     else:
                         JsonResponse({'Status': False, 'Errors': serializer.errors})
@@ -462,42 +557,68 @@ class ContactView(APIView):
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
 
+def order_version(request):
+    """
+    Версия списка заказов пользователя для условного GET: число заказов и время последнего изменения.
+    В список входят цены и характеристики товаров, поэтому в версию входит и версия каталога.
+    """
+    if not request.user.is_authenticated:
+        return None
+    versions = Order.objects.filter(user_id=request.user.id).exclude(state='basket').order_by().aggregate(
+        count=Count('id'), modified=Max('updated_at'))
+    modified = versions['modified']
+    version = f'orders{request.user.id}.{versions["count"]}.{modified.timestamp() if modified else 0}'
+    catalog, catalog_modified = catalog_version()
+    return f'{version}.{catalog}', max(filter(None, (modified, catalog_modified)), default=None)
+
+
 class OrderView(APIView):
     """
     Класс для получения и размешения заказов пользователями
     """
+    renderer_classes = FAST_RENDERER_CLASSES
 
     # получить мои заказы
+    @conditional_get(order_version)
     def get(self, request, *args, **kwargs):
         if not request.user.is_authenticated:
             return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
-        order = Order.objects.filter(
-            user_id=request.user.id).exclude(state='basket').prefetch_related(
-            'ordered_items__product_info__product__category',
-            'ordered_items__product_info__product_parameters__parameter').select_related('contact').annotate(
-            total_sum=Sum(F('ordered_items__quantity') * F('ordered_items__product_info__price'))).distinct()
+        try:
+            fields, expand = order_fieldsets(request.query_params)
+        except ValueError as error:
+            return JsonResponse({'Status': False, 'Errors': str(error)}, status=400)
 
-        serializer = OrderSerializer(order, many=True)
-        return Response(serializer.data)
+        order = Order.objects.filter(user_id=request.user.id).exclude(state='basket')
+
+        return Response(order_list_data(order, fields, expand))
 
     # разместить заказ из корзины
+    @idempotent
     def post(self, request, *args, **kwargs):
         if not request.user.is_authenticated:
             return JsonResponse({'Status': False, 'Error': 'Log in required'}, status=403)
 
         if {'id', 'contact'}.issubset(request.data):
             if request.data['id'].isdigit():
+                # partial=true - оформить то, что есть на складе, вместо отказа во всем заказе
                 try:
-                    is_updated = Order.objects.filter(
-                        user_id=request.user.id, id=request.data['id']).update(
-                        contact_id=request.data['contact'],
-                        state='new')
+                    partial = strtobool(request.data.get('partial', 'false'))
+                except ValueError as error:
+                    return JsonResponse({'Status': False, 'Errors': str(error)})
+
+                # корзина блокируется на время оформления, остатки списываются в той же транзакции
+                try:
+                    results = checkout(Order.objects.filter(user_id=request.user.id, id=request.data['id']),
+                                       partial=partial, contact_id=request.data['contact'])
+                except StockError as error:
+                    return JsonResponse({'Status': False, 'Errors': str(error), 'Позиции': error.results},
+                                        status=409)
                 except IntegrityError as error:
                     print(error)
                     return JsonResponse({'Status': False, 'Errors': 'Неправильно указаны аргументы'})
                 else:
-                    if is_updated:
+                    if results is not None:
                         new_order.send(sender=self.__class__, user_id=request.user.id)
-                        return JsonResponse({'Status': True})
+                        return JsonResponse({'Status': True, 'Позиции': results})
 
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})